@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+import time
+
+import glog as log
+import numpy as np
+import torch
+
+from evaluate import DefaultEvaluator
+from go import BLACK, EMPTY, WHITE
+from gtp import format_vertex, parse_vertex
+from mcts import TreeNode, advance, search
+from network import ZetaGoNetwork
+from predict import run_concurrently
+
+# Batch analysis of positions without a display: the positions are read
+# from a file line by line, every one of them is evaluated by the raw
+# network or by a search of a fixed number of simulations, and the
+# results are written as JSON lines as soon as they are ready.
+# The positions are analyzed concurrently (see predict.run_concurrently())
+# so that the network evaluates them in batches, and at most concurrency
+# of them are held in memory at the same time, however large the input
+# is.
+#
+# Every line of the input is either the moves of a game from the empty
+# board (black first) in vertices separated by spaces, e.g.,
+#   D4 Q16 pass C3
+# or a JSON object:
+#   {"id": ..., "moves": [...], "black": [...], "white": [...],
+#    "turn": "b", "komi": 7.5}
+# where all the fields are optional: "black" and "white" are the stones
+# set up before the moves, "turn" is the player to move after the setup
+# (black by default), and "id" (the line number by default) is copied to
+# the result.
+# The result of a position is:
+#   {"id": ..., "turn": "b", "value": ..., "policy": [...]}
+# where "value" is the value predicted for the player to move, and
+# "policy" is the prior probabilities of the actions (action x * size + y
+# is the vertex in column x and row size - y, the last one is pass).
+# With a search, the result also contains the visit counts of the actions
+# "visits", the average value of the search for the player to move
+# "search_value" and the most visited move "best_move".
+# The results are written in the order they finish, not in the order of
+# the input. An invalid line gets a result with an "error" instead.
+
+# the precision of the probabilities and the values in the output
+_DIGITS = 6
+
+# log the progress after every this number of positions
+_LOG_FREQUENCY = 1000
+
+
+# create the search tree root of a position described by a line of the
+# input, and return the id and the root
+# a ValueError is raised if the line is invalid
+def parse_position(line, line_number, conf):
+    line = line.strip()
+    if line.startswith('{'):
+        position = json.loads(line)
+        if not isinstance(position, dict):
+            raise ValueError('a position must be a JSON object')
+    else:
+        position = {'moves': line.split()}
+    moves = position.get('moves', [])
+    if isinstance(moves, str):
+        moves = moves.split()
+
+    root = TreeNode(None, None, None, conf)
+    go = root.go
+    if 'komi' in position:
+        go.komi = float(position['komi'])
+    for color, key in ((BLACK, 'black'), (WHITE, 'white')):
+        for vertex in position.get(key, []):
+            action = parse_vertex(vertex, conf)
+            if action == conf.PASS:
+                raise ValueError('invalid setup stone')
+            x, y = divmod(action, conf.BOARD_SIZE)
+            if go.board.color(x, y) != EMPTY:
+                raise ValueError('occupied setup stone {}'.format(vertex))
+            go.board.place(x, y, color)
+    turn = str(position.get('turn', 'b')).lower()
+    if turn not in ('b', 'w'):
+        raise ValueError('invalid turn')
+    go.turn = BLACK if turn == 'b' else WHITE
+
+    for vertex in moves:
+        action = parse_vertex(vertex, conf)
+        if action != conf.PASS and not root.go.legal_play(
+                *divmod(action, conf.BOARD_SIZE)):
+            raise ValueError('illegal move {}'.format(vertex))
+        root = advance(root, action, conf)
+    return position.get('id', line_number), root
+
+
+def _rounded(x):
+    return np.round(np.asarray(x, dtype=np.float64), _DIGITS).tolist()
+
+
+# the coroutine that analyzes the position of root (see
+# predict.run_coroutine()), and returns the result
+def analysis(position_id, root, evaluator, conf, num_simulations):
+    # the value of a finished game is its result
+    if root.proven is None:
+        if num_simulations == 0:
+            root.p, root.v = yield evaluator, root
+        else:
+            for _ in range(num_simulations):
+                yield from search(root, evaluator, conf)
+
+    result = {
+        'id': position_id,
+        'turn': 'b' if root.go.turn == BLACK else 'w',
+        'value': round(float(root.v), _DIGITS),
+        'policy': None if root.p is None else _rounded(root.p),
+    }
+    if num_simulations > 0:
+        result['visits'] = root.n.tolist()
+        result['search_value'] = round(
+            float(root.w.sum() / max(root.n.sum(), 1)), _DIGITS)
+        result['best_move'] = format_vertex(int(np.argmax(root.n)), conf) \
+            if root.n.sum() > 0 else None
+    return result
+
+
+# analyze the positions in the lines of input, and write the results to
+# output, and return the number of positions analyzed
+# num_simulations is the number of simulations of the search of every
+# position, 0 for the raw network evaluation
+def analyze(input, output, evaluator, conf, num_simulations, concurrency):
+    # the analysis looks at the position as it is, without the Dirichlet
+    # noise of self-play
+    conf = conf._replace(DIRICHLET_EPSILON=0.0)
+
+    def write(result):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    # the analyses of the valid lines, taken as soon as there is room
+    # (see predict.run_concurrently()), the invalid ones are reported
+    # right away
+    def analyses():
+        for line_number, line in enumerate(input, 1):
+            if line.strip() == '':
+                continue
+            try:
+                position_id, root = parse_position(line, line_number, conf)
+            except (ValueError, TypeError, AttributeError) as e:
+                write({'id': line_number, 'error': str(e)})
+                continue
+            yield analysis(position_id, root, evaluator, conf,
+                           num_simulations)
+
+    count = 0
+    start = time.time()
+    for result in run_concurrently(analyses(), concurrency, conf):
+        write(result)
+        count += 1
+        if count % _LOG_FREQUENCY == 0:
+            log.info('{} positions analyzed ({:.1f} positions/s)'.format(
+                count, count / max(time.time() - start, 1e-6)))
+    return count
+
+
+# analyze the positions in input_file (standard input if it is "-") with
+# the model in model_file, and write the results to output_file
+# (standard output if it is "-")
+def run_analyze(model_file, input_file, output_file, num_simulations=0,
+                concurrency=32):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # the model holds conf besides the tensors
+    model = torch.load(model_file, map_location=device, weights_only=False)
+    conf = model['conf']
+
+    network = ZetaGoNetwork(conf)
+    network.load_state_dict(model['network'])
+    network.to(device)
+    evaluator = DefaultEvaluator(network, device)
+
+    input = sys.stdin if input_file == '-' else open(input_file)
+    output = sys.stdout if output_file == '-' else open(output_file, 'w')
+    try:
+        start = time.time()
+        count = analyze(input, output, evaluator, conf, num_simulations,
+                        concurrency)
+        log.info('{} positions analyzed in {:.1f}s'.format(
+            count, time.time() - start))
+    finally:
+        if input is not sys.stdin:
+            input.close()
+        if output is not sys.stdout:
+            output.close()
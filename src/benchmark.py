@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+import os
+import pickle
+import platform
+import random
+import time
+
+import glog as log
+import numpy as np
+import torch
+
+from config import get_conf
+from evaluate import DefaultEvaluator
+from go import Board, Go
+from mcts import TreeNode, tree_search
+from network import ZetaGoNetwork
+from play import self_play
+from predict import extract_features
+from record import extract_features as extract_record_features
+from resign import ResignManager
+from root_parallel import RootParallelSearch
+
+# The benchmark suite measures the throughput of the components of
+# ZetaGo with fixed seeds, so that the results of two versions are
+# comparable on the same machine.
+# The results are written to a JSON file:
+#   {
+#     "meta": {"time": ..., "config": ..., "torch": ..., ...},
+#     "results": {
+#       "<name>": {"value": ..., "unit": ..., "higher_is_better": ...},
+#       ...
+#     }
+#   }
+# and can be compared with the results of a baseline (see compare()).
+
+_SEED = 0
+
+# the micro benchmarks are repeated and the best time is taken
+_REPEAT = 3
+
+# number of random games used by the rules benchmarks
+_NUM_RANDOM_GAMES = 20
+
+# the batch sizes of the network forward benchmark
+_BATCH_SIZES = (1, 8, 32, 128)
+
+# number of forward passes for each batch size
+_NUM_FORWARDS = 20
+
+# number of simulations of the search benchmark
+_NUM_SEARCH_SIMULATIONS = 200
+
+# maximum number of processes of the root parallel search benchmark
+_MAX_SEARCH_PROCESSES = 8
+
+
+def _seed():
+    random.seed(_SEED)
+    np.random.seed(_SEED)
+    torch.manual_seed(_SEED)
+
+
+# return the best time of running func repeatedly
+def _best_time(func, repeat=_REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _result(value, unit, higher_is_better=True):
+    return {
+        'value': value,
+        'unit': unit,
+        'higher_is_better': higher_is_better,
+    }
+
+
+# play a game with uniformly random legal moves, and return the actions
+# a player passes only if there is no legal move, and the game ends
+# after two consecutive passes or max_length moves
+def random_game(conf, rng, max_length):
+    go = Go(board_size=conf.BOARD_SIZE, komi=conf.KOMI)
+    actions = []
+    while len(actions) < max_length:
+        legal = [x * conf.BOARD_SIZE + y
+                 for x in range(conf.BOARD_SIZE)
+                 for y in range(conf.BOARD_SIZE) if go.legal_play(x, y)]
+        if len(legal) == 0:
+            action = conf.PASS
+            go.pass_()
+        else:
+            action = legal[rng.randint(len(legal))]
+            go.play(action // conf.BOARD_SIZE, action % conf.BOARD_SIZE)
+        actions.append(action)
+        if len(actions) >= 2 and actions[-1] == actions[-2] == conf.PASS:
+            break
+    return actions
+
+
+def _replay(actions, conf):
+    go = Go(board_size=conf.BOARD_SIZE, komi=conf.KOMI)
+    for action in actions:
+        if action == conf.PASS:
+            go.pass_()
+        else:
+            go.play(action // conf.BOARD_SIZE, action % conf.BOARD_SIZE)
+    return go
+
+
+# return the positions at every move of the games
+def _positions(games, conf):
+    positions = []
+    for actions in games:
+        go = Go(board_size=conf.BOARD_SIZE, komi=conf.KOMI)
+        for action in actions:
+            positions.append(go)
+            go = Go(copy=go)
+            if action == conf.PASS:
+                go.pass_()
+            else:
+                go.play(action // conf.BOARD_SIZE, action % conf.BOARD_SIZE)
+    return positions
+
+
+def bench_rules(conf, results):
+    rng = np.random.RandomState(_SEED)
+    games = [random_game(conf, rng, conf.MAX_GAME_LENGTH)
+             for _ in range(_NUM_RANDOM_GAMES)]
+    num_moves = sum(len(actions) for actions in games)
+    positions = _positions(games, conf)
+    final_positions = [_replay(actions, conf) for actions in games]
+
+    # Go.play (and Go.pass_) on random legal games
+    elapsed = _best_time(lambda: [_replay(a, conf) for a in games])
+    results['go_play'] = _result(num_moves / elapsed, 'moves/s')
+
+    # legal_play on every intersection of every position
+    def sweep():
+        for go in positions:
+            for x in range(conf.BOARD_SIZE):
+                for y in range(conf.BOARD_SIZE):
+                    go.legal_play(x, y)
+    elapsed = _best_time(sweep)
+    results['legal_play_sweep'] = _result(
+        len(positions) / elapsed, 'positions/s')
+
+    # Board.score on the final positions
+    def score():
+        for go in final_positions:
+            Go(copy=go).score()
+    copy_time = _best_time(
+        lambda: [Go(copy=go) for go in final_positions])
+    elapsed = max(_best_time(score) - copy_time, 1e-9)
+    results['board_score'] = _result(
+        len(final_positions) / elapsed, 'positions/s')
+
+
+# the default pickle of a game, i.e., the __dict__s of the Go and the
+# Board (with the BitSets of the liberties), which Go.__reduce__()
+# replaces with the binary encoding
+def _default_dumps(go):
+    return pickle.dumps((go.__dict__, go.board.__dict__))
+
+
+def _default_loads(data):
+    go_state, board_state = pickle.loads(data)
+    go, board = Go.__new__(Go), Board.__new__(Board)
+    go.__dict__.update(go_state)
+    board.__dict__.update(board_state)
+    go.board = board
+    return go
+
+
+# Go.to_bytes() and Go.from_bytes() compared with the default pickle on
+# the positions of random games
+def bench_serialization(conf, results):
+    rng = np.random.RandomState(_SEED)
+    games = [random_game(conf, rng, conf.MAX_GAME_LENGTH)
+             for _ in range(_NUM_RANDOM_GAMES)]
+    positions = _positions(games, conf)
+
+    for name, dumps, loads in (
+            ('go_bytes', lambda go: go.to_bytes(), Go.from_bytes),
+            ('go_pickle', _default_dumps, _default_loads)):
+        data = [dumps(go) for go in positions]
+        elapsed = _best_time(lambda: [dumps(go) for go in positions])
+        results['{}_encode'.format(name)] = _result(
+            len(positions) / elapsed, 'positions/s')
+        elapsed = _best_time(lambda: [loads(d) for d in data])
+        results['{}_decode'.format(name)] = _result(
+            len(positions) / elapsed, 'positions/s')
+        results['{}_size'.format(name)] = _result(
+            sum(len(d) for d in data) / len(data), 'bytes',
+            higher_is_better=False)
+
+
+def bench_features(conf, results):
+    rng = np.random.RandomState(_SEED)
+    actions = random_game(conf, rng, conf.MAX_GAME_LENGTH)
+
+    # a chain of search tree nodes (not evaluated) along the game
+    nodes = [TreeNode(None, None, None, conf)]
+    for action in actions:
+        nodes.append(TreeNode(nodes[-1], action, None, conf))
+    elapsed = _best_time(
+        lambda: [extract_features(node, conf) for node in nodes])
+    results['extract_features_tree'] = _result(
+        len(nodes) / elapsed, 'positions/s')
+
+    # the same positions from the histories of a game record
+    histories = []
+    for node in nodes:
+        history = []
+        while node is not None and len(history) < conf.HISTORY_LENGTH:
+            history.append(node.go)
+            node = node.parent
+        histories.append(history)
+    elapsed = _best_time(
+        lambda: [extract_record_features(h, conf) for h in histories])
+    results['extract_features_record'] = _result(
+        len(histories) / elapsed, 'positions/s')
+
+
+def bench_network(conf, network, device, results):
+    network.eval()
+    for batch_size in _BATCH_SIZES:
+        features = torch.rand(
+            batch_size, conf.INPUT_CHANNELS,
+            conf.BOARD_SIZE, conf.BOARD_SIZE).to(device)
+
+        def forward():
+            with torch.no_grad():
+                for _ in range(_NUM_FORWARDS):
+                    network(features)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+        forward()  # warm up
+        elapsed = _best_time(forward)
+        results['forward_latency_batch_{}'.format(batch_size)] = _result(
+            elapsed / _NUM_FORWARDS * 1000.0, 'ms', higher_is_better=False)
+        results['forward_throughput_batch_{}'.format(batch_size)] = _result(
+            batch_size * _NUM_FORWARDS / elapsed, 'positions/s')
+
+
+def bench_search(conf, network, device, results):
+    evaluator = DefaultEvaluator(network, device)
+
+    def search():
+        _seed()
+        root = TreeNode(None, None, evaluator, conf)
+        for _ in range(_NUM_SEARCH_SIMULATIONS):
+            tree_search(root, evaluator, conf)
+    elapsed = _best_time(search)
+    results['search'] = _result(
+        _NUM_SEARCH_SIMULATIONS / elapsed, 'simulations/s')
+
+
+# the search with root parallelization over several local processes,
+# measured in the same way as bench_search() (the start of the processes
+# is not included)
+def bench_root_parallel_search(conf, network, device, results):
+    num_processes = max(2, min(os.cpu_count(), _MAX_SEARCH_PROCESSES))
+    _seed()
+    parallel_search = RootParallelSearch(network, conf, device, num_processes)
+    try:
+        # warm up, and wait until all the processes are ready
+        parallel_search.search([], num_processes)
+
+        def search():
+            parallel_search.clear()
+            parallel_search.search([], _NUM_SEARCH_SIMULATIONS)
+        elapsed = _best_time(search)
+    finally:
+        parallel_search.close()
+    results['search_root_parallel_{}'.format(num_processes)] = _result(
+        _NUM_SEARCH_SIMULATIONS / elapsed, 'simulations/s')
+
+
+def bench_self_play(network, device, num_games, results):
+    # always measured on 9x9 boards with the settings of the 9x9
+    # configuration (except the network)
+    conf = get_conf('9x9')
+    if network is None:
+        network = ZetaGoNetwork(conf)
+        network.to(device)
+    evaluator = DefaultEvaluator(network, device)
+    resign_mgr = ResignManager(conf)
+
+    _seed()
+    moves = 0
+    start = time.perf_counter()
+    for _ in range(num_games):
+        moves += len(self_play(evaluator, conf, resign_mgr))
+    elapsed = time.perf_counter() - start
+    results['self_play_9x9'] = _result(
+        num_games * 60.0 / elapsed, 'games/min')
+    results['self_play_9x9_moves'] = _result(moves / elapsed, 'moves/s')
+
+
+# run the benchmark suite with the configuration conf_name, and return
+# the results
+# the self-play benchmark uses the network of the configuration if it is
+# a 9x9 configuration, otherwise a randomly initialized network of the
+# 9x9 configuration
+def run(conf_name, num_games=1):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    conf = get_conf(conf_name)
+
+    _seed()
+    network = ZetaGoNetwork(conf)
+    network.to(device)
+
+    results = {}
+    log.info('benchmarking the rules...')
+    bench_rules(conf, results)
+    log.info('benchmarking serialization...')
+    bench_serialization(conf, results)
+    log.info('benchmarking feature extraction...')
+    bench_features(conf, results)
+    log.info('benchmarking the network...')
+    bench_network(conf, network, device, results)
+    log.info('benchmarking the search...')
+    bench_search(conf, network, device, results)
+    bench_root_parallel_search(conf, network, device, results)
+    if num_games > 0:
+        log.info('benchmarking self-play...')
+        bench_self_play(network if conf.BOARD_SIZE == 9 else None,
+                        device, num_games, results)
+
+    return {
+        'meta': {
+            'time': datetime.now().isoformat(),
+            'config': conf_name,
+            'device': str(device),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+
+
+def save(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# compare the results with the baseline, and return the lines of a
+# comparison table and the names of the regressed benchmarks, i.e.,
+# whose results are worse than the baseline by more than tolerance
+# (relative)
+def compare(report, baseline, tolerance):
+    lines = ['{:<32} {:>14} {:>14} {:>9}  {}'.format(
+        'benchmark', 'baseline', 'current', 'change', 'unit')]
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        if name not in baseline['results']:
+            lines.append('{:<32} {:>14} {:>14.4g} {:>9}  {}'.format(
+                name, '-', result['value'], '-', result['unit']))
+            continue
+        base = baseline['results'][name]['value']
+        value = result['value']
+        change = (value - base) / base if base != 0 else 0.0
+        # a positive improvement means better
+        improvement = change if result['higher_is_better'] else -change
+        flag = ''
+        if improvement < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        lines.append('{:<32} {:>14.4g} {:>14.4g} {:>+8.1f}%  {}{}'.format(
+            name, base, value, change * 100.0, result['unit'], flag))
+    return lines, regressions
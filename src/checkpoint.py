@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import copy
+from glob import glob
+import os
+import queue
+import threading
+
+import glog as log
+import torch
+
+
+# copy a checkpoint in memory, so that training can go on while the copy
+# is being written
+# tensors are copied to the CPU, and other objects are deep copied
+def snapshot(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [snapshot(x) for x in obj]
+    else:
+        return copy.deepcopy(obj)
+
+
+# a writer that saves checkpoints to <model_dir>/checkpoint_<step>.pt in
+# a background thread
+# a checkpoint is written to a temporary file first and then atomically
+# renamed, so a crash never leaves a partially written checkpoint
+# after a checkpoint is written, only the latest keep checkpoints and
+# the gated ones (i.e., whose networks became the best network) are
+# kept, all the checkpoints are kept if keep is 0
+class CheckpointWriter:
+
+    def __init__(self, model_dir, keep, gated_steps=()):
+        self.model_dir = model_dir
+        self.keep = keep
+
+        # the steps of the gated checkpoints
+        self.gated_steps = set(gated_steps)
+
+        # at most one checkpoint is waiting to be written, save() blocks
+        # if the writer falls behind by more than one checkpoint
+        self._checkpoints = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def path(self, step):
+        return '{}/checkpoint_{}.pt'.format(self.model_dir, step)
+
+    # take a snapshot of the checkpoint and write it in the background
+    # the steps of the gated checkpoints are recorded in the checkpoint
+    # (as 'gated_steps') so that they are still kept after resuming
+    def save(self, checkpoint, step, gated=False):
+        self._check()
+        if gated:
+            self.gated_steps.add(step)
+        checkpoint = snapshot(checkpoint)
+        checkpoint['gated_steps'] = sorted(self.gated_steps)
+        self._checkpoints.put((checkpoint, step))
+
+    # wait until all the checkpoints are written
+    def close(self):
+        self._checkpoints.put(None)
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _work(self):
+        while True:
+            item = self._checkpoints.get()
+            if item is None:
+                return
+            checkpoint, step = item
+            try:
+                path = self.path(step)
+                temp_path = path + '.tmp'
+                torch.save(checkpoint, temp_path)
+                os.replace(temp_path, path)
+                self._remove_old_checkpoints()
+            except Exception as e:
+                log.error('failed to write checkpoint {}: {}'.format(step, e))
+                self._error = e
+
+    def _remove_old_checkpoints(self):
+        if self.keep <= 0:
+            return
+        steps = []
+        for path in glob('{}/checkpoint_*.pt'.format(self.model_dir)):
+            name = os.path.basename(path)
+            steps.append(int(name[len('checkpoint_'):-len('.pt')]))
+        for step in sorted(steps)[:-self.keep]:
+            if step not in self.gated_steps:
+                os.remove(self.path(step))
@@ -1,23 +1,133 @@
 # -*- coding: utf-8 -*-
 
-from play import mutual_play
+import math
 
+from evaluate import DefaultEvaluator
+from play import mutual_play_game
+from predict import run_concurrently
+from sgf import append_sgf, write_sgf
 
-def estimate_win_rate(network_a, network_b, device, conf):
-    score_a, score_b = 0, 0
 
-    # let network_a play black
-    for game in range(conf.NUM_GAMES // 2):
-        if mutual_play(network_a, network_b, device, conf):
+# the coroutine of a game between network_a and network_b (see
+# play.mutual_play_game()), which returns True if network_a wins
+# the game is appended to sgf_file if specified
+def _game(evaluator_a, evaluator_b, a_plays_black, conf, sgf_file=None):
+    actions = []
+    if a_plays_black:
+        a_wins = yield from mutual_play_game(
+            evaluator_a, evaluator_b, conf, actions)
+    else:
+        a_wins = not (yield from mutual_play_game(
+            evaluator_b, evaluator_a, conf, actions))
+    if sgf_file is not None:
+        black_name, white_name = ('network_a', 'network_b') \
+            if a_plays_black else ('network_b', 'network_a')
+        append_sgf(sgf_file, write_sgf(
+            actions, conf, black_name=black_name, white_name=white_name))
+    return a_wins
+
+
+# the coroutine of the game-th evaluation game, which returns the index
+# of the game and whether network_a wins it
+def _indexed_game(game, evaluator_a, evaluator_b, conf, sgf_file=None):
+    a_wins = yield from _game(
+        evaluator_a, evaluator_b, game % 2 == 0, conf, sgf_file)
+    return game, a_wins
+
+
+# the coroutines of all the evaluation games, network_a plays black in
+# every other game, so that both networks play black equally often in
+# every prefix of the games (see gate())
+def evaluation_games(evaluator_a, evaluator_b, conf, sgf_file=None):
+    for game in range(conf.GAMES_PER_EVALUATION):
+        yield _indexed_game(game, evaluator_a, evaluator_b, conf, sgf_file)
+
+
+# play the evaluation games concurrently, and yield the index of each
+# game and whether network_a wins it as the games finish
+# the leaf nodes of all the running games are evaluated in one batch per
+# network
+# the finished games are appended to sgf_file if specified
+# if started is given, it is incremented by every game started
+def play_evaluation_games(network_a, network_b, device, conf, sgf_file=None,
+                          started=None):
+    evaluator_a = DefaultEvaluator(network_a, device)
+    evaluator_b = DefaultEvaluator(network_b, device)
+    games = evaluation_games(evaluator_a, evaluator_b, conf, sgf_file)
+    if started is not None:
+        games = _counted(games, started)
+    return run_concurrently(games, conf.EVALUATION_CONCURRENCY, conf)
+
+
+def _counted(games, started):
+    for game in games:
+        started[0] += 1
+        yield game
+
+
+def estimate_win_rate(network_a, network_b, device, conf, sgf_file=None):
+    score_a, score_b = 0, 0
+    for _, a_wins in play_evaluation_games(
+            network_a, network_b, device, conf, sgf_file):
+        if a_wins:
             score_a += 1
         else:
             score_b += 1
 
-    # let network_b play black
-    for game in range(conf.NUM_GAMES - conf.NUM_GAMES // 2):
-        if mutual_play(network_b, network_a, device, conf):
-            score_b += 1
-        else:
-            score_a += 1
-
     return score_a / (score_a + score_b)
+
+
+# the sequential probability ratio test on the results of the games
+# played so far, return 1 if network_a is decided to be better, -1 if it
+# is decided to be not better, and 0 if undecided
+def sprt(score_a, score_b, conf):
+    p0, p1 = conf.SPRT_WIN_RATES
+    llr = score_a * math.log(p1 / p0) \
+        + score_b * math.log((1.0 - p1) / (1.0 - p0))
+    if llr >= math.log((1.0 - conf.SPRT_BETA) / conf.SPRT_ALPHA):
+        return 1
+    elif llr <= math.log(conf.SPRT_BETA / (1.0 - conf.SPRT_ALPHA)):
+        return -1
+    else:
+        return 0
+
+
+# decide whether network_a is better than network_b, and return the
+# decision, the win rate of network_a and the number of games played
+# if EARLY_GATING is set, the evaluation stops as soon as the decision
+# is made by the sequential probability ratio test (see sprt())
+# the games finish out of order (the short ones first), so the results
+# are buffered and counted in the order the games are started, otherwise
+# the early results would be biased towards the short games
+# when the evaluation stops early, the results of the games after the
+# decision are discarded and the unfinished games are abandoned, but
+# they are still counted as played
+# the finished games are appended to sgf_file if specified
+def gate(network_a, network_b, device, conf, sgf_file=None):
+    score_a, score_b = 0, 0
+    decision = 0
+    started = [0]
+
+    # the results of the games finished before some earlier game
+    pending = {}
+    for game, a_wins in play_evaluation_games(
+            network_a, network_b, device, conf, sgf_file, started):
+        pending[game] = a_wins
+        while score_a + score_b in pending:
+            if pending.pop(score_a + score_b):
+                score_a += 1
+            else:
+                score_b += 1
+            if conf.EARLY_GATING:
+                decision = sprt(score_a, score_b, conf)
+                if decision != 0:
+                    break
+        if decision != 0:
+            break
+
+    win_rate = score_a / (score_a + score_b)
+    if decision == 0:
+        # undecided, fall back to comparing with the margin
+        decision = 1 if win_rate > conf.WIN_RATE_MARGIN else -1
+
+    return decision > 0, win_rate, started[0]
@@ -78,30 +78,121 @@ CONFIGURATIONS = {
         # temperature = 1 when t < EXPLORATION_TIME, and 0 afterward
         'EXPLORATION_TIME': 30,
 
+        # end a self-play game as soon as its winner is decided by the
+        # pass-alive chains and the regions where the opponent can never
+        # live (Benson's algorithm, see go.Board.pass_alive())
+        'EARLY_TERMINATION': True,
+
         # number of simulation in each MCTS
         'NUM_SIMULATIONS': 1600,
 
         # the constant for the PUCT algorithm
         'C_PUCT': 0.1,
 
+        # the algorithm to choose the actions of the root in self-play
+        #   - 'puct': PUCT with Dirichlet noise, and the distribution of
+        #     visits as the training target, as in AlphaGo Zero
+        #   - 'gumbel': Gumbel top-k sampling of GUMBEL_K actions and
+        #     sequential halving, with the improved policy as the training
+        #     target (see mcts.gumbel_search()), which works with much
+        #     fewer simulations
+        # GUMBEL_C_VISIT and GUMBEL_C_SCALE are the constants of the
+        # transformation of q values
+        'ROOT_SEARCH': 'puct',
+        'GUMBEL_K': 16,
+        'GUMBEL_C_VISIT': 50,
+        'GUMBEL_C_SCALE': 1.0,
+
         # parameters for the Dirichlet noise
         'DIRICHLET_ALPHA': 0.03,
         'DIRICHLET_EPSILON': 0.25,
 
+        # never search the plays that fill own single-point eyes, they
+        # are legal but never good in area scoring
+        'PRUNE_EYE_FILLING': True,
+
+        # the predictions of the positions in the first
+        # OPENING_CACHE_PLIES moves are averaged over the 8 dihedral
+        # transformations and shared by the self-play games of the same
+        # best network, at most OPENING_CACHE_SIZE of them are kept
+        # set OPENING_CACHE_PLIES to 0 to cache only the empty board, or
+        # -1 to disable the cache
+        'OPENING_CACHE_PLIES': 8,
+        'OPENING_CACHE_SIZE': 100000,
+
+        # maximum number of self-play games played concurrently in a
+        # process, the leaf nodes of their search trees are evaluated in
+        # batches
+        'SELF_PLAY_CONCURRENCY': 32,
+
         # number of games played when evaluating two networks
         'GAMES_PER_EVALUATION': 400,
 
+        # maximum number of evaluation games played concurrently, the
+        # leaf nodes of their search trees are evaluated in batches
+        'EVALUATION_CONCURRENCY': 32,
+
         # the minimal win rate a new network must have in order for it
         # to be considered as the winner
         'WIN_RATE_MARGIN': 0.55,
 
+        # stop the evaluation as soon as a sequential probability ratio
+        # test (SPRT) decides whether the new network is better, instead
+        # of always playing GAMES_PER_EVALUATION games
+        # the test is between the hypotheses that the win rate of the new
+        # network is SPRT_WIN_RATES[0] (not better) and SPRT_WIN_RATES[1]
+        # (better), with the probabilities of wrongly accepting them
+        # bounded by SPRT_BETA and SPRT_ALPHA respectively
+        # if the test is undecided after GAMES_PER_EVALUATION games, the
+        # win rate is compared with WIN_RATE_MARGIN as usual
+        'EARLY_GATING': True,
+        'SPRT_WIN_RATES': (0.5, 0.6),
+        'SPRT_ALPHA': 0.05,
+        'SPRT_BETA': 0.05,
+
         # maximum number of self-play games stored in the example pool
         # old games will be discarded if the pool is full
         'EXAMPLE_POOL_SIZE': 500000,
 
+        # maximum number of examples (i.e., positions) stored in the
+        # example pool, old games will be discarded if the pool is full
+        'EXAMPLE_POOL_CAPACITY': 100000000,
+
+        # how the examples are stored in the example pool, must be one of
+        #   - 'array': the feature planes are stored in a compact array
+        #   - 'move_record': only the actions and the distributions of
+        #     action selection are stored, the feature planes are
+        #     regenerated by replaying the games when a batch is drawn,
+        #     with a random dihedral transformation applied
+        'EXAMPLE_STORE': 'array',
+
+        # whether to memory map the array store to a file in the model
+        # directory instead of allocating it in memory
+        'EXAMPLE_POOL_MMAP': True,
+
         # frequency of checkpoint
         'CHECKPOINT_FREQUENCY': 1000,
 
+        # number of the latest checkpoints to keep, older checkpoints are
+        # deleted unless their networks became the best network
+        # set to 0 to keep all the checkpoints
+        'KEEP_CHECKPOINTS': 10,
+
+        # the metrics are always appended to <model_dir>/metrics.jsonl,
+        # and also written in the Prometheus text format if set (see
+        # metrics.py)
+        'METRICS_PROMETHEUS': False,
+
+        # number of background threads preparing batches for training
+        'LOADER_WORKERS': 2,
+
+        # maximum number of batches prepared ahead of the optimizer
+        'LOADER_PREFETCH': 4,
+
+        # whether to prepare the batches in pinned memory, which speeds
+        # up the copy to GPU
+        'LOADER_PIN_MEMORY': True,
+
         # ---- resignation settings ----
         # maximal fraction of regretful resignations (i.e., games that
         # could have been won if the player had not resigned)
@@ -147,14 +238,36 @@ CONFIGURATIONS = {
         'L2_REG': 0.0001,
         'LR_SCHEDULE': ((400000, 0.01), (600000, 0.001), (-1, 0.0001)),
         'EXPLORATION_TIME': 8,
+        'EARLY_TERMINATION': True,
         'NUM_SIMULATIONS': 200,
         'C_PUCT': 0.1,
+        'ROOT_SEARCH': 'puct',
+        'GUMBEL_K': 16,
+        'GUMBEL_C_VISIT': 50,
+        'GUMBEL_C_SCALE': 1.0,
         'DIRICHLET_ALPHA': 0.03,
         'DIRICHLET_EPSILON': 0.25,
+        'PRUNE_EYE_FILLING': True,
+        'OPENING_CACHE_PLIES': 4,
+        'OPENING_CACHE_SIZE': 100000,
+        'SELF_PLAY_CONCURRENCY': 32,
         'GAMES_PER_EVALUATION': 100,
+        'EVALUATION_CONCURRENCY': 32,
         'WIN_RATE_MARGIN': 0.55,
+        'EARLY_GATING': True,
+        'SPRT_WIN_RATES': (0.5, 0.6),
+        'SPRT_ALPHA': 0.05,
+        'SPRT_BETA': 0.05,
         'EXAMPLE_POOL_SIZE': 100000,
+        'EXAMPLE_POOL_CAPACITY': 6000000,
+        'EXAMPLE_STORE': 'array',
+        'EXAMPLE_POOL_MMAP': False,
         'CHECKPOINT_FREQUENCY': 1000,
+        'KEEP_CHECKPOINTS': 10,
+        'METRICS_PROMETHEUS': False,
+        'LOADER_WORKERS': 2,
+        'LOADER_PREFETCH': 4,
+        'LOADER_PIN_MEMORY': True,
 
         # ---- resignation settings ----
         'RESIGN_REGRET_FRAC': 0.05,
@@ -197,14 +310,36 @@ Config = collections.namedtuple(
         'LR_SCHEDULE',
         'MAX_GAME_LENGTH',
         'EXPLORATION_TIME',
+        'EARLY_TERMINATION',
         'NUM_SIMULATIONS',
         'C_PUCT',
+        'ROOT_SEARCH',
+        'GUMBEL_K',
+        'GUMBEL_C_VISIT',
+        'GUMBEL_C_SCALE',
         'DIRICHLET_ALPHA',
         'DIRICHLET_EPSILON',
+        'PRUNE_EYE_FILLING',
+        'OPENING_CACHE_PLIES',
+        'OPENING_CACHE_SIZE',
+        'SELF_PLAY_CONCURRENCY',
         'GAMES_PER_EVALUATION',
+        'EVALUATION_CONCURRENCY',
         'WIN_RATE_MARGIN',
+        'EARLY_GATING',
+        'SPRT_WIN_RATES',
+        'SPRT_ALPHA',
+        'SPRT_BETA',
         'EXAMPLE_POOL_SIZE',
+        'EXAMPLE_POOL_CAPACITY',
+        'EXAMPLE_STORE',
+        'EXAMPLE_POOL_MMAP',
         'CHECKPOINT_FREQUENCY',
+        'KEEP_CHECKPOINTS',
+        'METRICS_PROMETHEUS',
+        'LOADER_WORKERS',
+        'LOADER_PREFETCH',
+        'LOADER_PIN_MEMORY',
         'RESIGN_REGRET_FRAC',
         'RESIGN_SAMPLE_RATE',
         'NUM_RESIGN_SAMPLES',
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import random
+
 
 # a bitmap implementation of set
 # high memory efficiency
@@ -61,6 +63,15 @@ class BitSet:
             self.bitmap[i >> 3] &= ~BitSet._masks[i & 7]
             self.size -= 1
 
+    # add all the elements of an iterable at once
+    def update(self, elements):
+        bitmap, masks = self.bitmap, BitSet._masks
+        for i in elements:
+            mask = masks[i & 7]
+            if not bitmap[i >> 3] & mask:
+                bitmap[i >> 3] |= mask
+                self.size += 1
+
     def union(self, other):
         if other is None:
             return
@@ -219,3 +230,133 @@ class Queue:
             self._head = (self._head + 1) % self._capacity
             self._size -= 1
             return x
+
+
+class _TreapNode:
+    __slots__ = ('key', 'weight', 'count', 'priority', 'left', 'right',
+                 'sum', 'min_prefix')
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.count = 1
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.sum = weight
+        self.min_prefix = weight
+
+
+# an ordered multiset of keys, each added with a weight, implemented as a
+# treap (a randomized balanced binary search tree)
+# the prefix sum of a key k is the total weight of all the keys <= k
+# besides insertion and deletion, it supports finding the largest key
+# whose prefix sum does not exceed a given bound in O(log n) time
+# every node maintains the total weight of its subtree (sum) and the
+# minimum prefix sum within its subtree (min_prefix), so that a subtree
+# without any qualified key can be skipped as a whole
+class PrefixSumTree:
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    # number of distinct keys
+    def __len__(self):
+        return self._size
+
+    def add(self, key, weight):
+        left, right = PrefixSumTree._split(self._root, key, False)
+        middle, right = PrefixSumTree._split(right, key, True)
+        if middle is None:
+            middle = _TreapNode(key, weight)
+            self._size += 1
+        else:
+            middle.count += 1
+            middle.weight += weight
+            PrefixSumTree._update(middle)
+        self._root = PrefixSumTree._merge(
+            PrefixSumTree._merge(left, middle), right)
+
+    # remove a key added with the given weight
+    # assuming the key exists
+    def remove(self, key, weight):
+        left, right = PrefixSumTree._split(self._root, key, False)
+        middle, right = PrefixSumTree._split(right, key, True)
+        middle.count -= 1
+        middle.weight -= weight
+        if middle.count == 0:
+            middle = None
+            self._size -= 1
+        else:
+            PrefixSumTree._update(middle)
+        self._root = PrefixSumTree._merge(
+            PrefixSumTree._merge(left, middle), right)
+
+    # return the largest key whose prefix sum is <= bound, or None if
+    # there is no such key
+    def last_key_within(self, bound):
+        node = self._root
+        # the total weight of the keys on the left of the subtree
+        offset = 0
+        while node is not None:
+            left_sum = 0 if node.left is None else node.left.sum
+            prefix = offset + left_sum + node.weight
+            if node.right is not None \
+                    and prefix + node.right.min_prefix <= bound:
+                offset = prefix
+                node = node.right
+            elif prefix <= bound:
+                return node.key
+            elif node.left is not None \
+                    and offset + node.left.min_prefix <= bound:
+                node = node.left
+            else:
+                return None
+        return None
+
+    @staticmethod
+    def _update(node):
+        node.sum = node.weight
+        node.min_prefix = node.weight
+        if node.left is not None:
+            node.sum += node.left.sum
+            node.min_prefix = min(
+                node.left.min_prefix, node.left.sum + node.weight)
+        if node.right is not None:
+            node.min_prefix = min(
+                node.min_prefix, node.sum + node.right.min_prefix)
+            node.sum += node.right.sum
+
+    # split the tree into the keys < key and the keys >= key, or into the
+    # keys <= key and the keys > key if inclusive
+    @staticmethod
+    def _split(node, key, inclusive):
+        if node is None:
+            return None, None
+        if node.key < key or (inclusive and node.key == key):
+            left, right = PrefixSumTree._split(node.right, key, inclusive)
+            node.right = left
+            PrefixSumTree._update(node)
+            return node, right
+        else:
+            left, right = PrefixSumTree._split(node.left, key, inclusive)
+            node.left = right
+            PrefixSumTree._update(node)
+            return left, node
+
+    # merge two trees, assuming all the keys of a are less than those of b
+    @staticmethod
+    def _merge(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        if a.priority > b.priority:
+            a.right = PrefixSumTree._merge(a.right, b)
+            PrefixSumTree._update(a)
+            return a
+        else:
+            b.left = PrefixSumTree._merge(a, b.left)
+            PrefixSumTree._update(b)
+            return b
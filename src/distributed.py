@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+
+# In the distributed mode, the optimizer runs in several processes
+# (ranks), possibly on different nodes, which communicate through
+# torch.distributed with the gloo backend:
+#   - every rank holds a replica of the example pool, the self-play
+#     games of an iteration are split among the ranks and exchanged
+#     afterwards, so that all the replicas hold the same games
+#   - the shuffled permutation of the pool is split into one shard per
+#     rank, and every rank draws batches of BATCH_SIZE / world_size
+#     examples from its own shard, so that one step of all the ranks
+#     still consumes BATCH_SIZE examples and LR_SCHEDULE and
+#     CHECKPOINT_FREQUENCY keep their meanings
+#   - the gradients are all-reduced (averaged) in every step
+#   - only rank 0 writes the games to the storage, evaluates the
+#     network and saves checkpoints
+
+# maximum time to wait for the other ranks, it must be longer than an
+# evaluation because the other ranks wait for rank 0 to evaluate the
+# network
+_TIMEOUT = timedelta(days=1)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# set the address of rank 0 for a single-node run, unless it is already
+# set by the launcher
+def init_local_master():
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(_free_port()))
+
+
+# join the process group, the address of rank 0 is read from the
+# environment variables MASTER_ADDR and MASTER_PORT
+def init(rank, world_size):
+    dist.init_process_group(
+        'gloo', rank=rank, world_size=world_size, timeout=_TIMEOUT)
+
+
+def destroy():
+    dist.destroy_process_group()
+
+
+# the device of a rank, ranks on the same node share the GPUs in a round
+# robin way
+def device_of(local_rank):
+    if torch.cuda.is_available():
+        return torch.device(
+            'cuda:{}'.format(local_rank % torch.cuda.device_count()))
+    else:
+        return torch.device('cpu')
+
+
+# copy the parameters and buffers of rank 0 to all the ranks
+def broadcast_module(module):
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+# return the objects of all the ranks, in the order of their ranks
+def all_gather(obj):
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+# return the object of rank 0
+def broadcast(obj):
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
@@ -1,25 +1,38 @@
 # -*- coding: utf-8 -*-
 
+import time
+
 import glog as log
 import numpy as np
 import torch
 
+from data_structure import Queue
+from distributed import all_gather, broadcast
 from evaluate import DefaultEvaluator
-from play import self_play
+from metrics import self_play_metrics
+from play import self_play_games
+from predict import OpeningCache, dihedral_trans
 from resign import ResignManager
+from storage import GameStorage, from_runs, to_runs
 
 
-class ExamplePool:
+# the common interface of the example pools, the subclasses decide how
+# the games are stored
+# if a GameStorage is given, every game added to the pool is also
+# written to it, and the pool only needs to remember the ids of its
+# games for checkpointing
+class _ExamplePoolBase:
 
-    def __init__(self, conf):
+    def __init__(self, conf, storage=None):
         self.conf = conf
 
-        # the list that stores examples
-        self.examples = []
+        # maximum number of examples in the pool
+        self.capacity = conf.EXAMPLE_POOL_CAPACITY
 
-        # lengths[i] is the length (i.e., number of examples) of the
-        # ith game
-        self.lengths = []
+        # the ids of the games in the pool, from the oldest to the
+        # newest
+        self.storage = storage
+        self.game_ids = Queue(conf.EXAMPLE_POOL_SIZE)
 
         # the random permutation used to shuffle the examples
         self.permutation = None
@@ -30,36 +43,374 @@ class ExamplePool:
         # resignation manager
         self.resign_mgr = ResignManager(conf)
 
-    def generate_examples(self, network, device):
+        # the predictions of the opening positions of the best network,
+        # which must be cleared whenever the best network changes
+        self.opening_cache = OpeningCache(conf)
+
+    # generate the self-play games of an iteration, and return the
+    # throughput metrics (see metrics.self_play_metrics())
+    # in the distributed mode (see distributed.py), every rank plays its
+    # share of the games, and then all the games are added to the pools
+    # of all the ranks in the same order
+    def generate_examples(self, network, device, rank=0, world_size=1):
+        start = time.time()
         evaluator = DefaultEvaluator(network, device)
-        for i in range(self.conf.GAMES_PER_ITERATION):
-            new_examples = self_play(evaluator, self.conf, self.resign_mgr)
-            self.examples += new_examples
-            self.lengths.append(len(new_examples))
-            log.info('{} new examples generated'.format(len(new_examples)))
-
-        # discard old examples when pool is full
-        if len(self.lengths) > self.conf.EXAMPLE_POOL_SIZE:
-            m = len(self.lengths) - self.conf.EXAMPLE_POOL_SIZE
-            n = sum(self.lengths[:m])
-            self.examples = self.examples[n:]
-            self.lengths = self.lengths[m:]
-
-    def shuffle(self):
-        self.permutation = np.random.permutation(len(self.examples))
+        records = []
+        num_games = len(range(rank, self.conf.GAMES_PER_ITERATION, world_size))
+        for record in self_play_games(evaluator, self.conf, self.resign_mgr,
+                                      num_games, self.opening_cache):
+            if world_size == 1:
+                self.add_game(record)
+            records.append(record)
+            log.info('{} new examples generated'.format(len(record)))
+
+        if world_size > 1:
+            records = [r for records_ in all_gather(records)
+                       for r in records_]
+            # only rank 0 writes the games to the storage, the other
+            # ranks reuse their ids
+            game_ids = [self.add_game(r) for r in records] \
+                if rank == 0 else None
+            game_ids = broadcast(game_ids)
+            if rank != 0:
+                for record, game_id in zip(records, game_ids):
+                    self.add_game(record, game_id=game_id)
+
+        return self_play_metrics(records, time.time() - start, self.conf)
+
+    # write a finished game to the storage, and return its id, or None if
+    # there is no storage or the game cannot be added to the pool
+    def store(self, record):
+        if self.storage is None or not 0 < len(record) <= self.capacity:
+            return None
+        return self.storage.append(record)
+
+    # prepare the data of a finished game kept by the pool (see
+    # _append()), which does not modify the pool, so that the expensive
+    # part of adding a game can be done without holding the lock of a
+    # loader.BatchLoader
+    def prepare(self, record):
+        return None
+
+    # append a finished game to the pool, discarding the oldest games
+    # when the pool is full, and return the id of the game
+    # the game is written to the storage unless game_id is given (e.g.,
+    # by store()), and prepared unless prepared is given (see prepare())
+    def add_game(self, record, game_id=None, prepared=None):
+        n = len(record)
+        if n == 0:
+            return
+        if n > self.capacity:
+            log.warning('game of length {} exceeds the capacity of the pool, '
+                        'discarded'.format(n))
+            return
+
+        while self.game_ids.is_full() or len(self) + n > self.capacity:
+            self.game_ids.dequeue()
+            self._discard_oldest_game()
+
+        if game_id is None and self.storage is not None:
+            game_id = self.storage.append(record)
+        self.game_ids.enqueue(game_id)
+        self._append(record, prepared)
+        return game_id
+
+    # add the latest games of storage (e.g., the games imported from SGF
+    # files, see sgf.py) to the pool, and return the number of games read
+    # in the distributed mode, only rank 0 writes the games to the
+    # storage of the pool, and the other ranks reuse their ids
+    def add_stored_games(self, storage, rank=0, world_size=1):
+        begin = max(len(storage) - self.conf.EXAMPLE_POOL_SIZE, 0)
+        game_ids = [self.add_game(storage.read(i))
+                    for i in range(begin, len(storage))] \
+            if rank == 0 else None
+        if world_size > 1:
+            game_ids = broadcast(game_ids)
+            if rank != 0:
+                for i, game_id in zip(range(begin, len(storage)), game_ids):
+                    self.add_game(storage.read(i), game_id=game_id)
+        return len(storage) - begin
+
+    # return the states of the pool for checkpointing, which only
+    # contain the ids of the games instead of the games themselves
+    def state_dict(self):
+        return {
+            'game_ids': to_runs(self.game_ids),
+            'resign_mgr': self.resign_mgr,
+        }
+
+    # restore the pool from the dict returned by state_dict() by
+    # reading the games back from the storage
+    def load_state_dict(self, state):
+        for game_id in from_runs(state['game_ids']):
+            self.add_game(self.storage.read(game_id), game_id=game_id)
+        self.resign_mgr = state['resign_mgr']
+        self.shuffle()
+
+    # if world_size > 1, the permutation is split into world_size shards
+    # of the same size and only the shard of rank is kept, in which case
+    # all the ranks must use the same seed
+    def shuffle(self, rank=0, world_size=1, seed=None):
+        permutation = np.arange(len(self), dtype=np.uint32)
+        if seed is None:
+            np.random.shuffle(permutation)
+        else:
+            np.random.RandomState(seed).shuffle(permutation)
+        if world_size > 1:
+            permutation = permutation[
+                rank:len(permutation) // world_size * world_size:world_size]
+        self.permutation = permutation
         self.position = 0
 
     def has_batch(self):
-        return self.position + self.conf.BATCH_SIZE < len(self.examples)
+        return self.position + self.conf.BATCH_SIZE < len(self.permutation)
 
-    def load_batch(self, device):
+    # loading a batch takes two phases:
+    #   - gather(): copy the data of the batch out of the pool, which
+    #     must not run concurrently with add_game()
+    #   - assemble(): build the arrays of features, pi and z from the
+    #     gathered data, which is independent of the pool
+    # so that the expensive second phase can run in the background (see
+    # BatchLoader)
+
+    # gather the next batch of the shuffled permutation
+    def gather_next(self):
         indices = self.permutation[
-            self.position, self.position + self.conf.BATCH_SIZE]
-        features = torch.stack(
-            [torch.from_numpy(self.examples[i][0]) for i in indices]).to(device)
-        pi = torch.stack(
-            [torch.from_numpy(self.examples[i][1]) for i in indices]).to(device)
-        z = torch.stack(
-            [torch.from_numpy(self.examples[i][2]) for i in indices]).to(device)
+            self.position:self.position + self.conf.BATCH_SIZE]
         self.position += self.conf.BATCH_SIZE
+        return self.gather(indices)
+
+    # gather a batch drawn uniformly at random (with replacement)
+    # instead of traversing a shuffled permutation, used when examples
+    # keep arriving while training
+    def gather_random(self):
+        return self.gather(
+            np.random.randint(len(self), size=self.conf.BATCH_SIZE))
+
+    def load_batch(self, device):
+        return to_tensors(self.assemble(self.gather_next()), device)
+
+    def sample_batch(self, device):
+        return to_tensors(self.assemble(self.gather_random()), device)
+
+
+# the pool of self-play examples, implemented as a ring buffer of
+# fixed capacity
+# each example is stored as a record of a structured array:
+#   - features: all the feature planes packed into bits
+#   - pi: the distribution of action selection in float16
+#   - z: the game winner from the perspective of the player in int8
+# the array is allocated in memory, or memory mapped to a file if
+# mmap_file is specified
+class ExamplePool(_ExamplePoolBase):
+
+    def __init__(self, conf, storage=None, mmap_file=None):
+        super(ExamplePool, self).__init__(conf, storage)
+
+        # number of bytes of the packed feature planes
+        self._packed_size = (
+            conf.INPUT_CHANNELS * conf.BOARD_SIZE * conf.BOARD_SIZE + 7) // 8
+
+        self._dtype = np.dtype([
+            ('features', np.uint8, (self._packed_size,)),
+            ('pi', np.float16, (conf.NUM_ACTIONS,)),
+            ('z', np.int8),
+        ])
+
+        # the array that stores examples
+        if mmap_file is None:
+            self._data = np.zeros(self.capacity, dtype=self._dtype)
+        else:
+            self._data = np.memmap(
+                mmap_file, dtype=self._dtype, mode='w+',
+                shape=(self.capacity,))
+
+        # the examples are stored in
+        # _data[_head], _data[_head + 1], ..., _data[_head + _size - 1]
+        # where the indices are taken modulo capacity
+        self._head = 0
+        self._size = 0
+
+        # the lengths (i.e., number of examples) of the games in the
+        # pool, from the oldest to the newest
+        self.lengths = Queue(conf.EXAMPLE_POOL_SIZE)
+
+    def __len__(self):
+        return self._size
+
+    # number of bytes occupied by the examples
+    def nbytes(self):
+        return self._size * self._dtype.itemsize
+
+    # generate the examples of a game and pack them into records
+    def prepare(self, record):
+        n = len(record)
+        examples = record.examples(self.conf)
+        records = np.zeros(n, dtype=self._dtype)
+        records['features'] = np.packbits(
+            np.array([e[0] for e in examples]).reshape(n, -1) > 0.5, axis=1)
+        records['pi'] = np.array([e[1] for e in examples])
+        records['z'] = np.array([e[2][0] for e in examples])
+        return records
+
+    def _append(self, record, records=None):
+        n = len(record)
+        if records is None:
+            records = self.prepare(record)
+
+        # write the records to the tail, wrapping around if necessary
+        tail = (self._head + self._size) % self.capacity
+        m = min(n, self.capacity - tail)
+        self._data[tail:tail + m] = records[:m]
+        self._data[:n - m] = records[m:]
+
+        self._size += n
+        self.lengths.enqueue(n)
+
+    def _discard_oldest_game(self):
+        n = self.lengths.dequeue()
+        self._head = (self._head + n) % self.capacity
+        self._size -= n
+
+    # gather the examples with the given indices (0 for the oldest
+    # example)
+    def gather(self, indices):
+        return self._data[
+            (indices.astype(np.int64) + self._head) % self.capacity]
+
+    # unpack the gathered examples
+    def assemble(self, records):
+        features = np.unpackbits(
+            records['features'], axis=1,
+            count=self.conf.INPUT_CHANNELS * self.conf.BOARD_SIZE ** 2)
+        features = features.reshape(
+            len(records), self.conf.INPUT_CHANNELS,
+            self.conf.BOARD_SIZE, self.conf.BOARD_SIZE).astype(np.float32)
+        pi = records['pi'].astype(np.float32)
+        z = records['z'].astype(np.float32).reshape(len(records), 1)
         return features, pi, z
+
+
+# the pool of self-play games stored as move records (see GameRecord)
+# the examples are regenerated by replaying the games when a batch is
+# drawn, and a random dihedral transformation is applied to each of
+# them, which takes a small fraction of the memory of ExamplePool and
+# augments the examples 8 times
+class MoveRecordPool(_ExamplePoolBase):
+
+    def __init__(self, conf, storage=None):
+        super(MoveRecordPool, self).__init__(conf, storage)
+
+        # the games in the pool, from the oldest to the newest
+        self.records = Queue(conf.EXAMPLE_POOL_SIZE)
+
+        # total number of examples in the pool
+        self._size = 0
+
+        # _offsets[i] is the total length of the games before the ith
+        # game, calculated when shuffling
+        self._offsets = None
+
+    def __len__(self):
+        return self._size
+
+    # number of bytes occupied by the games
+    def nbytes(self):
+        return sum(r.actions.nbytes + r.pi_offsets.nbytes +
+                   r.pi_actions.nbytes + r.pi_probs.nbytes
+                   for r in self.records)
+
+    def _append(self, record, prepared=None):
+        self.records.enqueue(record)
+        self._size += len(record)
+
+    def _discard_oldest_game(self):
+        self._size -= len(self.records.dequeue())
+
+    def shuffle(self, rank=0, world_size=1, seed=None):
+        self._offsets = np.cumsum([0] + [len(r) for r in self.records])
+        super(MoveRecordPool, self).shuffle(rank, world_size, seed)
+
+    # gather the games of the examples with the given indices (0 for
+    # the oldest example)
+    def gather(self, indices):
+        games = np.searchsorted(self._offsets, indices, side='right') - 1
+        return self._group(games, indices - self._offsets[games])
+
+    # a game is chosen uniformly at random and accepted with probability
+    # proportional to its length, so that every example is equally
+    # likely to be drawn
+    def gather_random(self):
+        games, times = [], []
+        while len(games) < self.conf.BATCH_SIZE:
+            i = np.random.randint(len(self.records))
+            n = len(self.records[i])
+            if np.random.rand() * self.conf.MAX_GAME_LENGTH < n:
+                games.append(i)
+                times.append(np.random.randint(n))
+        return self._group(np.array(games), np.array(times))
+
+    # group the examples at times[i] of the games[i]th game by game,
+    # and return a list of (record, times, indices in the batch)
+    def _group(self, games, times):
+        groups = []
+        order = np.lexsort((times, games))
+        begin = 0
+        while begin < len(order):
+            end = begin
+            while end < len(order) and games[order[end]] == games[order[begin]]:
+                end += 1
+            indices = order[begin:end]
+            groups.append(
+                (self.records[games[order[begin]]], times[indices], indices))
+            begin = end
+        return groups
+
+    # regenerate the gathered examples, each game is replayed only once
+    def assemble(self, groups):
+        n = sum(len(indices) for _, _, indices in groups)
+        features = np.zeros(
+            (n, self.conf.INPUT_CHANNELS,
+             self.conf.BOARD_SIZE, self.conf.BOARD_SIZE), dtype=np.float32)
+        pi = np.zeros((n, self.conf.NUM_ACTIONS), dtype=np.float32)
+        z = np.zeros((n, 1), dtype=np.float32)
+        for record, times, indices in groups:
+            examples = record.examples_at(times, self.conf)
+            for i, example in zip(indices, examples):
+                features[i], pi[i], z[i] = augment(example, self.conf)
+        return features, pi, z
+
+
+# apply a random dihedral transformation to an example
+def augment(example, conf):
+    features, pi, z = example
+    trans = np.random.randint(8)
+    features = dihedral_trans(features, trans, axes=(1, 2))
+    pi_move = dihedral_trans(
+        np.reshape(pi[:conf.BOARD_SIZE ** 2],
+                   (conf.BOARD_SIZE, conf.BOARD_SIZE)),
+        trans, axes=(0, 1))
+    pi = np.append(np.reshape(pi_move, conf.BOARD_SIZE ** 2), pi[conf.PASS])
+    return features, pi, z
+
+
+# convert the arrays of a batch into tensors on device
+def to_tensors(arrays, device):
+    return tuple(torch.from_numpy(x).to(device) for x in arrays)
+
+
+# create an example pool for the model in model_dir according to
+# EXAMPLE_STORE, whose games are stored in <model_dir>/games
+# an array store is memory mapped to <model_dir>/example_pool.dat if
+# EXAMPLE_POOL_MMAP is set (<model_dir>/example_pool_<rank>.dat for the
+# replicas of the other ranks in the distributed mode)
+def create_example_pool(conf, model_dir, rank=0):
+    storage = GameStorage('{}/games'.format(model_dir))
+    if conf.EXAMPLE_STORE == 'move_record':
+        return MoveRecordPool(conf, storage=storage)
+    elif conf.EXAMPLE_POOL_MMAP:
+        mmap_file = '{}/example_pool.dat'.format(model_dir) if rank == 0 \
+            else '{}/example_pool_{}.dat'.format(model_dir, rank)
+        return ExamplePool(conf, storage=storage, mmap_file=mmap_file)
+    else:
+        return ExamplePool(conf, storage=storage)
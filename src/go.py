@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import struct
+
 from data_structure import BitSet, Queue, SmallSet
 
 # color of intersection
@@ -37,6 +39,34 @@ UNDECIDED = 0
 # the four directions: left, up, right, down
 _directions = ((1, 0), (0, 1), (-1, 0), (0, -1))
 
+# the binary encoding of a board (see Board.to_bytes()) packs the colors
+# of 4 intersections into a byte, 2 bits each: 0 for EMPTY, 1 for BLACK
+# and 3 for WHITE (i.e., color & 3)
+# _unpack[b] is the colors of the 4 intersections packed into byte b,
+# and _pack is its inverse
+_unpack = tuple(
+    tuple((EMPTY, BLACK, EMPTY, WHITE)[(b >> (2 * i)) & 3] for i in range(4))
+    for b in range(256))
+_pack = {colors: b for b, colors in enumerate(_unpack)
+         if all(((b >> (2 * i)) & 3) != 2 for i in range(4))}
+
+# the header of the binary encoding of a game (see Go.to_bytes()): turn,
+# komi, the intersection of the last move (-1 if none) and the number of
+# stones it captured
+_go_header = struct.Struct('<bdhH')
+
+# _neighbor_table[board_size][z] is the intersections adjacent to z
+_neighbor_table = {}
+
+
+def _neighbors(board_size):
+    if board_size not in _neighbor_table:
+        _neighbor_table[board_size] = tuple(
+            tuple((x + dx) * board_size + y + dy for dx, dy in _directions
+                  if 0 <= x + dx < board_size and 0 <= y + dy < board_size)
+            for x in range(board_size) for y in range(board_size))
+    return _neighbor_table[board_size]
+
 
 # a class of the Go board, maintaining the information of stone chains
 # and empty intersection chains
@@ -93,6 +123,67 @@ class Board:
             self._liberties = [None if x is None else BitSet(copy=x) for x in
                                copy._liberties]
 
+    # pickle the board in the binary encoding (see to_bytes()) instead of
+    # the lists and the BitSets of the chains
+    def __reduce__(self):
+        return type(self).from_bytes, (self.to_bytes(),)
+
+    # encode the board into bytes: the board size followed by the packed
+    # colors of the intersections (see _pack), the chains and the
+    # liberties are rebuilt from the colors when decoded
+    def to_bytes(self):
+        n = self.board_size * self.board_size
+        colors = iter(self._color + [EMPTY] * (-n % 4))
+        return bytes((self.board_size,)) + bytes(
+            _pack[c] for c in zip(colors, colors, colors, colors))
+
+    # the inverse of to_bytes()
+    @classmethod
+    def from_bytes(cls, data):
+        board_size = data[0]
+        n = board_size * board_size
+        if len(data) != 1 + (n + 3) // 4:
+            raise ValueError('invalid encoding of a board')
+        board = cls.__new__(cls)
+        board.board_size = board_size
+        board._color = [c for b in data[1:] for c in _unpack[b]][:n]
+        board._rebuild()
+        return board
+
+    # rebuild the stone chains and their liberties from _color, and
+    # reset each empty intersection to a chain of its own
+    def _rebuild(self):
+        n = self.board_size * self.board_size
+        neighbors = _neighbors(self.board_size)
+        color = self._color
+        parent = list(range(n))
+        chain_size = [1] * n
+        liberties = [None] * n
+        visited = bytearray(n)
+        for z in range(n):
+            c = color[z]
+            if c == EMPTY or visited[z]:
+                continue
+            # flood fill the chain of z, which becomes its representative
+            # (the loop also visits the stones appended to the chain)
+            chain = [z]
+            visited[z] = 1
+            chain_liberties = []
+            for v in chain:
+                parent[v] = z
+                for w in neighbors[v]:
+                    if color[w] == EMPTY:
+                        chain_liberties.append(w)
+                    elif color[w] == c and not visited[w]:
+                        visited[w] = 1
+                        chain.append(w)
+            chain_size[z] = len(chain)
+            liberties[z] = BitSet(n)
+            liberties[z].update(chain_liberties)
+        self._parent = parent
+        self._chain_size = chain_size
+        self._liberties = liberties
+
     # return the color of (x, y)
     def color(self, x, y):
         return self._color[x * self.board_size + y]
@@ -214,21 +305,25 @@ class Board:
                 q = Queue(n)
                 q.enqueue((x, y))
                 visited.add(z)
+                # notice that x and y of the outer loops must not be
+                # overwritten here
                 while not q.is_empty():
-                    x, y = q.dequeue()
+                    x_, y_ = q.dequeue()
                     for dx, dy in _directions:
-                        if self.on_board(x + dx, y + dy):
-                            if self.color(x + dx, y + dy) == BLACK:
-                                adjacent_chains.add(self.find(x + dx, y + dy))
+                        if self.on_board(x_ + dx, y_ + dy):
+                            z_ = (x_ + dx) * self.board_size + y_ + dy
+                            if self._color[z_] == BLACK:
+                                adjacent_chains.add(
+                                    self.find(x_ + dx, y_ + dy))
                                 adjacent_to_black = True
-                            elif self.color(x + dx, y + dy) == WHITE:
-                                adjacent_chains.add(self.find(x + dx, y + dy))
+                            elif self._color[z_] == WHITE:
+                                adjacent_chains.add(
+                                    self.find(x_ + dx, y_ + dy))
                                 adjacent_to_white = True
-                            elif not visited.contains(
-                                    (x + dx) * self.board_size + y + dy):
-                                q.enqueue((x + dx, y + dy))
-                                visited.add((x + dx) * self.board_size + y + dy)
-                    self._parent[x * self.board_size + y] = z
+                            elif not visited.contains(z_):
+                                q.enqueue((x_ + dx, y_ + dy))
+                                visited.add(z_)
+                    self._parent[x_ * self.board_size + y_] = z
                     self._chain_size[z] += 1
 
                 if (adjacent_to_black and adjacent_to_white) \
@@ -247,6 +342,104 @@ class Board:
 
         return ownership
 
+    # Benson's algorithm of unconditional life
+    # a region of color is a maximal connected set of intersections not
+    # occupied by color, and it is vital to a chain of color if all its
+    # empty intersections are liberties of the chain
+    # starting from all the chains of color and all the regions of color
+    # enclosed by them, the algorithm repeatedly removes the chains with
+    # less than two vital regions among the remaining regions, and the
+    # regions adjacent to any removed chain, until nothing is removed
+    # the remaining chains are pass-alive, i.e., they can never be
+    # captured even if color always passes
+    # return the representatives of the pass-alive chains, and the
+    # regions (as lists of intersections) enclosed by them in which the
+    # opponent can never live, i.e., every empty intersection of the
+    # region is a liberty of the pass-alive chains, so that the opponent
+    # can never make an eye there
+    def pass_alive(self, color):
+        n = self.board_size * self.board_size
+
+        # find all the regions, and for each region its intersections,
+        # its empty intersections and the chains adjacent to it
+        region = [-1] * n
+        regions = []
+        for z in range(n):
+            if self._color[z] == color or region[z] >= 0:
+                continue
+            r = len(regions)
+            points, empty_points, chains = [z], [], set()
+            region[z] = r
+            i = 0
+            while i < len(points):
+                x, y = divmod(points[i], self.board_size)
+                if self._color[points[i]] == EMPTY:
+                    empty_points.append(points[i])
+                i += 1
+                for dx, dy in _directions:
+                    if self.on_board(x + dx, y + dy):
+                        z_ = (x + dx) * self.board_size + y + dy
+                        if self._color[z_] == color:
+                            chains.add(self.find(x + dx, y + dy))
+                        elif region[z_] < 0:
+                            region[z_] = r
+                            points.append(z_)
+            regions.append((points, empty_points, chains))
+
+        # the chains each region is vital to
+        vital = [{c for c in chains
+                  if all(self._liberties[c].contains(z) for z in empty_points)}
+                 for _, empty_points, chains in regions]
+
+        # whether each region is still enclosed by the remaining chains
+        # notice that a region adjacent to no chain (i.e., color has no
+        # stone on the board) is not enclosed
+        enclosed = [len(chains) > 0 for _, _, chains in regions]
+
+        alive = {self.find(z // self.board_size, z % self.board_size)
+                 for z in range(n) if self._color[z] == color}
+        while True:
+            num_vital_regions = dict.fromkeys(alive, 0)
+            for r in range(len(regions)):
+                if enclosed[r]:
+                    for c in vital[r]:
+                        num_vital_regions[c] += 1
+            dead = {c for c in alive if num_vital_regions[c] < 2}
+            if len(dead) == 0:
+                break
+            alive -= dead
+            for r in range(len(regions)):
+                if enclosed[r] and not regions[r][2] <= alive:
+                    enclosed[r] = False
+
+        territory = []
+        for r in range(len(regions)):
+            points, empty_points, chains = regions[r]
+            if enclosed[r] and all(
+                    any(self._liberties[c].contains(z) for c in chains)
+                    for z in empty_points):
+                territory.append(points)
+        return alive, territory
+
+    # return a list owner where owner[z] is BLACK (WHITE) if the
+    # intersection z unconditionally belongs to black (white), i.e., it
+    # is a stone of a pass-alive chain or in a region where the opponent
+    # can never live (see pass_alive()), and EMPTY otherwise
+    def unconditional_ownership(self):
+        n = self.board_size * self.board_size
+        owner = [EMPTY] * n
+        for color in (BLACK, WHITE):
+            alive, territory = self.pass_alive(color)
+            points = [z for z in range(n) if self._color[z] == color and
+                      self.find(z // self.board_size, z % self.board_size)
+                      in alive]
+            points += [z for points_ in territory for z in points_]
+            for z in points:
+                # never happens in theory, but an intersection claimed
+                # by both players is left undecided to be safe
+                owner[z] = color if owner[z] == EMPTY else _GRAY
+        return [EMPTY if x == _GRAY else x for x in owner]
+
     # place a stone on (x, y) with specified color
     # assuming (x, y) is an empty intersection
     def place(self, x, y, color):
@@ -343,6 +536,37 @@ class Go:
             self.previous_y = copy.previous_y
             self.previous_captured_size = copy.previous_captured_size
 
+    # pickle the game in the binary encoding (see to_bytes())
+    def __reduce__(self):
+        return type(self).from_bytes, (self.to_bytes(),)
+
+    # encode the game into bytes: the turn, the komi and the ko state
+    # (see _go_header) followed by the encoding of the board (see
+    # Board.to_bytes())
+    def to_bytes(self):
+        previous = -1 if self.previous_x < 0 \
+            else self.previous_x * self.board.board_size + self.previous_y
+        return _go_header.pack(
+            self.turn, self.komi, previous, self.previous_captured_size) \
+            + self.board.to_bytes()
+
+    # the inverse of to_bytes()
+    @classmethod
+    def from_bytes(cls, data):
+        turn, komi, previous, previous_captured_size = \
+            _go_header.unpack_from(data)
+        go = cls.__new__(cls)
+        go.board = Board.from_bytes(data[_go_header.size:])
+        go.komi = komi
+        go.turn = turn
+        if previous < 0:
+            go.previous_x, go.previous_y = -1, -1
+        else:
+            go.previous_x, go.previous_y = \
+                divmod(previous, go.board.board_size)
+        go.previous_captured_size = previous_captured_size
+        return go
+
     # determine opponent's stone chains that will be captured if
     # placing a stone on (x, y)
     # assuming (x, y) is an empty intersection on the board, and
@@ -369,6 +593,27 @@ class Go:
                 return False
         return True
 
+    # determine if placing a stone on (x, y) fills an own eye, i.e., all
+    # the intersections adjacent to (x, y) are own stones of the same
+    # chain, so that (x, y) alone would be a BLACK_EYE (WHITE_EYE) of
+    # update_empty_intersection()
+    # such a play never captures anything and never helps in area
+    # scoring, it only takes a liberty (and maybe an eye) from the chain
+    # assuming (x, y) is an empty intersection on the board
+    def fills_own_eye(self, x, y):
+        b = self.board
+        chain = None
+        for dx, dy in _directions:
+            if b.on_board(x + dx, y + dy):
+                if b.color(x + dx, y + dy) != self.turn:
+                    return False
+                c = b.find(x + dx, y + dy)
+                if chain is None:
+                    chain = c
+                elif c != chain:
+                    return False
+        return True
+
     # determine if placing a stone on (x, y) is a legal play
     def legal_play(self, x, y, ignore_ko=False):
         b = self.board
@@ -425,6 +670,25 @@ class Go:
             komi = self.komi
         return self.board.score(komi)
 
+    # return the winner (BLACK or WHITE) if it is already decided by the
+    # intersections that unconditionally belong to the players (see
+    # Board.unconditional_ownership()), i.e., the winner still wins even
+    # if all the other intersections went to the loser, otherwise return
+    # EMPTY
+    # as in score(), black wins only if its score is strictly higher
+    def decided_winner(self, komi=None):
+        if komi is None:
+            komi = self.komi
+        owner = self.board.unconditional_ownership()
+        black, white = owner.count(BLACK), owner.count(WHITE)
+        undecided = len(owner) - black - white
+        if black > white + komi + undecided:
+            return BLACK
+        elif white + komi >= black + undecided:
+            return WHITE
+        else:
+            return EMPTY
+
     # NOTICE: The functions below are about ladder capture and they
     # are quite compute-intensive. Ladder capture information are
     # important features in AlphaGo but they are no longer used in
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+import glog as log
+import numpy as np
+import torch
+
+from evaluate import DefaultEvaluator
+from go import BLACK, EMPTY, WHITE, Go
+from mcts import TreeNode, advance, search_for
+from network import ZetaGoNetwork
+from root_parallel import RootParallelSearch
+
+# An engine that speaks the Go Text Protocol (GTP) version 2 over stdin
+# and stdout, so that ZetaGo can play in tournament managers (e.g.,
+# gogui-twogtp) against other engines.
+# Only the responses are written to stdout, the logs go to stderr.
+# The search tree is kept between the commands, and the subtree of the
+# current position is reused by the next search.
+# With time settings, the search of every move goes on until a budget of
+# seconds derived from the remaining time is used up (see
+# GTPEngine._budget()), otherwise it performs num_simulations
+# simulations.
+
+_NAME = 'ZetaGo'
+_VERSION = '0.1'
+
+# the column letters of the vertices, notice that I is skipped
+_COLUMNS = 'ABCDEFGHJKLMNOPQRSTUVWXYZ'
+
+# the computer resigns if the value of its best move is below this
+_RESIGN_VALUE = -0.95
+
+# with main time, the remaining time is spread over at least this
+# number of moves
+_MIN_MOVES_LEFT = 10
+
+# seconds kept for the communication with the controller
+_SAFETY_MARGIN = 0.2
+
+# the minimal budget of a move in seconds
+_MIN_BUDGET = 0.05
+
+
+class GTPError(Exception):
+    pass
+
+
+# convert a vertex (e.g., "D4" or "pass") to an action
+def parse_vertex(vertex, conf):
+    vertex = vertex.upper()
+    if vertex == 'PASS':
+        return conf.PASS
+    x = _COLUMNS.find(vertex[:1])
+    y = conf.BOARD_SIZE - int(vertex[1:]) if vertex[1:].isdigit() else -1
+    if not (0 <= x < conf.BOARD_SIZE and 0 <= y < conf.BOARD_SIZE):
+        raise ValueError('invalid vertex')
+    return x * conf.BOARD_SIZE + y
+
+
+# convert an action to a vertex
+def format_vertex(action, conf):
+    if action == conf.PASS:
+        return 'pass'
+    x, y = divmod(action, conf.BOARD_SIZE)
+    return '{}{}'.format(_COLUMNS[x], conf.BOARD_SIZE - y)
+
+
+class GTPEngine:
+
+    def __init__(self, network, conf, device, num_simulations=None,
+                 num_processes=1):
+        self.conf = conf
+        self.num_simulations = conf.NUM_SIMULATIONS \
+            if num_simulations is None else num_simulations
+        self.evaluator = DefaultEvaluator(network, device)
+        self.parallel_search = RootParallelSearch(
+            network, conf, device, num_processes) \
+            if num_processes > 1 else None
+
+        # main time, byo-yomi time and byo-yomi stones (see
+        # time_settings), None if there is no time limit
+        self.time_settings = None
+
+        # the remaining time of the current period and the remaining
+        # stones of it (0 in main time) of each color, which are updated
+        # by the controller with time_left, and by the engine itself
+        # after every move it generates
+        self.clocks = {}
+
+        self.komi = conf.KOMI
+        self._new_game()
+
+        self.commands = {
+            'protocol_version': self.protocol_version,
+            'name': self.name,
+            'version': self.version,
+            'known_command': self.known_command,
+            'list_commands': self.list_commands,
+            'quit': self.quit,
+            'boardsize': self.boardsize,
+            'clear_board': self.clear_board,
+            'komi': self.set_komi,
+            'play': self.play,
+            'genmove': self.genmove,
+            'undo': self.undo,
+            'showboard': self.showboard,
+            'final_score': self.final_score,
+            'time_settings': self.set_time_settings,
+            'time_left': self.set_time_left,
+        }
+        self.running = True
+
+    def _new_game(self, actions=()):
+        self.root = TreeNode(None, None, None, self.conf)
+        self.root.go.komi = self.komi
+        self.actions = []
+        for action in actions:
+            self._take(action)
+
+    # take action at the current position, reusing the subtree
+    def _take(self, action):
+        self.root = advance(self.root, action, self.conf)
+        self.actions.append(action)
+
+    # parse a command line, and return the response without the
+    # trailing empty line
+    def handle(self, line):
+        line = line.split('#')[0].strip()
+        if line == '':
+            return None
+        words = line.split()
+        command_id = ''
+        if words[0].isdigit():
+            command_id = words[0]
+            words = words[1:]
+        if len(words) == 0:
+            return None
+        command, args = words[0], words[1:]
+        if command not in self.commands:
+            return '?{} unknown command'.format(command_id)
+        try:
+            result = self.commands[command](*args)
+        except (GTPError, TypeError, ValueError) as e:
+            return '?{} {}'.format(command_id, e)
+        return '={} {}'.format(command_id, '' if result is None else result)
+
+    def run(self, input=sys.stdin, output=sys.stdout):
+        for line in input:
+            response = self.handle(line)
+            if response is None:
+                continue
+            output.write(response.rstrip(' ') + '\n\n')
+            output.flush()
+            if not self.running:
+                break
+        if self.parallel_search is not None:
+            self.parallel_search.close()
+
+    # ---- conversions between vertices and actions ----
+
+    def _action(self, vertex):
+        return parse_vertex(vertex, self.conf)
+
+    def _vertex(self, action):
+        return format_vertex(action, self.conf)
+
+    @staticmethod
+    def _color(color):
+        color = color.lower()
+        if color in ('b', 'black'):
+            return BLACK
+        elif color in ('w', 'white'):
+            return WHITE
+        raise GTPError('invalid color')
+
+    # ---- administrative commands ----
+
+    def protocol_version(self):
+        return '2'
+
+    def name(self):
+        return _NAME
+
+    def version(self):
+        return _VERSION
+
+    def known_command(self, command):
+        return 'true' if command in self.commands else 'false'
+
+    def list_commands(self):
+        return '\n'.join(sorted(self.commands))
+
+    def quit(self):
+        self.running = False
+
+    # ---- setup commands ----
+
+    # the network only supports the board size of its configuration
+    def boardsize(self, size):
+        if int(size) != self.conf.BOARD_SIZE:
+            raise GTPError('unacceptable size')
+        self._new_game()
+
+    def clear_board(self):
+        self._new_game()
+
+    def set_komi(self, komi):
+        self.komi = float(komi)
+        self.root.go.komi = self.komi
+
+    # ---- core play commands ----
+
+    # play a move of the given color, a pass is inserted if it is not
+    # the turn of that color
+    def play(self, color, vertex):
+        color = self._color(color)
+        action = self._action(vertex)
+        if action != self.conf.PASS:
+            go = self.root.go
+            if color != go.turn:
+                go = Go(copy=go)
+                go.pass_()
+            x, y = divmod(action, self.conf.BOARD_SIZE)
+            if not go.legal_play(x, y):
+                raise GTPError('illegal move')
+        if color != self.root.go.turn:
+            self._take(self.conf.PASS)
+        self._take(action)
+
+    def genmove(self, color):
+        color = self._color(color)
+        if color != self.root.go.turn:
+            self._take(self.conf.PASS)
+
+        start = time.time()
+        # with time settings, search until the budget is used up
+        seconds = self._budget(color)
+        num_simulations = self.num_simulations if seconds is None else None
+        if self.parallel_search is None:
+            simulations = search_for(self.root, self.evaluator, self.conf,
+                                     num_simulations, seconds)
+            n, w = self.root.n, self.root.w
+        else:
+            n, w = self.parallel_search.search(
+                self.actions, num_simulations, seconds)
+            simulations = self.parallel_search.simulations
+        elapsed = time.time() - start
+        self._spend(color, elapsed)
+        log.info('{} simulations in {:.2f}s ({:.1f} simulations/s)'.format(
+            simulations, elapsed, simulations / max(elapsed, 1e-6)))
+
+        action = int(np.argmax(n))
+        if n[action] > 0 and w[action] / n[action] < _RESIGN_VALUE:
+            return 'resign'
+        self._take(action)
+        return self._vertex(action)
+
+    def undo(self):
+        if len(self.actions) == 0:
+            raise GTPError('cannot undo')
+        self._new_game(self.actions[:-1])
+
+    # ---- tournament commands ----
+
+    def final_score(self):
+        black_score, white_score = self.root.go.score(self.komi)
+        if black_score > white_score:
+            return 'B+{}'.format(black_score - white_score)
+        elif white_score > black_score:
+            return 'W+{}'.format(white_score - black_score)
+        else:
+            return '0'
+
+    # ---- time control commands ----
+
+    def set_time_settings(self, main_time, byo_yomi_time, byo_yomi_stones):
+        main_time = float(main_time)
+        byo_yomi_time = float(byo_yomi_time)
+        byo_yomi_stones = int(byo_yomi_stones)
+        self.clocks = {}
+        if byo_yomi_time > 0 and byo_yomi_stones == 0:
+            # no time limit
+            self.time_settings = None
+            return
+        self.time_settings = (main_time, byo_yomi_time, byo_yomi_stones)
+        for color in (BLACK, WHITE):
+            if main_time > 0:
+                self.clocks[color] = (main_time, 0)
+            else:
+                self.clocks[color] = (byo_yomi_time, byo_yomi_stones)
+
+    def set_time_left(self, color, time_left, stones_left):
+        self.clocks[self._color(color)] = (float(time_left), int(stones_left))
+
+    # the seconds to search for the next move, or None if there is no
+    # time limit
+    #   - in byo-yomi, the remaining time of the period is spread evenly
+    #     over its remaining stones
+    #   - in main time, the remaining time is spread over the expected
+    #     number of remaining moves (half of the empty intersections),
+    #     plus the time of a byo-yomi stone if any
+    def _budget(self, color):
+        if self.time_settings is None or color not in self.clocks:
+            return None
+        _, byo_yomi_time, byo_yomi_stones = self.time_settings
+        time_left, stones_left = self.clocks[color]
+        if stones_left > 0:
+            budget = time_left / stones_left
+        else:
+            empty = sum(
+                1 for x in range(self.conf.BOARD_SIZE)
+                for y in range(self.conf.BOARD_SIZE)
+                if self.root.go.board.color(x, y) == EMPTY)
+            budget = time_left / max(empty // 2, _MIN_MOVES_LEFT)
+            if byo_yomi_stones > 0:
+                budget += byo_yomi_time / byo_yomi_stones
+        return max(budget - _SAFETY_MARGIN, _MIN_BUDGET)
+
+    # update the remaining time of color after a move
+    def _spend(self, color, elapsed):
+        if self.time_settings is None or color not in self.clocks:
+            return
+        _, byo_yomi_time, byo_yomi_stones = self.time_settings
+        time_left, stones_left = self.clocks[color]
+        time_left -= elapsed
+        if stones_left > 0:
+            stones_left -= 1
+            if stones_left == 0:
+                # a new byo-yomi period
+                time_left, stones_left = byo_yomi_time, byo_yomi_stones
+        elif time_left <= 0 and byo_yomi_stones > 0:
+            # the main time runs out
+            time_left, stones_left = byo_yomi_time, byo_yomi_stones
+        self.clocks[color] = (time_left, stones_left)
+
+    def showboard(self):
+        size = self.conf.BOARD_SIZE
+        symbols = {BLACK: 'X', WHITE: 'O', EMPTY: '.'}
+        lines = ['   ' + ' '.join(_COLUMNS[:size])]
+        for y in range(size):
+            lines.append('{:>2} '.format(size - y) + ' '.join(
+                symbols[self.root.go.board.color(x, y)] for x in range(size)))
+        return '\n' + '\n'.join(lines)
+
+
+# run the GTP engine with the model in model_file
+def run_gtp(model_file, num_simulations=None, num_processes=1):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # model_file is trusted, and conf in it is not a tensor, so it cannot
+    # be loaded with weights_only
+    model = torch.load(model_file, map_location=device, weights_only=False)
+    conf = model['conf']
+
+    network = ZetaGoNetwork(conf)
+    network.load_state_dict(model['network'])
+    network.to(device)
+
+    GTPEngine(network, conf, device, num_simulations, num_processes).run()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+
+import torch
+
+# seconds between two checks of the stop signal when a worker is
+# blocked on a full queue
+_PUT_TIMEOUT = 0.1
+
+
+# a loader that prepares batches of the example pool in background
+# threads
+# each worker gathers a batch from the pool (holding the lock), then
+# assembles it into contiguous tensors (optionally in pinned memory)
+# and puts them into a bounded queue, so that there are always a few
+# batches ready when the optimizer asks for one
+# the pool must not be modified without holding the lock while the
+# loader is running
+class BatchLoader:
+
+    def __init__(self, example_pool, device, conf):
+        self.example_pool = example_pool
+        self.device = device
+        self.num_workers = conf.LOADER_WORKERS
+        self.prefetch = conf.LOADER_PREFETCH
+        self.pin_memory = conf.LOADER_PIN_MEMORY and device.type == 'cuda'
+
+        # the lock protecting the example pool
+        self.lock = threading.Lock()
+
+        # total time (in seconds) spent waiting for batches
+        self.wait_time = 0.0
+
+    # traverse the shuffled example pool once (see ExamplePool.shuffle())
+    def epoch(self):
+        return self._run(random=False)
+
+    # keep drawing batches uniformly at random from the example pool
+    def forever(self):
+        return self._run(random=True)
+
+    def _run(self, random):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        workers = [threading.Thread(
+            target=self._work, args=(random, batches, stop_event),
+            daemon=True) for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            finished = 0
+            while finished < self.num_workers:
+                start = time.time()
+                batch = batches.get()
+                self.wait_time += time.time() - start
+
+                if batch is None:
+                    # the worker has finished
+                    finished += 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    yield tuple(x.to(self.device, non_blocking=True)
+                                for x in batch)
+        finally:
+            # unblock the workers and wait for them to exit
+            stop_event.set()
+            for worker in workers:
+                worker.join()
+
+    def _work(self, random, batches, stop_event):
+        pool = self.example_pool
+        try:
+            while not stop_event.is_set():
+                with self.lock:
+                    if random:
+                        data = pool.gather_random()
+                    elif pool.has_batch():
+                        data = pool.gather_next()
+                    else:
+                        break
+                batch = tuple(
+                    torch.from_numpy(x) for x in pool.assemble(data))
+                if self.pin_memory:
+                    batch = tuple(x.pin_memory() for x in batch)
+                self._put(batch, batches, stop_event)
+            self._put(None, batches, stop_event)
+        except Exception as e:
+            self._put(e, batches, stop_event)
+
+    def _put(self, item, batches, stop_event):
+        while not stop_event.is_set():
+            try:
+                batches.put(item, timeout=_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
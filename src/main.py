@@ -5,10 +5,37 @@ from datetime import datetime
 from glob import glob
 import os
 import sys
+import time
 
-from config import CONFIGURATIONS
+import torch
+
+from analyze import run_analyze
+import benchmark
+from config import CONFIGURATIONS, get_conf
+from gtp import run_gtp
+import perft
+from pipeline import train_pipeline
 from play import play_against_human
-from train import train
+from profiling import profile_self_play
+import sgf
+from storage import GameStorage
+from train import train, train_distributed
+
+
+# whether the process is started by a launcher of distributed training
+# like torchrun, in which case all the ranks share the model directory
+def distributed_launched():
+    return 'RANK' in os.environ
+
+
+def check_processes(sub_args):
+    if sub_args.processes < 1:
+        print('illegal number of processes: {}'.format(sub_args.processes))
+        exit(-1)
+    if sub_args.pipeline and \
+            (sub_args.processes > 1 or distributed_launched()):
+        print('distributed training is not supported in the pipeline mode')
+        exit(-1)
 
 
 def process_train():
@@ -17,6 +44,11 @@ def process_train():
         usage=(
             'python {0} train [--model_name MODEL_NAME] [--config CONFIG]\n' +
             '       ' +
+            '                 [--pipeline] [--producers PRODUCERS]\n' +
+            '       ' +
+            '                 [--processes PROCESSES] ' +
+            '[--import_dir IMPORT_DIR]\n' +
+            '       ' +
             'python {0} train [-h]\n'
         ).format(sys.argv[0])
     )
@@ -33,22 +65,61 @@ def process_train():
         help='the configuration for the training, ' +
              'must be one of the configurations defined in config.py ' +
              '(default: "19x19")')
+    sub_parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='run self-play, optimization and evaluation ' +
+             'asynchronously in separate processes')
+    sub_parser.add_argument(
+        '--producers',
+        type=int,
+        default=1,
+        help='the number of self-play processes in the pipeline mode ' +
+             '(default: 1)')
+    sub_parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='the number of local processes for distributed ' +
+             'data-parallel training (default: 1)')
+    sub_parser.add_argument(
+        '--import_dir',
+        type=str,
+        default='',
+        help='the game storage written by the import command, ' +
+             'whose latest games seed the example pool')
     sub_args = sub_parser.parse_args(sys.argv[2:])
+    check_processes(sub_args)
 
     if sub_args.config not in CONFIGURATIONS:
         print('configuration {} not found'.format(sub_args.config))
         exit(-1)
+    import_dir = None
+    if sub_args.import_dir != '':
+        import_dir = os.path.abspath(sub_args.import_dir)
+        if not os.path.isdir(import_dir):
+            print('directory {} not found'.format(import_dir))
+            exit(-1)
 
     model_name = datetime.now().strftime('%Y-%m-%d_%H%M%S') \
         if sub_args.model_name == '' else sub_args.model_name
     model_dir = os.path.abspath(os.path.join(
         os.getcwd(), '../models/{}'.format(model_name)))
-    if os.path.exists(model_dir):
+    if os.path.exists(model_dir) and not distributed_launched():
         print('directory {} already exists'.format(model_dir))
         exit(-1)
     os.makedirs(model_dir, exist_ok=True)
 
-    train(model_dir, sub_args.config)
+    if sub_args.pipeline:
+        train_pipeline(model_dir, sub_args.config,
+                       num_producers=sub_args.producers,
+                       import_dir=import_dir)
+    elif sub_args.processes > 1 or distributed_launched():
+        train_distributed(model_dir, sub_args.config,
+                          num_processes=sub_args.processes,
+                          import_dir=import_dir)
+    else:
+        train(model_dir, sub_args.config, import_dir=import_dir)
 
 
 def process_resume():
@@ -57,6 +128,10 @@ def process_resume():
         usage=(
             'python {0} resume <model_name> [--checkpoint CHECKPOINT]\n' +
             '       ' +
+            '                  [--pipeline] [--producers PRODUCERS]\n' +
+            '       ' +
+            '                  [--processes PROCESSES]\n' +
+            '       ' +
             'python {0} resume [-h]\n'
         ).format(sys.argv[0])
     )
@@ -70,7 +145,25 @@ def process_resume():
         default='',
         help='the name of the checkpoint file, ' +
              'will load the latest checkpoint if not specified')
+    sub_parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='run self-play, optimization and evaluation ' +
+             'asynchronously in separate processes')
+    sub_parser.add_argument(
+        '--producers',
+        type=int,
+        default=1,
+        help='the number of self-play processes in the pipeline mode ' +
+             '(default: 1)')
+    sub_parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='the number of local processes for distributed ' +
+             'data-parallel training (default: 1)')
     sub_args = sub_parser.parse_args(sys.argv[2:])
+    check_processes(sub_args)
 
     model_dir = os.path.abspath(os.path.join(
         os.getcwd(), '../models/{}'.format(sub_args.model_name)))
@@ -94,7 +187,14 @@ def process_resume():
             exit(-1)
 
     # resume training
-    train(model_dir, None, checkpoint_file=checkpoint_file)
+    if sub_args.pipeline:
+        train_pipeline(model_dir, None, checkpoint_file=checkpoint_file,
+                       num_producers=sub_args.producers)
+    elif sub_args.processes > 1 or distributed_launched():
+        train_distributed(model_dir, None, checkpoint_file=checkpoint_file,
+                          num_processes=sub_args.processes)
+    else:
+        train(model_dir, None, checkpoint_file=checkpoint_file)
 
 
 def process_play():
@@ -103,6 +203,8 @@ def process_play():
         usage=(
             'python {0} play <model_name> [--black_player BLACK_PLAYER]\n' +
             '       ' +
+            '                             [--processes PROCESSES]\n' +
+            '       ' +
             'python {0} play [-h]\n'
         ).format(sys.argv[0])
     )
@@ -116,6 +218,12 @@ def process_play():
         default='human',
         help='the player who plays black and moves first, ' +
              'should be one of human/computer (default: human)')
+    sub_parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='the number of local processes searching in parallel ' +
+             '(default: 1)')
     sub_args = sub_parser.parse_args(sys.argv[2:])
 
     model_file = os.path.abspath(os.path.join(
@@ -129,7 +237,465 @@ def process_play():
         print('illegal black_player, set it to human')
         sub_args.black_player = 'human'
 
-    play_against_human(model_file, sub_args.black_player)
+    if sub_args.processes < 1:
+        print('illegal number of processes: {}'.format(sub_args.processes))
+        exit(-1)
+
+    play_against_human(model_file, sub_args.black_player,
+                       num_processes=sub_args.processes)
+
+
+def process_gtp():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} gtp <model_name> [--simulations SIMULATIONS]\n' +
+            '       ' +
+            '                            [--processes PROCESSES]\n' +
+            '       ' +
+            'python {0} gtp [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        'model_name',
+        type=str,
+        help='the name of the model to play with')
+    sub_parser.add_argument(
+        '--simulations',
+        type=int,
+        default=0,
+        help='the number of simulations per move without time settings, ' +
+             'will use NUM_SIMULATIONS of the model if not specified')
+    sub_parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='the number of local processes searching in parallel ' +
+             '(default: 1)')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    model_file = os.path.abspath(os.path.join(
+        os.getcwd(), '../models/{}/model.pt'.format(sub_args.model_name)))
+    if not os.path.isfile(model_file):
+        print('model file {} not found'.format(model_file), file=sys.stderr)
+        exit(-1)
+
+    if sub_args.processes < 1:
+        print('illegal number of processes: {}'.format(sub_args.processes),
+              file=sys.stderr)
+        exit(-1)
+
+    run_gtp(model_file,
+            num_simulations=sub_args.simulations
+            if sub_args.simulations > 0 else None,
+            num_processes=sub_args.processes)
+
+
+def process_analyze():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} analyze <model_name> <input> [--output OUTPUT]\n' +
+            '       ' +
+            '                                        ' +
+            '[--simulations SIMULATIONS]\n' +
+            '       ' +
+            '                                        ' +
+            '[--concurrency CONCURRENCY]\n' +
+            '       ' +
+            'python {0} analyze [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        'model_name',
+        type=str,
+        help='the name of the model to analyze with')
+    sub_parser.add_argument(
+        'input',
+        type=str,
+        help='the file of the positions, one per line, ' +
+             'or "-" for the standard input')
+    sub_parser.add_argument(
+        '--output',
+        type=str,
+        default='-',
+        help='the file to write the results as JSON lines ' +
+             '(default: "-", the standard output)')
+    sub_parser.add_argument(
+        '--simulations',
+        type=int,
+        default=0,
+        help='the number of simulations of the search of every position, ' +
+             'will use the raw network evaluation if 0 (default: 0)')
+    sub_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=32,
+        help='the number of positions analyzed at the same time, ' +
+             'whose evaluations are batched (default: 32)')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    model_file = os.path.abspath(os.path.join(
+        os.getcwd(), '../models/{}/model.pt'.format(sub_args.model_name)))
+    if not os.path.isfile(model_file):
+        print('model file {} not found'.format(model_file), file=sys.stderr)
+        exit(-1)
+    if sub_args.input != '-' and not os.path.isfile(sub_args.input):
+        print('input file {} not found'.format(sub_args.input),
+              file=sys.stderr)
+        exit(-1)
+    if sub_args.simulations < 0 or sub_args.concurrency < 1:
+        print('illegal number of simulations or concurrency',
+              file=sys.stderr)
+        exit(-1)
+
+    run_analyze(model_file, sub_args.input, sub_args.output,
+                num_simulations=sub_args.simulations,
+                concurrency=sub_args.concurrency)
+
+
+def process_export():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} export <model_name> [--output OUTPUT]\n' +
+            '       ' +
+            '                                [--games GAMES]\n' +
+            '       ' +
+            'python {0} export [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        'model_name',
+        type=str,
+        help='the name of the model whose self-play games are exported')
+    sub_parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='the SGF file to write, ' +
+             'will use ../models/<model_name>/sgf/self_play.sgf ' +
+             'if not specified')
+    sub_parser.add_argument(
+        '--games',
+        type=int,
+        default=0,
+        help='the number of the latest games to export, ' +
+             'will export all the games if not specified')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    model_dir = os.path.abspath(os.path.join(
+        os.getcwd(), '../models/{}'.format(sub_args.model_name)))
+    if not os.path.isdir(model_dir):
+        print('directory {} not found'.format(model_dir))
+        exit(-1)
+
+    # the configuration is taken from the model, or from the latest
+    # checkpoint if the training is not finished
+    model_files = [f for f in ['{}/model.pt'.format(model_dir)]
+                   if os.path.isfile(f)]
+    if len(model_files) == 0:
+        model_files = sorted(
+            glob('{}/checkpoint_*.pt'.format(model_dir)),
+            key=os.path.getmtime)[-1:]
+    if len(model_files) == 0:
+        print('no model or checkpoint file found in {}'.format(model_dir))
+        exit(-1)
+    conf = torch.load(
+        model_files[0], map_location='cpu', weights_only=False)['conf']
+
+    output = sub_args.output
+    if output == '':
+        output = '{}/sgf/self_play.sgf'.format(model_dir)
+
+    storage = GameStorage('{}/games'.format(model_dir))
+    begin = 0 if sub_args.games <= 0 \
+        else max(len(storage) - sub_args.games, 0)
+    count = sgf.write_records(
+        (storage.read(game_id) for game_id in range(begin, len(storage))),
+        conf, output)
+    print('{} games exported to {}'.format(count, output))
+
+
+def process_import():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} import <sgf_file> [<sgf_file>]... ' +
+            '[--config CONFIG]\n' +
+            '       ' +
+            '                 [--output_dir OUTPUT_DIR] ' +
+            '[--processes PROCESSES]\n' +
+            '       ' +
+            'python {0} import [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        'sgf_files',
+        type=str,
+        nargs='+',
+        help='the SGF files to import, each one may contain many games')
+    sub_parser.add_argument(
+        '--config',
+        type=str,
+        default='19x19',
+        help='the configuration of the games, ' +
+             'the games of other board sizes are skipped ' +
+             '(default: "19x19")')
+    sub_parser.add_argument(
+        '--output_dir',
+        type=str,
+        default='',
+        help='the directory of the game storage to append the games to, ' +
+             'will use ../games/<timestamp> if not specified')
+    sub_parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='the number of processes replaying the games (default: 1)')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    if sub_args.config not in CONFIGURATIONS:
+        print('configuration {} not found'.format(sub_args.config))
+        exit(-1)
+    for path in sub_args.sgf_files:
+        if not os.path.isfile(path):
+            print('SGF file {} not found'.format(path))
+            exit(-1)
+    if sub_args.processes < 1:
+        print('illegal number of processes: {}'.format(sub_args.processes))
+        exit(-1)
+
+    output_dir = sub_args.output_dir
+    if output_dir == '':
+        output_dir = os.path.abspath(os.path.join(
+            os.getcwd(), '../games/{}'.format(
+                datetime.now().strftime('%Y-%m-%d_%H%M%S'))))
+
+    conf = get_conf(sub_args.config)
+    storage = GameStorage(output_dir)
+    num_games, num_moves = 0, 0
+    start = time.time()
+    for record in sgf.read_sgf_records(
+            sub_args.sgf_files, conf, sub_args.processes):
+        storage.append(record)
+        num_games += 1
+        num_moves += len(record)
+    elapsed = max(time.time() - start, 1e-6)
+    print('{} games ({} moves) imported to {}, '
+          '{:.1f} games/s, {:.1f} moves/s'.format(
+              num_games, num_moves, output_dir,
+              num_games / elapsed, num_moves / elapsed))
+    print('run "python {} train --import_dir {}" to train on them'.format(
+        sys.argv[0], output_dir))
+
+
+def process_profile():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} profile [--config CONFIG]\n' +
+            '       ' +
+            '                  [--model_name MODEL_NAME]\n' +
+            '       ' +
+            '                  [--games GAMES] [--moves MOVES]\n' +
+            '       ' +
+            '                  [--output_dir OUTPUT_DIR]\n' +
+            '       ' +
+            'python {0} profile [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        '--config',
+        type=str,
+        default='19x19',
+        help='the configuration of the randomly initialized network, ' +
+             'ignored if --model_name is specified (default: "19x19")')
+    sub_parser.add_argument(
+        '--model_name',
+        type=str,
+        default='',
+        help='the name of the model to profile, ' +
+             'will use a randomly initialized network if not specified')
+    sub_parser.add_argument(
+        '--games',
+        type=int,
+        default=1,
+        help='the number of self-play games (default: 1)')
+    sub_parser.add_argument(
+        '--moves',
+        type=int,
+        default=0,
+        help='stop every game after this number of moves, ' +
+             'will play full games if not specified')
+    sub_parser.add_argument(
+        '--output_dir',
+        type=str,
+        default='',
+        help='the directory to write the profiles, ' +
+             'will use ../profiles/<timestamp> if not specified')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    if sub_args.model_name == '':
+        if sub_args.config not in CONFIGURATIONS:
+            print('configuration {} not found'.format(sub_args.config))
+            exit(-1)
+        model_file = None
+    else:
+        model_file = os.path.abspath(os.path.join(
+            os.getcwd(),
+            '../models/{}/model.pt'.format(sub_args.model_name)))
+        if not os.path.isfile(model_file):
+            print('model file {} not found'.format(model_file))
+            exit(-1)
+
+    if sub_args.output_dir == '':
+        output_dir = os.path.abspath(os.path.join(
+            os.getcwd(), '../profiles/{}'.format(
+                datetime.now().strftime('%Y-%m-%d_%H%M%S'))))
+    else:
+        output_dir = os.path.abspath(sub_args.output_dir)
+
+    summary_path = profile_self_play(
+        output_dir, sub_args.config, model_file=model_file,
+        num_games=sub_args.games,
+        num_moves=sub_args.moves if sub_args.moves > 0 else None)
+    with open(summary_path) as f:
+        print(f.read())
+
+
+def process_benchmark():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} benchmark [--config CONFIG] [--games GAMES]\n' +
+            '       ' +
+            '                    [--output OUTPUT] [--baseline BASELINE]\n' +
+            '       ' +
+            '                    [--tolerance TOLERANCE]\n' +
+            '       ' +
+            'python {0} benchmark [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        '--config',
+        type=str,
+        default='9x9',
+        help='the configuration to benchmark, ' +
+             'must be one of the configurations defined in config.py ' +
+             '(default: "9x9")')
+    sub_parser.add_argument(
+        '--games',
+        type=int,
+        default=1,
+        help='the number of 9x9 self-play games, ' +
+             'set to 0 to skip the self-play benchmark (default: 1)')
+    sub_parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='the file to write the results, ' +
+             'will use ../benchmarks/<timestamp>.json if not specified')
+    sub_parser.add_argument(
+        '--baseline',
+        type=str,
+        default='',
+        help='the results of a previous run to compare with')
+    sub_parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1,
+        help='the relative slowdown (compared with the baseline) ' +
+             'regarded as a regression (default: 0.1)')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    if sub_args.config not in CONFIGURATIONS:
+        print('configuration {} not found'.format(sub_args.config))
+        exit(-1)
+    if sub_args.baseline != '' and not os.path.isfile(sub_args.baseline):
+        print('baseline file {} not found'.format(sub_args.baseline))
+        exit(-1)
+
+    output = sub_args.output
+    if output == '':
+        output = os.path.abspath(os.path.join(
+            os.getcwd(), '../benchmarks/{}.json'.format(
+                datetime.now().strftime('%Y-%m-%d_%H%M%S'))))
+
+    report = benchmark.run(sub_args.config, num_games=sub_args.games)
+    benchmark.save(report, output)
+    print('results saved to {}'.format(output))
+
+    baseline = benchmark.load(sub_args.baseline) \
+        if sub_args.baseline != '' else {'results': {}}
+    lines, regressions = benchmark.compare(
+        report, baseline, sub_args.tolerance)
+    print('\n'.join(lines))
+    if len(regressions) > 0:
+        print('{} regressions found'.format(len(regressions)))
+        exit(1)
+
+
+def process_perft():
+    # parse arguments
+    sub_parser = argparse.ArgumentParser(
+        usage=(
+            'python {0} perft [--implementations IMPLEMENTATIONS]\n' +
+            '       ' +
+            '                [--board_size BOARD_SIZE] [--depth DEPTH]\n' +
+            '       ' +
+            '                [--games GAMES] [--seed SEED]\n' +
+            '       ' +
+            'python {0} perft [-h]\n'
+        ).format(sys.argv[0])
+    )
+    sub_parser.add_argument(
+        '--implementations',
+        type=str,
+        default='go,naive',
+        help='comma separated implementations of the rules to compare, ' +
+             'each one is either defined in perft.py or given as ' +
+             '<module>:<class> (default: "go,naive")')
+    sub_parser.add_argument(
+        '--board_size',
+        type=int,
+        default=5,
+        help='the size of the board (default: 5)')
+    sub_parser.add_argument(
+        '--depth',
+        type=int,
+        default=3,
+        help='the depth of the game tree to walk (default: 3)')
+    sub_parser.add_argument(
+        '--games',
+        type=int,
+        default=100,
+        help='the number of random games to compare (default: 100)')
+    sub_parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='the seed of the random games (default: 0)')
+    sub_args = sub_parser.parse_args(sys.argv[2:])
+
+    names = sub_args.implementations.split(',')
+    board_size = sub_args.board_size
+
+    mismatches = perft.verify_perft(names, board_size, sub_args.depth)
+    mismatches += perft.verify_random(
+        names, board_size, sub_args.games, 4 * board_size * board_size,
+        seed=sub_args.seed)
+    for moves, difference in mismatches:
+        print('mismatch after moves {}: {}'.format(moves, difference))
+
+    for name in names:
+        result = perft.measure(name, board_size, sub_args.depth)
+        print('{}: {} leaves, {} positions, {:.1f} positions/s'.format(
+            name, result['leaves'], result['positions'],
+            result['positions_per_second']))
+
+    if len(mismatches) > 0:
+        exit(1)
 
 
 def main():
@@ -140,7 +706,14 @@ def main():
             'Currently supported commands:\n' +
             '    train    Train a model\n' +
             '    resume   Resume training from a checkpoint\n' +
-            '    play     Play Go with computer\n\n' +
+            '    play     Play Go with computer\n' +
+            '    gtp      Run as a GTP engine\n' +
+            '    analyze  Analyze positions in batch\n' +
+            '    export   Export self-play games as SGF\n' +
+            '    import   Import SGF games for training\n' +
+            '    profile  Profile self-play games\n' +
+            '    benchmark  Run the benchmark suite\n' +
+            '    perft    Check and measure the rules engine\n\n' +
             'Type "python {0} <command> -h" to show help message ' +
             'for each command.\n'
         ).format(sys.argv[0])
@@ -148,7 +721,10 @@ def main():
     parser.add_argument(
         'command',
         type=str,
-        help='the command to run, must be one of train/resume/play')
+        help='the command to run, ' +
+             'must be one of ' +
+             'train/resume/play/gtp/analyze/export/import/profile/' +
+             'benchmark/perft')
     args = parser.parse_args(sys.argv[1:2])
 
     if args.command == 'train':
@@ -157,6 +733,20 @@ def main():
         process_resume()
     elif args.command == 'play':
         process_play()
+    elif args.command == 'gtp':
+        process_gtp()
+    elif args.command == 'analyze':
+        process_analyze()
+    elif args.command == 'export':
+        process_export()
+    elif args.command == 'import':
+        process_import()
+    elif args.command == 'profile':
+        process_profile()
+    elif args.command == 'benchmark':
+        process_benchmark()
+    elif args.command == 'perft':
+        process_perft()
     else:
         print('unrecognized command: {}'.format(args.command))
         exit(-1)
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import time
+
 import numpy as np
 
-from go import Go
-from predict import predict
+from go import BLACK, WHITE, Go
+from predict import predict, run_coroutine
+
+# the values of the nodes whose results are known exactly (i.e., proven),
+# from the perspective of the player to move
+WIN = 1.0
+LOSS = -1.0
 
 
 # define the Monte Carlo search tree node
 # the definitions of n, w, q and p are the same as that in the paper
+# if evaluator is None, the evaluation of the node (i.e., p and v) is
+# deferred until the node is searched
+# the node of a finished game (i.e., after two consecutive passes) is
+# never evaluated by the network, its value is the real result
 class TreeNode:
 
     def __init__(self, parent, action, evaluator, conf):
@@ -23,55 +34,113 @@ class TreeNode:
         self.parent = parent
         self.children = [None] * conf.NUM_ACTIONS
         self.action = action
-        self.n = np.zeros(conf.NUM_ACTIONS, dtype=np.int)
+        self.n = np.zeros(conf.NUM_ACTIONS, dtype=np.int_)
         self.w = np.zeros(conf.NUM_ACTIONS, dtype=np.float32)
-        self.p, self.v = predict(evaluator, self, conf, random_trans=True)
+
+        # WIN or LOSS if the result of the node is proven, i.e., the game
+        # ends here, or the player to move can force a win (or cannot
+        # avoid a loss) in the searched subtree, None otherwise
+        self.proven = None
+        if parent is not None and action == conf.PASS \
+                and parent.action == conf.PASS:
+            score_black, score_white = self.go.score()
+            winner = BLACK if score_black > score_white else WHITE
+            self.proven = WIN if self.go.turn == winner else LOSS
+
+        if self.proven is not None:
+            self.p, self.v = None, self.proven
+        elif evaluator is None:
+            self.p, self.v = None, None
+        else:
+            self.p, self.v = predict(evaluator, self, conf, random_trans=True)
+
+
+# perform a simulation, see predict.run_coroutine() for cache
+def tree_search(root, evaluator, conf, cache=None):
+    run_coroutine(search(root, evaluator, conf), conf, cache)
+
+
+# perform num_simulations simulations, or stop earlier if seconds is
+# specified and the time is up, and return the number of simulations
+# performed, which is at least one so that the root is evaluated
+# num_simulations may be None if seconds is specified, in which case the
+# search only stops when the time is up
+def search_for(root, evaluator, conf, num_simulations, seconds=None):
+    deadline = None if seconds is None else time.time() + seconds
+    simulations = 0
+    while num_simulations is None or simulations < max(num_simulations, 1):
+        tree_search(root, evaluator, conf)
+        simulations += 1
+        if deadline is not None and time.time() >= deadline:
+            break
+    return simulations
 
 
-def tree_search(root, evaluator, conf):
+# take action at root, and return the child as the new root, whose
+# subtree is kept for the following searches
+# the child is created (without being evaluated) if it does not exist
+def advance(root, action, conf):
+    if root.children[action] is None:
+        root.children[action] = TreeNode(root, action, None, conf)
+    root = root.children[action]
+
+    # release memory
+    root.parent.children = None
+    return root
+
+
+# the coroutine version of tree_search() (see predict.run_coroutine()),
+# which yields (evaluator, node) when node needs to be evaluated
+# the proven results are propagated upward as in MCTS-solver: a node is
+# a win if any of its children is a loss for the opponent, and a loss if
+# all of its children are wins for the opponent
+# a simulation stops at a proven node without evaluating it, and a
+# losing move is never selected unless all the moves lose
+# only the candidate moves (see candidate()) are searched
+# if root_action is specified, the simulation takes root_action at the
+# root instead of selecting one (see gumbel_search())
+def search(root, evaluator, conf, root_action=None):
+    # evaluate the root first if its evaluation is deferred
+    if root.p is None:
+        root.p, root.v = yield evaluator, root
+
     node = root
 
     # prepare Dirichlet noise for the root node
-    noise = np.random.dirichlet(np.full(conf.NUM_ACTIONS, conf.DIRICHLET_ALPHA))
+    if root_action is None:
+        noise = np.random.dirichlet(
+            np.full(conf.NUM_ACTIONS, conf.DIRICHLET_ALPHA))
 
     # select
     while True:
-        # break if node is in a terminated state (i.e., the game ends)
-        if node.action == conf.PASS \
-                and node.parent is not None \
-                and node.parent.action == conf.PASS:
+        # break if the result of node is proven (e.g., the game ends)
+        # the root is still searched so that its visits keep going to
+        # the proven moves
+        if node.proven is not None and node != root:
             break
 
-        # find actions with maximum upper confidence bound
-        best_action = None
-        best_ucb = 0.0
-        sqrt_sum_n = np.sqrt(sum(node.n))
-        for action in range(conf.NUM_ACTIONS):
-            # skip illegal actions, notice that pass is always legal
-            if action != conf.PASS and not node.go.legal_play(
-                    action // conf.BOARD_SIZE, action % conf.BOARD_SIZE):
-                continue
-            q = 0.0 if node.n[action] == 0 else node.w[action] / node.n[action]
-            p = node.p[action]
-            if node == root:
-                # introduce additional Dirichlet noise for the root
-                p = (1 - conf.DIRICHLET_EPSILON) * p \
-                    + conf.DIRICHLET_EPSILON * noise[action]
-            ucb = q + conf.C_PUCT * p * sqrt_sum_n / (1.0 + node.n[action])
-
-            # there can be multiple best actions with super rare
-            # possibility, we will ignore this
-            if best_action is None or ucb > best_ucb:
-                best_action = action
-                best_ucb = ucb
+        if node != root:
+            best_action = _select(node, None, conf)
+        elif root_action is None:
+            best_action = _select(node, noise, conf)
+        else:
+            best_action = root_action
 
         if node.children[best_action] is not None:
             node = node.children[best_action]
+            # the evaluation of a child created by another search tree
+            # move may have been deferred
+            if node.p is None and node.proven is None:
+                node.p, node.v = yield evaluator, node
+                break
         else:
-            # reach a leaf node, evaluate and expand
+            # reach a leaf node, evaluate (unless its result is known)
+            # and expand
             node.children[best_action] = \
-                TreeNode(node, best_action, evaluator, conf)
+                TreeNode(node, best_action, None, conf)
             node = node.children[best_action]
+            if node.proven is None:
+                node.p, node.v = yield evaluator, node
             break
 
     # backup
@@ -83,6 +152,167 @@ def tree_search(root, evaluator, conf):
         v = -v
         node.parent.n[node.action] += 1
         node.parent.w[node.action] += v
+        if node.proven is not None and node.parent.proven is None:
+            if node.proven == LOSS:
+                node.parent.proven = WIN
+            elif _all_moves_lose(node.parent, conf):
+                node.parent.proven = LOSS
+            if node.parent.proven is not None:
+                node.parent.v = node.parent.proven
         node = node.parent
         if node == root:
             break
+
+
+# return the action with maximum upper confidence bound, with the
+# Dirichlet noise added to the prior probabilities if specified
+# actions are compared by (not losing, ucb), and an action that wins is
+# selected immediately
+def _select(node, noise, conf):
+    best_action = None
+    best_ucb = None
+    sqrt_sum_n = np.sqrt(sum(node.n))
+    for action in range(conf.NUM_ACTIONS):
+        # skip illegal and pruned actions
+        if not candidate(node.go, action, conf):
+            continue
+        child = node.children[action]
+        if child is not None and child.proven == LOSS:
+            return action
+        q = 0.0 if node.n[action] == 0 else node.w[action] / node.n[action]
+        p = node.p[action]
+        if noise is not None:
+            # introduce additional Dirichlet noise for the root
+            p = (1 - conf.DIRICHLET_EPSILON) * p \
+                + conf.DIRICHLET_EPSILON * noise[action]
+        ucb = (child is None or child.proven != WIN,
+               q + conf.C_PUCT * p * sqrt_sum_n / (1.0 + node.n[action]))
+
+        # there can be multiple best actions with super rare
+        # possibility, we will ignore this
+        if best_action is None or ucb > best_ucb:
+            best_action = action
+            best_ucb = ucb
+    return best_action
+
+
+def gumbel_tree_search(root, evaluator, conf, gumbel_noise=True,
+                       cache=None):
+    return run_coroutine(
+        gumbel_search(root, evaluator, conf, gumbel_noise), conf, cache)
+
+
+# the coroutine version of gumbel_tree_search() (see
+# predict.run_coroutine())
+# perform NUM_SIMULATIONS simulations with the root actions chosen by
+# Gumbel top-k sampling and sequential halving, as in "Policy improvement
+# by planning with Gumbel" (Danihelka et al., 2022), and return the
+# chosen action and the improved policy
+#   - sample GUMBEL_K candidate actions without replacement by the
+#     largest g(a) + logits(a), where g(a) is Gumbel noise (unless
+#     gumbel_noise is False) and logits(a) = log p(a)
+#   - split the simulations into ceil(log2(GUMBEL_K)) phases, in each
+#     phase visit the remaining actions equally, and then keep the
+#     better half by g(a) + logits(a) + sigma(q(a)), the last phase uses
+#     up all the remaining simulations
+#   - the best remaining action is chosen
+# the improved policy softmax(logits + sigma(completed q)) is the
+# training target, where the completed q of an unvisited action is
+# estimated by _mixed_value()
+# the actions below the root are selected by PUCT as usual
+def gumbel_search(root, evaluator, conf, gumbel_noise=True):
+    if root.p is None:
+        root.p, root.v = yield evaluator, root
+
+    actions = np.array([a for a in range(conf.NUM_ACTIONS)
+                        if candidate(root.go, a, conf)])
+    logits = np.full(conf.NUM_ACTIONS, -np.inf)
+    logits[actions] = np.log(np.maximum(root.p[actions], 1e-30))
+    g = np.random.gumbel(size=conf.NUM_ACTIONS) if gumbel_noise \
+        else np.zeros(conf.NUM_ACTIONS)
+
+    k = min(conf.GUMBEL_K, len(actions))
+    remaining = actions[np.argsort(-(g + logits)[actions])[:k]]
+    num_phases = max(1, int(np.ceil(np.log2(k))))
+    simulations = 0
+    for phase in range(num_phases):
+        if phase == num_phases - 1 or len(remaining) <= 2:
+            visits = -(-(conf.NUM_SIMULATIONS - simulations)
+                       // len(remaining))
+        else:
+            visits = max(1, conf.NUM_SIMULATIONS
+                         // (num_phases * len(remaining)))
+        for _ in range(visits):
+            for action in remaining:
+                if simulations == conf.NUM_SIMULATIONS:
+                    break
+                yield from search(root, evaluator, conf, root_action=action)
+                simulations += 1
+
+        score = (g + logits + _sigma(root, _completed_q(root, conf), conf))
+        remaining = remaining[np.argsort(-score[remaining])]
+        if phase == num_phases - 1 or len(remaining) <= 2:
+            break
+        remaining = remaining[:-(-len(remaining) // 2)]
+
+    improved_policy = np.zeros(conf.NUM_ACTIONS, dtype=np.float32)
+    x = (logits + _sigma(root, _completed_q(root, conf), conf))[actions]
+    x = np.exp(x - np.max(x))
+    improved_policy[actions] = x / np.sum(x)
+
+    return int(remaining[0]), improved_policy
+
+
+# the q values of the root for all the actions from the perspective of
+# the player to move, where the unvisited actions take the mixed value
+def _completed_q(root, conf):
+    visited = root.n > 0
+    q = np.full(conf.NUM_ACTIONS, _mixed_value(root))
+    q[visited] = root.w[visited] / root.n[visited]
+    return q
+
+
+# an estimation of the value of the root that mixes the value predicted
+# by the network with the q values of the visited actions weighted by
+# their prior probabilities
+def _mixed_value(root):
+    visited = root.n > 0
+    sum_n = np.sum(root.n)
+    if sum_n == 0:
+        return root.v
+    p = root.p[visited]
+    q = root.w[visited] / root.n[visited]
+    return (root.v + sum_n * np.sum(p * q) / np.sum(p)) / (1.0 + sum_n)
+
+
+# the monotonically increasing transformation of q, with q rescaled from
+# [-1, 1] to [0, 1]
+def _sigma(root, q, conf):
+    return (conf.GUMBEL_C_VISIT + np.max(root.n)) * conf.GUMBEL_C_SCALE \
+        * (q + 1.0) / 2.0
+
+
+# whether action is a candidate move of the position go, i.e., a legal
+# move that is not pruned, notice that pass is always a candidate
+# if PRUNE_EYE_FILLING is set, the plays that fill own eyes are pruned
+# (see go.Go.fills_own_eye()), they are still legal but never searched,
+# and hence never played in self-play
+def candidate(go, action, conf):
+    if action == conf.PASS:
+        return True
+    x, y = action // conf.BOARD_SIZE, action % conf.BOARD_SIZE
+    if not go.legal_play(x, y):
+        return False
+    return not (conf.PRUNE_EYE_FILLING and go.fills_own_eye(x, y))
+
+
+# whether every candidate move of node leads to a proven win of the
+# opponent
+def _all_moves_lose(node, conf):
+    for action in range(conf.NUM_ACTIONS):
+        if not candidate(node.go, action, conf):
+            continue
+        child = node.children[action]
+        if child is None or child.proven != WIN:
+            return False
+    return True
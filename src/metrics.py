@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+
+from record import END_RESIGNATION
+
+# The metrics are appended to <model_dir>/metrics.jsonl, one JSON object
+# per line, for example
+#   {"time": 1700000000.0, "job": "train", "iteration": 3, "step": 4000,
+#    "steps_per_second": 12.5, "data_wait": 0.3, ...}
+# Every process (job) writes whole lines with a single call in append
+# mode, so the lines of different processes never interleave.
+# If METRICS_PROMETHEUS is set, the latest value of every metric of a job
+# is also written to <model_dir>/metrics_<job>.prom in the Prometheus text
+# format, which can be collected by the textfile collector of a local
+# node exporter.
+
+
+class MetricsLogger:
+
+    def __init__(self, model_dir, conf, job):
+        self.job = job
+        self.path = os.path.join(model_dir, 'metrics.jsonl')
+        if conf.METRICS_PROMETHEUS:
+            self.prometheus_path = os.path.join(
+                model_dir, 'metrics_{}.prom'.format(job))
+        else:
+            self.prometheus_path = None
+
+        # the latest values of all the metrics
+        self._latest = {}
+
+    def write(self, iteration, step, metrics):
+        record = {
+            'time': time.time(),
+            'job': self.job,
+            'iteration': iteration,
+            'step': step,
+        }
+        record.update(metrics)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        if self.prometheus_path is not None:
+            self._latest.update(record)
+            del self._latest['job']
+            self._write_prometheus()
+
+    def _write_prometheus(self):
+        lines = []
+        for name, value in sorted(self._latest.items()):
+            if value is None:
+                # e.g., the gating evaluator knows no iteration
+                continue
+            lines.append('zetago_{}{{job="{}"}} {}'.format(
+                name, self.job, float(value)))
+        temp_path = self.prometheus_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
+
+
+# the throughput metrics of self-play games finished in elapsed seconds
+def self_play_metrics(records, elapsed, conf):
+    games = len(records)
+    moves = sum(len(record) for record in records)
+    elapsed = max(elapsed, 1e-6)
+    return {
+        'games': games,
+        'games_per_hour': games * 3600.0 / elapsed,
+        'moves_per_second': moves / elapsed,
+        'simulations_per_second': moves * conf.NUM_SIMULATIONS / elapsed,
+        'average_game_length': moves / games if games > 0 else 0.0,
+        'resign_rate': sum(record.end == END_RESIGNATION for record in records)
+        / games if games > 0 else 0.0,
+    }
+
+
+# the size metrics of an example pool
+def pool_metrics(example_pool):
+    return {
+        'pool_examples': len(example_pool),
+        'pool_games': len(example_pool.game_ids),
+        'pool_bytes': example_pool.nbytes(),
+    }
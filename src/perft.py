@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import time
+
+import numpy as np
+
+from go import BLACK, EMPTY, WHITE, Go
+
+# A perft-style harness of the rules engine: it walks the game tree
+# (every legal move sequence up to a fixed depth, or random move
+# sequences) with several implementations of the rules side by side,
+# checks that they agree on the board, the captures, the legal moves and
+# the scores of every position, and measures how many positions each of
+# them processes per second.
+# An implementation is a class with the same interface as go.Go:
+#   - __init__(board_size, komi) and __init__(copy=other)
+#   - turn, legal_play(x, y), play(x, y), pass_(), score()
+#   - board.color(x, y)
+# and is referred to by a name in IMPLEMENTATIONS or by
+# "<module>:<class>".
+
+# the four directions: left, up, right, down
+_directions = ((1, 0), (0, 1), (-1, 0), (0, -1))
+
+
+# a straightforward implementation of the rules which recomputes the
+# chains and liberties from scratch whenever they are needed, used as
+# the reference of go.Go
+# the rules are the same: simple ko, no suicide, area scoring where an
+# empty region counts for a player if it touches only the stones of
+# that player
+class NaiveGo:
+
+    def __init__(self, board_size=19, komi=0, copy=None):
+        if copy is None:
+            self.board_size = board_size
+            self.komi = komi
+            self.turn = BLACK
+            self._color = [EMPTY] * (board_size * board_size)
+
+            # the point where the opponent may not play in the next move
+            # due to ko, None if there is no such point
+            self._ko = None
+        else:
+            self.board_size = copy.board_size
+            self.komi = copy.komi
+            self.turn = copy.turn
+            self._color = copy._color[:]
+            self._ko = copy._ko
+
+    # provide board.color() like go.Go
+    @property
+    def board(self):
+        return self
+
+    def color(self, x, y):
+        return self._color[x * self.board_size + y]
+
+    def _neighbors(self, z):
+        x, y = divmod(z, self.board_size)
+        for dx, dy in _directions:
+            if 0 <= x + dx < self.board_size and 0 <= y + dy < self.board_size:
+                yield (x + dx) * self.board_size + y + dy
+
+    # return the points of the chain (or the empty region) z belongs to,
+    # and the colors adjacent to it
+    def _region(self, colors, z):
+        color = colors[z]
+        region, adjacent = {z}, set()
+        stack = [z]
+        while len(stack) > 0:
+            for w in self._neighbors(stack.pop()):
+                if colors[w] == color:
+                    if w not in region:
+                        region.add(w)
+                        stack.append(w)
+                else:
+                    adjacent.add(colors[w])
+        return region, adjacent
+
+    def _liberties(self, colors, z):
+        region, _ = self._region(colors, z)
+        return {w for v in region for w in self._neighbors(v)
+                if colors[w] == EMPTY}
+
+    # place a stone of the player to move on z, and return the new colors
+    # and the captured points, or None if the move is suicide
+    def _place(self, z):
+        colors = self._color[:]
+        colors[z] = self.turn
+        captured = set()
+        for w in self._neighbors(z):
+            if colors[w] == -self.turn and w not in captured \
+                    and len(self._liberties(colors, w)) == 0:
+                captured |= self._region(colors, w)[0]
+        for w in captured:
+            colors[w] = EMPTY
+        if len(self._liberties(colors, z)) == 0:
+            return None
+        return colors, captured
+
+    def legal_play(self, x, y):
+        if not (0 <= x < self.board_size and 0 <= y < self.board_size):
+            return False
+        z = x * self.board_size + y
+        if self._color[z] != EMPTY:
+            return False
+        result = self._place(z)
+        if result is None:
+            return False
+        # a move on the ko point is illegal if it captures a single stone
+        return not (z == self._ko and len(result[1]) == 1)
+
+    def play(self, x, y):
+        if not self.legal_play(x, y):
+            return False
+        z = x * self.board_size + y
+        self._color, captured = self._place(z)
+
+        # the opponent may not recapture immediately if a single stone
+        # is captured by a single stone which is now in atari
+        self._ko = None
+        if len(captured) == 1:
+            region, _ = self._region(self._color, z)
+            if len(region) == 1 and len(self._liberties(self._color, z)) == 1:
+                self._ko = next(iter(captured))
+
+        self.turn = -self.turn
+        return True
+
+    def pass_(self):
+        self._ko = None
+        self.turn = -self.turn
+
+    def score(self, komi=None):
+        if komi is None:
+            komi = self.komi
+        black_score, white_score = 0.0, komi
+        visited = set()
+        for z, color in enumerate(self._color):
+            if color == BLACK:
+                black_score += 1
+            elif color == WHITE:
+                white_score += 1
+            elif z not in visited:
+                region, adjacent = self._region(self._color, z)
+                visited |= region
+                if adjacent == {BLACK}:
+                    black_score += len(region)
+                elif adjacent == {WHITE}:
+                    white_score += len(region)
+        return black_score, white_score
+
+
+IMPLEMENTATIONS = {
+    'go': Go,
+    'naive': NaiveGo,
+}
+
+
+# return the implementation of the given name, either one of
+# IMPLEMENTATIONS or "<module>:<class>"
+def load_implementation(name):
+    if name in IMPLEMENTATIONS:
+        return IMPLEMENTATIONS[name]
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)
+
+
+# the state of a position which must be the same for all the
+# implementations
+def _state(go):
+    size = go.board.board_size
+    colors = tuple(go.board.color(x, y)
+                   for x in range(size) for y in range(size))
+    return colors, go.turn
+
+
+# the legal moves (not including pass) of a position
+def _legal_moves(go, board_size):
+    return [x * board_size + y
+            for x in range(board_size) for y in range(board_size)
+            if go.legal_play(x, y)]
+
+
+def _play(go, action, board_size):
+    if action == board_size * board_size:
+        go.pass_()
+    else:
+        go.play(action // board_size, action % board_size)
+
+
+# count the leaves of the game tree of the given depth, where pass is a
+# move and the game ends after two consecutive passes, and return the
+# number of leaves and the number of positions visited
+def perft(cls, board_size, depth, komi=7.5):
+    def walk(go, depth, passed):
+        if depth == 0:
+            return 1, 1
+        moves = _legal_moves(go, board_size) + [board_size * board_size]
+        leaves, positions = 0, 1
+        for action in moves:
+            is_pass = action == board_size * board_size
+            if is_pass and passed:
+                # the game ends
+                leaves += 1
+                positions += 1
+                continue
+            child = cls(copy=go)
+            _play(child, action, board_size)
+            l, p = walk(child, depth - 1, is_pass)
+            leaves += l
+            positions += p
+        return leaves, positions
+    return walk(cls(board_size=board_size, komi=komi), depth, False)
+
+
+# compare a list of positions (of different implementations) that
+# should be the same, and return the description of the first
+# difference, or None if they agree
+def _compare(games, names, board_size, compare_score):
+    states = [_state(go) for go in games]
+    legal_moves = [_legal_moves(go, board_size) for go in games]
+    scores = [go.score() for go in games] if compare_score else None
+    for i in range(1, len(games)):
+        if states[i] != states[0]:
+            return 'boards differ: {} vs {}'.format(names[0], names[i])
+        if legal_moves[i] != legal_moves[0]:
+            return 'legal moves differ: {} {} vs {} {}'.format(
+                names[0], sorted(set(legal_moves[0]) - set(legal_moves[i])),
+                names[i], sorted(set(legal_moves[i]) - set(legal_moves[0])))
+        if compare_score and scores[i] != scores[0]:
+            return 'scores differ: {} {} vs {} {}'.format(
+                names[0], scores[0], names[i], scores[i])
+    return None
+
+
+# walk the game tree of the given depth with all the implementations in
+# lockstep, and return the mismatches as a list of (moves, description)
+# the search stops after max_mismatches mismatches
+def verify_perft(names, board_size, depth, komi=7.5, max_mismatches=10):
+    classes = [load_implementation(name) for name in names]
+    mismatches = []
+
+    def walk(games, moves, depth, passed):
+        if len(mismatches) >= max_mismatches:
+            return
+        difference = _compare(games, names, board_size, True)
+        if difference is not None:
+            mismatches.append((moves, difference))
+            return
+        if depth == 0:
+            return
+        for action in _legal_moves(games[0], board_size) \
+                + [board_size * board_size]:
+            is_pass = action == board_size * board_size
+            if is_pass and passed:
+                continue
+            children = [type(go)(copy=go) for go in games]
+            for child in children:
+                _play(child, action, board_size)
+            walk(children, moves + [action], depth - 1, is_pass)
+
+    walk([cls(board_size=board_size, komi=komi) for cls in classes],
+         [], depth, False)
+    return mismatches
+
+
+# play random games with all the implementations in lockstep, and return
+# the mismatches as a list of (moves, description)
+# a player passes with probability pass_rate or if there is no legal
+# move, and the games are long enough to have plenty of captures and ko
+def verify_random(names, board_size, num_games, max_length, komi=7.5,
+                  pass_rate=0.02, seed=0, max_mismatches=10):
+    classes = [load_implementation(name) for name in names]
+    rng = np.random.RandomState(seed)
+    mismatches = []
+    for game in range(num_games):
+        games = [cls(board_size=board_size, komi=komi) for cls in classes]
+        moves = []
+        passed = False
+        while len(moves) < max_length:
+            difference = _compare(games, names, board_size, True)
+            if difference is not None:
+                mismatches.append((moves, difference))
+                break
+            legal_moves = _legal_moves(games[0], board_size)
+            if len(legal_moves) == 0 or rng.rand() < pass_rate:
+                action = board_size * board_size
+            else:
+                action = legal_moves[rng.randint(len(legal_moves))]
+            is_pass = action == board_size * board_size
+            for go in games:
+                _play(go, action, board_size)
+            moves.append(action)
+            if is_pass and passed:
+                break
+            passed = is_pass
+        if len(mismatches) >= max_mismatches:
+            break
+    return mismatches
+
+
+# measure the positions per second of an implementation by counting the
+# game tree of the given depth
+def measure(name, board_size, depth, komi=7.5):
+    cls = load_implementation(name)
+    start = time.perf_counter()
+    leaves, positions = perft(cls, board_size, depth, komi)
+    elapsed = time.perf_counter() - start
+    return {
+        'leaves': leaves,
+        'positions': positions,
+        'seconds': elapsed,
+        'positions_per_second': positions / elapsed,
+    }
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import nullcontext
+from glob import glob
+import os
+import time
+
+import glog as log
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from checkpoint import CheckpointWriter
+from compare import gate
+from config import get_conf
+from evaluate import DefaultEvaluator
+from example import create_example_pool
+from loader import BatchLoader
+from metrics import MetricsLogger, pool_metrics, self_play_metrics
+from network import ZetaGoNetwork
+from play import self_play_games
+from predict import OpeningCache
+from record import GameRecord
+from resign import ResignManager
+from storage import GameStorage
+from train import optimize
+
+# In the pipeline mode, the three components of AlphaGo Zero run
+# asynchronously in separate local processes:
+#   - the producers keep generating self-play games with the latest
+#     best network, SELF_PLAY_CONCURRENCY games at a time, and write
+#     every finished game to the replay store
+#   - the optimizer (the main process) keeps ingesting new games from
+#     the replay store and training the network on random batches of
+#     the example pool, and periodically publishes a candidate network
+#   - the gating evaluator compares the latest candidate network with
+#     the best network, and publishes a new version of the best network
+#     whenever the candidate wins
+# All the processes communicate through files under
+# <model_dir>/pipeline, and every file is written to a temporary path
+# first and then atomically renamed, so a reader never sees a
+# partially written file:
+#   - games/<producer>_<game>.pt: the replay store, one file per game
+#     (serialized by GameRecord.to_bytes())
+#   - weights/best_<version>.pt: versioned best networks
+#   - weights/candidate_<step>.pt: candidate networks to be gated
+
+# seconds to sleep when a process has nothing to do
+_POLL_INTERVAL = 1.0
+
+# number of optimizer steps between two scans of the replay store
+_INGEST_FREQUENCY = 10
+
+# seconds to wait for a process to finish its current work before
+# terminating it, it is always safe to terminate a process because
+# files are written atomically
+_JOIN_TIMEOUT = 10.0
+
+
+# save an object to path atomically
+def _save(obj, path):
+    temp_path = path + '.tmp'
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+
+# return the versions of all the files matching <directory>/<prefix>_*.pt
+# in ascending order, along with their paths
+def _versions(directory, prefix):
+    files = []
+    for path in glob(os.path.join(directory, '{}_*.pt'.format(prefix))):
+        name = os.path.basename(path)
+        files.append((int(name[len(prefix) + 1:-3]), path))
+    return sorted(files)
+
+
+# return the latest version and its path, or (-1, None) if not found
+def _latest(directory, prefix):
+    files = _versions(directory, prefix)
+    return files[-1] if len(files) > 0 else (-1, None)
+
+
+def _produce(pipeline_dir, conf, producer_id, stop_event):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if device.type == 'cpu':
+        # the producers already run in parallel, avoid oversubscribing
+        # the cores with intra-op threads
+        torch.set_num_threads(1)
+
+    weights_dir = os.path.join(pipeline_dir, 'weights')
+    games_dir = os.path.join(pipeline_dir, 'games')
+
+    network = ZetaGoNetwork(conf)
+    network.to(device)
+    evaluator = DefaultEvaluator(network, device)
+    resign_mgr = ResignManager(conf)
+    opening_cache = OpeningCache(conf)
+
+    version = -1
+    game = 0
+    while not stop_event.is_set():
+        # pick up the latest best network between two rounds of games
+        latest, path = _latest(weights_dir, 'best')
+        if latest > version:
+            network.load_state_dict(
+                torch.load(path, map_location=device)['network'])
+            version = latest
+            opening_cache.clear()
+            log.info('[producer={}] best network {} loaded'
+                     .format(producer_id, version))
+        if version < 0:
+            time.sleep(_POLL_INTERVAL)
+            continue
+
+        # a round of games played concurrently with the same network
+        for record in self_play_games(evaluator, conf, resign_mgr,
+                                      conf.SELF_PLAY_CONCURRENCY,
+                                      opening_cache):
+            _save({
+                'version': version,
+                'record': record.to_bytes(),
+            }, os.path.join(games_dir, '{:03d}_{:08d}.pt'.format(
+                producer_id, game)))
+            game += 1
+            if stop_event.is_set():
+                break
+
+
+def _gate(pipeline_dir, conf, stop_event):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    weights_dir = os.path.join(pipeline_dir, 'weights')
+    metrics = MetricsLogger(os.path.dirname(pipeline_dir), conf, 'gate')
+
+    candidate_network = ZetaGoNetwork(conf)
+    best_network = ZetaGoNetwork(conf)
+    candidate_network.to(device)
+    best_network.to(device)
+
+    while not stop_event.is_set():
+        candidates = _versions(weights_dir, 'candidate')
+        if len(candidates) == 0:
+            time.sleep(_POLL_INTERVAL)
+            continue
+
+        # only the latest candidate is worth evaluating, the older ones
+        # are discarded
+        step, path = candidates[-1]
+        candidate_network.load_state_dict(
+            torch.load(path, map_location=device)['network'])
+        for _, path in candidates:
+            os.remove(path)
+
+        version, path = _latest(weights_dir, 'best')
+        best_network.load_state_dict(
+            torch.load(path, map_location=device)['network'])
+
+        start = time.time()
+        better, win_rate, num_games = gate(
+            candidate_network, best_network, device, conf,
+            sgf_file=os.path.join(
+                os.path.dirname(pipeline_dir), 'sgf',
+                'evaluation_{}.sgf'.format(step)))
+        if better:
+            version += 1
+            _save({
+                'step': step,
+                'network': candidate_network.state_dict(),
+            }, os.path.join(weights_dir, 'best_{:06d}.pt'.format(version)))
+            log.info('[gate] best network updated to version {} (step={}), '
+                     'win_rate={}, {} games played, {} games saved, {:.1f}s'
+                     .format(version, step, win_rate, num_games,
+                             conf.GAMES_PER_EVALUATION - num_games,
+                             time.time() - start))
+        else:
+            log.info('[gate] best network not updated (step={}), '
+                     'win_rate={}, {} games played, {} games saved, {:.1f}s'
+                     .format(step, win_rate, num_games,
+                             conf.GAMES_PER_EVALUATION - num_games,
+                             time.time() - start))
+        metrics.write(None, step, {
+            'gating_seconds': time.time() - start,
+            'gating_games': num_games,
+            'win_rate': win_rate,
+            'gated': better,
+            'best_version': version,
+        })
+
+
+# load all the games in the replay store into the example pool, and
+# return the games loaded
+# the games are read, written to the storage of the pool and prepared
+# (see example.py) without holding lock (the lock of the BatchLoader
+# reading the pool, if any), which is only held to insert them, and the
+# file of a game is removed once the game is in the storage
+def _ingest(games_dir, example_pool, lock=None):
+    records = []
+    for path in sorted(glob(os.path.join(games_dir, '*.pt'))):
+        record = GameRecord.from_bytes(torch.load(path)['record'])
+        game_id = example_pool.store(record)
+        prepared = example_pool.prepare(record)
+        with lock if lock is not None else nullcontext():
+            example_pool.add_game(record, game_id, prepared)
+        os.remove(path)
+        records.append(record)
+    return records
+
+
+# if import_dir is specified, the example pool of a new model is seeded
+# with the games of the game storage in it (see train.train())
+def train_pipeline(model_dir, conf_name, checkpoint_file=None,
+                   num_producers=1, import_dir=None):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    pipeline_dir = os.path.join(model_dir, 'pipeline')
+    weights_dir = os.path.join(pipeline_dir, 'weights')
+    games_dir = os.path.join(pipeline_dir, 'games')
+    os.makedirs(weights_dir, exist_ok=True)
+    os.makedirs(games_dir, exist_ok=True)
+
+    if checkpoint_file is None:
+        log.info('start training a new model in pipeline mode')
+        log.info('model_dir={}'.format(model_dir))
+        log.info('conf_name={}'.format(conf_name))
+        log.info('device={}'.format(device))
+
+        conf = get_conf(conf_name)
+
+        games = 0
+        step = 0
+        gated_steps = []
+
+        network = ZetaGoNetwork(conf)
+        best_network = ZetaGoNetwork(conf)
+        best_network.load_state_dict(network.state_dict())
+        network.to(device)
+        best_network.to(device)
+
+        optimizer = optim.SGD(
+            network.parameters(),
+            lr=0.01,
+            momentum=0.9,
+            weight_decay=2 * conf.L2_REG)
+
+        example_pool = create_example_pool(conf, model_dir)
+        if import_dir is not None:
+            log.info('{} games added from {}'.format(
+                example_pool.add_stored_games(GameStorage(import_dir)),
+                import_dir))
+    else:
+        log.info('resume training from checkpoint {} in pipeline mode'
+                 .format(checkpoint_file))
+        log.info('device={}'.format(device))
+
+        # the checkpoint is a trusted local file which contains conf (not
+        # a tensor)
+        checkpoint = torch.load(checkpoint_file, weights_only=False)
+
+        conf = checkpoint['conf']
+
+        # checkpoints written by the sequential mode only record the
+        # number of iterations
+        games = checkpoint.get(
+            'games', checkpoint['iteration'] * conf.GAMES_PER_ITERATION)
+        step = checkpoint['step']
+        gated_steps = checkpoint.get('gated_steps', [])
+
+        network = ZetaGoNetwork(conf)
+        network.load_state_dict(checkpoint['network'])
+        best_network = ZetaGoNetwork(conf)
+        best_network.load_state_dict(checkpoint['best_network'])
+        network.to(device)
+        best_network.to(device)
+
+        optimizer = optim.SGD(
+            network.parameters(),
+            lr=0.01,
+            momentum=0.9,
+            weight_decay=2 * conf.L2_REG)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+        example_pool = create_example_pool(conf, model_dir)
+        example_pool.load_state_dict(checkpoint['example_pool'])
+
+    # publish the initial best network unless there is one already
+    if _latest(weights_dir, 'best')[1] is None:
+        _save({
+            'step': step,
+            'network': best_network.state_dict(),
+        }, os.path.join(weights_dir, 'best_{:06d}.pt'.format(0)))
+
+    # start the producers and the gating evaluator
+    ctx = mp.get_context('spawn')
+    stop_event = ctx.Event()
+    processes = [ctx.Process(
+        target=_produce, args=(pipeline_dir, conf, i, stop_event))
+        for i in range(num_producers)]
+    processes.append(ctx.Process(
+        target=_gate, args=(pipeline_dir, conf, stop_event)))
+    for process in processes:
+        process.start()
+    log.info('{} producers and the gating evaluator started'
+             .format(num_producers))
+
+    # the checkpoints are written in the background, a checkpoint is
+    # considered gated if the best network was updated since the
+    # previous checkpoint
+    checkpoint_writer = CheckpointWriter(
+        model_dir, conf.KEEP_CHECKPOINTS, gated_steps)
+    checkpoint_version = _latest(weights_dir, 'best')[0]
+    metrics = MetricsLogger(model_dir, conf, 'train')
+
+    running_loss = 0.0
+
+    # the games ingested since the last checkpoint, from which the
+    # throughput of all the producers is measured
+    records = []
+    start = time.time()
+    try:
+        # the optimizer never waits for an iteration of games, it only
+        # waits until the pool holds at least one batch
+        while True:
+            records += _ingest(games_dir, example_pool)
+            if len(example_pool) >= conf.BATCH_SIZE:
+                break
+            time.sleep(_POLL_INTERVAL)
+        games += len(records)
+        train_start = time.time()
+
+        loader = BatchLoader(example_pool, device, conf)
+        batches = loader.forever()
+        while games < conf.TOTAL_GAMES:
+            if step % _INGEST_FREQUENCY == 0:
+                new_records = _ingest(games_dir, example_pool, loader.lock)
+                games += len(new_records)
+                records += new_records
+
+            features, pi, z = next(batches)
+            running_loss += optimize(
+                network, optimizer, features, pi, z, step, conf)
+            step += 1
+
+            if step % conf.CHECKPOINT_FREQUENCY == 0:
+                iteration = games // conf.GAMES_PER_ITERATION
+                log.info('[iter={}] checkpoint reached, step={}, games={}'
+                         .format(iteration, step, games))
+
+                # hand the network over to the gating evaluator
+                _save({
+                    'step': step,
+                    'network': network.state_dict(),
+                }, os.path.join(
+                    weights_dir, 'candidate_{:08d}.pt'.format(step)))
+
+                # the best network is owned by the gating evaluator
+                version, path = _latest(weights_dir, 'best')
+                best_network.load_state_dict(
+                    torch.load(path, map_location=device)['network'])
+
+                running_loss /= conf.CHECKPOINT_FREQUENCY
+                checkpoint_writer.save({
+                    'conf': conf,
+                    'iteration': iteration,
+                    'games': games,
+                    'step': step,
+                    'example_pool': example_pool.state_dict(),
+                    'best_network': best_network.state_dict(),
+                    'network': network.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                }, step, gated=version > checkpoint_version)
+                checkpoint_version = version
+                log.info('[iter={}] checkpoint saved, best_version={}, '
+                         'running_loss={}, data_wait={:.1f}s'
+                         .format(iteration, version, running_loss,
+                                 loader.wait_time))
+                now = time.time()
+                with loader.lock:
+                    pool = pool_metrics(example_pool)
+                metrics.write(iteration, step, dict({
+                    'running_loss': running_loss,
+                    'steps_per_second':
+                        conf.CHECKPOINT_FREQUENCY / (now - train_start),
+                    'data_wait': loader.wait_time,
+                    'best_version': version,
+                }, **self_play_metrics(records, now - start, conf), **pool))
+                running_loss = 0.0
+                loader.wait_time = 0.0
+                records = []
+                start = train_start = time.time()
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join(_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    # training finished, save the final best network
+    checkpoint_writer.close()
+    version, path = _latest(weights_dir, 'best')
+    best_network.load_state_dict(
+        torch.load(path, map_location=device)['network'])
+    model_path = '{}/model.pt'.format(model_dir)
+    torch.save({
+        'conf': conf,
+        'network': best_network.state_dict(),
+    }, model_path)
+    log.info('finished training, model saved to {}'.format(model_path))
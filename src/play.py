@@ -1,18 +1,51 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
+import os
+import time
+
+import glog as log
 import numpy as np
 import torch
 
 from evaluate import DefaultEvaluator
-from go import BLACK, WHITE
-from gui import GUI
-from mcts import TreeNode, tree_search
+from go import BLACK, EMPTY, WHITE
+from mcts import TreeNode, gumbel_search, search, tree_search
 from network import ZetaGoNetwork
-from predict import extract_features
-
-
-def self_play(evaluator, conf, resign_mgr):
-    examples = []
+from predict import run_concurrently, run_coroutine
+from record import (END_DECIDED, END_MAX_LENGTH, END_PASSES,
+                    END_RESIGNATION, GameRecord)
+from root_parallel import RootParallelSearch
+from sgf import append_sgf, write_sgf
+
+
+# if opening_cache (a predict.OpeningCache) is specified, the
+# predictions of the opening positions are shared with the other games
+# played with the same network, the Dirichlet noise is still drawn
+# afresh for every game since it is not part of the predictions
+def self_play(evaluator, conf, resign_mgr, opening_cache=None):
+    return run_coroutine(
+        self_play_game(evaluator, conf, resign_mgr), conf, opening_cache)
+
+
+# play num_games self-play games in a single process, and yield their
+# records as they finish
+# up to SELF_PLAY_CONCURRENCY games are played at the same time, the
+# leaf nodes of all their search trees are evaluated in a single batch
+# (see predict.run_concurrently()), and a new game is started as soon
+# as a game finishes, so that the batches stay full
+def self_play_games(evaluator, conf, resign_mgr, num_games,
+                    opening_cache=None):
+    return run_concurrently(
+        (self_play_game(evaluator, conf, resign_mgr)
+         for _ in range(num_games)),
+        conf.SELF_PLAY_CONCURRENCY, conf, opening_cache)
+
+
+# the coroutine version of self_play() (see predict.run_coroutine()),
+# which returns the game record
+def self_play_game(evaluator, conf, resign_mgr):
+    record = GameRecord()
 
     resign_enabled = resign_mgr.enabled()
     if resign_enabled:
@@ -22,16 +55,23 @@ def self_play(evaluator, conf, resign_mgr):
 
     # result undecided
     result = 0.0
+    end = END_MAX_LENGTH
 
-    # create a search tree
-    root = TreeNode(None, None, evaluator, conf)
+    # create a search tree, the root is evaluated by the first search
+    root = TreeNode(None, None, None, conf)
 
     previous_action = None
     t = 0
     while t < conf.MAX_GAME_LENGTH:
         # perform MCTS
-        for i in range(conf.NUM_SIMULATIONS):
-            tree_search(root, evaluator, conf)
+        if conf.ROOT_SEARCH == 'gumbel':
+            # the Gumbel noise takes the place of the temperature (and
+            # the Dirichlet noise) for exploration
+            gumbel_action, improved_policy = yield from gumbel_search(
+                root, evaluator, conf, gumbel_noise=t < conf.EXPLORATION_TIME)
+        else:
+            for i in range(conf.NUM_SIMULATIONS):
+                yield from search(root, evaluator, conf)
 
         # we follow AlphaGo's method to calculate the resignation value
         # notice that children with n = 0 are skipped by setting their
@@ -42,30 +82,34 @@ def self_play(evaluator, conf, resign_mgr):
             history.append([resign_value, root.go.turn])
         elif -1.0 < resign_value <= resign_threshold:
             result = 1.0 if root.go.turn == WHITE else -1.0
+            end = END_RESIGNATION
             break
 
         # calculate the distribution of action selection
         # notice that illegal actions always have zero probability as
         # long as NUM_SIMULATION > 0
-        if t < conf.EXPLORATION_TIME:
-            # temperature tau = 1
-            s = sum(root.n)
-            pi = [x / s for x in root.n]
+        if conf.ROOT_SEARCH == 'gumbel':
+            # the action is chosen by sequential halving, and the
+            # improved policy is the training target
+            action, pi = gumbel_action, improved_policy
         else:
-            # temperature tau -> 0
-            m = max(root.n)
-            p = [0 if x < m else 1 for x in root.n]
-            s = sum(p)
-            pi = [x / s for x in p]
-
-        # save position, distribution of action selection and turn
-        examples.append([
-            extract_features(root, conf),
-            np.array(pi, dtype=np.float32),
-            np.array([root.go.turn], dtype=np.float32)])
+            if t < conf.EXPLORATION_TIME:
+                # temperature tau = 1
+                s = sum(root.n)
+                pi = [x / s for x in root.n]
+            else:
+                # temperature tau -> 0
+                m = max(root.n)
+                p = [0 if x < m else 1 for x in root.n]
+                s = sum(p)
+                pi = [x / s for x in p]
 
-        # choose an action
-        action = np.random.choice(conf.NUM_ACTIONS, p=pi)
+            # choose an action
+            action = np.random.choice(conf.NUM_ACTIONS, p=pi)
+
+        # save the action and the distribution of action selection,
+        # the position can be recovered by replaying the actions
+        record.append(action, pi)
 
         # take the action
         root = root.children[action]
@@ -79,9 +123,19 @@ def self_play(evaluator, conf, resign_mgr):
         if previous_action is not None \
                 and previous_action == conf.PASS \
                 and action == conf.PASS:
+            end = END_PASSES
             break
         previous_action = action
 
+        # game also terminates when the winner is decided by the
+        # intersections that unconditionally belong to the players
+        if conf.EARLY_TERMINATION:
+            winner = root.go.decided_winner()
+            if winner != EMPTY:
+                result = 1.0 if winner == BLACK else -1.0
+                end = END_DECIDED
+                break
+
     # calculate the scores if the result is undecided
     if result == 0.0:
         score_black, score_white = root.go.score()
@@ -91,22 +145,31 @@ def self_play(evaluator, conf, resign_mgr):
     if not resign_enabled:
         resign_mgr.add(history, result)
 
-    # update the the game winner from the perspective of each player
-    for i in range(len(examples)):
-        examples[i][2] *= result
+    record.finish(result, end)
 
-    return examples
+    return record
 
 
 def mutual_play(network_black, network_white, device, conf):
-    # create search trees for both players
-    root_black = TreeNode(None, None, network_black, device, conf)
-    root_white = TreeNode(None, None, network_white, device, conf)
-
     # create evaluators for both players
     evaluator_black = DefaultEvaluator(network_black, device)
     evaluator_white = DefaultEvaluator(network_white, device)
 
+    return run_coroutine(
+        mutual_play_game(evaluator_black, evaluator_white, conf), conf)
+
+
+# the coroutine version of mutual_play() (see predict.run_coroutine()),
+# which returns True if black wins
+# the actions taken are appended to actions if specified
+def mutual_play_game(evaluator_black, evaluator_white, conf, actions=None):
+    # create search trees for both players
+    # the nodes are evaluated only when they are searched, so a node of
+    # the opponent's tree which is never searched by the opponent (e.g.,
+    # the root after the opponent's move) costs no evaluation
+    root_black = TreeNode(None, None, None, conf)
+    root_white = TreeNode(None, None, None, conf)
+
     # black player goes first
     root = root_black
     evaluator = evaluator_black
@@ -116,7 +179,7 @@ def mutual_play(network_black, network_white, device, conf):
     while t < conf.MAX_GAME_LENGTH:
         # both players perform MCTS, each one uses its own network
         for i in range(conf.NUM_SIMULATIONS):
-            tree_search(root, evaluator, conf)
+            yield from search(root, evaluator, conf)
 
         # calculate the distribution of action selection
         # temperature tau -> 0
@@ -127,15 +190,17 @@ def mutual_play(network_black, network_white, device, conf):
 
         # choose an action
         action = np.random.choice(conf.NUM_ACTIONS, p=pi)
+        if actions is not None:
+            actions.append(int(action))
 
         # take the action
         if root_black.children[action] is None:
             root_black.children[action] = \
-                TreeNode(root_black, action, evaluator_black, conf)
+                TreeNode(root_black, action, None, conf)
         root_black = root_black.children[action]
         if root_white.children[action] is None:
             root_white.children[action] = \
-                TreeNode(root_white, action, evaluator_white, conf)
+                TreeNode(root_white, action, None, conf)
         root_white = root_white.children[action]
 
         # release memory
@@ -164,10 +229,14 @@ def mutual_play(network_black, network_white, device, conf):
     return score_black > score_white
 
 
-def play_against_human(model_file, black_player):
+# if num_processes > 1, the computer searches with num_processes local
+# processes in parallel (see root_parallel.py)
+# the game is saved to <model_dir>/sgf/human_<timestamp>.sgf when it ends
+def play_against_human(model_file, black_player, num_processes=1):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    model = torch.load(model_file)
+    # the model holds conf besides the tensors
+    model = torch.load(model_file, map_location=device, weights_only=False)
     conf = model['conf']
 
     # load the network
@@ -179,56 +248,97 @@ def play_against_human(model_file, black_player):
     evaluator = DefaultEvaluator(network, device)
 
     # create a search tree
+    # with the parallel search, the tree only keeps track of the game
+    # and is never searched
+    parallel_search = None
+    if num_processes > 1:
+        parallel_search = RootParallelSearch(
+            network, conf, device, num_processes)
+        evaluator = None
     root = TreeNode(None, None, evaluator, conf)
+    actions = []
 
+    # the GUI (and pygame) is only imported when playing against human,
+    # so that the rest of the code runs headless
+    from gui import GUI
     gui = GUI(conf)
 
     human_turn = black_player == 'human'
     previous_action = None
-    while True:
-        if human_turn:
-            # wait for human player's action
-            action = gui.wait_for_action(root.go)
-        else:
-            # calculate computer's action
-            gui.update_text('Computer is thinking...')
-
-            # perform MCTS
-            for i in range(conf.NUM_SIMULATIONS):
-                tree_search(root, evaluator, conf)
-
-            # calculate the distribution of action selection
-            # temperature tau -> 0
-            m = max(root.n)
-            p = [0 if x < m else 1 for x in root.n]
-            s = sum(p)
-            pi = np.array([x / s for x in p], dtype=np.float32)
-
-            # choose an action
-            action = np.random.choice(conf.NUM_ACTIONS, p=pi)
-
-        # take the action
-        if root.children[action] is None:
-            root.children[action] = \
-                TreeNode(root, action, evaluator, conf)
-        root = root.children[action]
-
-        # release memory
-        root.parent.children = None
-
-        # update GUI
-        gui.update_go(root.go)
-        gui.update_text('Computer passes' if action == conf.PASS else '')
-
-        # game terminates when both players pass
-        if previous_action is not None \
-                and previous_action == conf.PASS \
-                and action == conf.PASS:
-            black_score, white_score = root.go.score()
-            winner = 'BLACK' if black_score > white_score else 'WHITE'
-            gui.update_text('{} wins, {} : {}'.format(
-                winner, black_score, white_score))
-            gui.freeze()
-
-        previous_action = action
-        human_turn = not human_turn
+    # the worker processes of the parallel search are closed when the game
+    # ends, or when the window is closed in the middle of the game
+    try:
+        while True:
+            if human_turn:
+                # wait for human player's action
+                action = gui.wait_for_action(root.go)
+            else:
+                # calculate computer's action
+                gui.update_text('Computer is thinking...')
+
+                # perform MCTS
+                start = time.time()
+                if num_processes > 1:
+                    n, _ = parallel_search.search(
+                        actions, conf.NUM_SIMULATIONS)
+                else:
+                    for i in range(conf.NUM_SIMULATIONS):
+                        tree_search(root, evaluator, conf)
+                    n = root.n
+                log.info('{} simulations with {} processes, '
+                         '{:.1f} simulations/s'
+                         .format(conf.NUM_SIMULATIONS, num_processes,
+                                 conf.NUM_SIMULATIONS
+                                 / max(time.time() - start, 1e-6)))
+
+                # calculate the distribution of action selection
+                # temperature tau -> 0
+                m = max(n)
+                p = [0 if x < m else 1 for x in n]
+                s = sum(p)
+                pi = np.array([x / s for x in p], dtype=np.float32)
+
+                # choose an action
+                action = np.random.choice(conf.NUM_ACTIONS, p=pi)
+
+            # take the action
+            if root.children[action] is None:
+                root.children[action] = \
+                    TreeNode(root, action, evaluator, conf)
+            root = root.children[action]
+            actions.append(int(action))
+
+            # release memory
+            root.parent.children = None
+
+            # update GUI
+            gui.update_go(root.go)
+            gui.update_text('Computer passes' if action == conf.PASS else '')
+
+            # game terminates when both players pass
+            if previous_action is not None \
+                    and previous_action == conf.PASS \
+                    and action == conf.PASS:
+                black_score, white_score = root.go.score()
+                winner = 'BLACK' if black_score > white_score else 'WHITE'
+                gui.update_text('{} wins, {} : {}'.format(
+                    winner, black_score, white_score))
+                names = ('Human', 'ZetaGo') if black_player == 'human' \
+                    else ('ZetaGo', 'Human')
+                append_sgf(
+                    os.path.join(
+                        os.path.dirname(model_file), 'sgf',
+                        'human_{}.sgf'.format(
+                            datetime.now().strftime('%Y-%m-%d_%H%M%S'))),
+                    write_sgf(actions, conf, black_name=names[0],
+                              white_name=names[1]))
+                if parallel_search is not None:
+                    parallel_search.close()
+                    parallel_search = None
+                gui.freeze()
+
+            previous_action = action
+            human_turn = not human_turn
+    finally:
+        if parallel_search is not None:
+            parallel_search.close()
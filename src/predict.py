@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import collections
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -73,32 +75,194 @@ def extract_features(node, conf):
 
 
 def predict(evaluator, node, conf, random_trans=False):
+    return predict_batch(evaluator, [node], conf, random_trans)[0]
+
+
+# calculate the predictions for a batch of nodes with a single call of
+# the evaluator, and return a list of (p, v)
+def predict_batch(evaluator, nodes, conf, random_trans=False):
     if random_trans:
-        # uniform at random choose a Dihedral transformation and
-        # apply it to the features
-        trans = np.random.randint(8)
-        features = dihedral_trans(
-            extract_features(node, conf), trans, axes=(1, 2))
-        features = torch.stack([torch.from_numpy(features)])
-
-        logp, v = evaluator.evaluate(features)
-
-        # transform the distribution back
-        p = F.softmax(logp, dim=1)
-        p = p.cpu().numpy()[0]
-        p_move, p_pass = p[:conf.BOARD_SIZE ** 2], p[conf.PASS]
-        p_move = inverse_dihedral_trans(
-            np.reshape(p_move, (conf.BOARD_SIZE, conf.BOARD_SIZE)),
-            trans, axes=(0, 1))
-        p_move = np.reshape(p_move, conf.BOARD_SIZE ** 2)
-        p = np.append(p_move, p_pass)
-
-        v = v[0]
+        # uniform at random choose a Dihedral transformation for each
+        # node and apply it to the features
+        trans = np.random.randint(8, size=len(nodes))
+        features = [
+            dihedral_trans(extract_features(node, conf), t, axes=(1, 2))
+            for node, t in zip(nodes, trans)]
     else:
-        features = extract_features(node, conf)
-        features = torch.stack([torch.from_numpy(features)])
-        logp, v = evaluator.evaluate(features)
-        p = F.softmax(logp, dim=1)
-        p = p.cpu().numpy()[0]
-        v = v[0]
-    return p, v
+        trans = np.zeros(len(nodes), dtype=np.int64)
+        features = [extract_features(node, conf) for node in nodes]
+    features = torch.stack([torch.from_numpy(x) for x in features])
+
+    logp, v = evaluator.evaluate(features)
+    p = F.softmax(logp, dim=1)
+    p = p.cpu().numpy()
+    v = v.cpu().numpy()[:, 0]
+
+    predictions = []
+    for i in range(len(nodes)):
+        predictions.append((_inverse_policy(p[i], trans[i], conf), v[i]))
+    return predictions
+
+
+# transform a distribution of action selection predicted for the
+# transformed features back
+def _inverse_policy(p, trans, conf):
+    if trans == 0:
+        return p
+    p_move, p_pass = p[:conf.BOARD_SIZE ** 2], p[conf.PASS]
+    p_move = inverse_dihedral_trans(
+        np.reshape(p_move, (conf.BOARD_SIZE, conf.BOARD_SIZE)),
+        trans, axes=(0, 1))
+    p_move = np.reshape(p_move, conf.BOARD_SIZE ** 2)
+    return np.append(p_move, p_pass)
+
+
+# calculate the prediction of a node averaged over all the 8 dihedral
+# transformations, with a single call of the evaluator
+def predict_symmetric(evaluator, node, conf):
+    features = extract_features(node, conf)
+    features = torch.stack([
+        torch.from_numpy(dihedral_trans(features, t, axes=(1, 2)))
+        for t in range(8)])
+
+    logp, v = evaluator.evaluate(features)
+    p = F.softmax(logp, dim=1)
+    p = p.cpu().numpy()
+    v = v.cpu().numpy()[:, 0]
+
+    p = np.mean([_inverse_policy(p[t], t, conf) for t in range(8)], axis=0)
+    return p.astype(np.float32), np.float32(np.mean(v))
+
+
+# the predictions of the positions in the first OPENING_CACHE_PLIES
+# moves of a game, which are searched again and again by the self-play
+# games of the same network
+# a position is identified by the actions leading to it (which also
+# determine its history), and its prediction is averaged over all the
+# dihedral transformations, so that a cached prediction is not biased by
+# a single random transformation
+# at most OPENING_CACHE_SIZE predictions are kept, the least recently
+# used ones are discarded first
+# the cache must be cleared whenever the network changes
+class OpeningCache:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._predictions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._predictions)
+
+    def clear(self):
+        self._predictions.clear()
+
+    # whether node is in the opening, i.e., its prediction is cached
+    def covers(self, node):
+        return self._key(node) is not None
+
+    # return the actions leading to node (in reverse order), or None if
+    # node is not in the opening
+    def _key(self, node):
+        if self.conf.OPENING_CACHE_PLIES < 0:
+            return None
+        actions = []
+        while node.parent is not None:
+            if len(actions) == self.conf.OPENING_CACHE_PLIES:
+                return None
+            actions.append(node.action)
+            node = node.parent
+        return tuple(actions)
+
+    # return the cached prediction of node, or calculate it as predict()
+    # does if node is not in the opening
+    def predict(self, evaluator, node):
+        key = self._key(node)
+        if key is None:
+            return predict(evaluator, node, self.conf, random_trans=True)
+        prediction = self._predictions.get(key)
+        if prediction is None:
+            prediction = predict_symmetric(evaluator, node, self.conf)
+            self._predictions[key] = prediction
+            if len(self._predictions) > self.conf.OPENING_CACHE_SIZE:
+                self._predictions.popitem(last=False)
+        else:
+            self._predictions.move_to_end(key)
+        return prediction
+
+
+# the search and the games can be written as coroutines (generators)
+# that, instead of calling the network directly, yield a request
+# (evaluator, node) whenever a node needs to be evaluated, and expect
+# the prediction (p, v) of the node to be sent back
+# this allows running many coroutines concurrently and evaluating their
+# requests in batches
+
+# run a coroutine, evaluating its requests one by one, and return its
+# return value
+# the predictions of the opening positions are taken from cache (an
+# OpeningCache) if specified
+def run_coroutine(coroutine, conf, cache=None):
+    try:
+        evaluator, node = next(coroutine)
+        while True:
+            if cache is None:
+                prediction = predict(evaluator, node, conf, random_trans=True)
+            else:
+                prediction = cache.predict(evaluator, node)
+            evaluator, node = coroutine.send(prediction)
+    except StopIteration as e:
+        return e.value
+
+
+# run coroutines concurrently, with at most concurrency of them running
+# at the same time, and yield their return values as they finish
+# the pending requests of the running coroutines are grouped by
+# evaluator and each group is evaluated in a single batch
+# new coroutines are taken from the iterable coroutines as soon as
+# there is room, so the batches stay full
+# the predictions of the opening positions are taken from cache (an
+# OpeningCache) if specified
+def run_concurrently(coroutines, concurrency, conf, cache=None):
+    coroutines = iter(coroutines)
+    exhausted = False
+
+    # the running coroutines and their pending requests
+    running = []
+    requests = []
+    while True:
+        while not exhausted and len(running) < concurrency:
+            coroutine = next(coroutines, None)
+            if coroutine is None:
+                exhausted = True
+                break
+            try:
+                requests.append(next(coroutine))
+                running.append(coroutine)
+            except StopIteration as e:
+                yield e.value
+        if len(running) == 0:
+            return
+
+        # group the requests by evaluator
+        groups = {}
+        predictions = [None] * len(requests)
+        for i, (evaluator, node) in enumerate(requests):
+            if cache is not None and cache.covers(node):
+                predictions[i] = cache.predict(evaluator, node)
+            else:
+                groups.setdefault(id(evaluator), (evaluator, []))[1].append(i)
+        for evaluator, indices in groups.values():
+            for i, prediction in zip(indices, predict_batch(
+                    evaluator, [requests[i][1] for i in indices], conf,
+                    random_trans=True)):
+                predictions[i] = prediction
+
+        # resume the coroutines
+        running_, requests_ = [], []
+        for coroutine, prediction in zip(running, predictions):
+            try:
+                requests_.append(coroutine.send(prediction))
+                running_.append(coroutine)
+            except StopIteration as e:
+                yield e.value
+        running, requests = running_, requests_
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import io
+import os
+import pstats
+import time
+
+import glog as log
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from config import get_conf
+from evaluate import DefaultEvaluator
+from network import ZetaGoNetwork
+from play import self_play
+from resign import ResignManager
+
+# number of functions (operators) listed in the summary
+_TOP = 30
+
+
+# play self-play games under cProfile and the torch profiler, and write
+# the following files to output_dir:
+#   - summary.txt: the top hotspots of both profiles
+#   - cprofile.prof: the raw cProfile stats, which can be loaded with
+#     pstats or visualized with tools like snakeviz
+#   - torch_trace.json: the raw torch profile in the Chrome trace format,
+#     which can be opened in chrome://tracing
+# the network is loaded from model_file if specified, otherwise it is
+# randomly initialized with the configuration conf_name
+# if num_moves is specified, every game stops after num_moves moves
+def profile_self_play(output_dir, conf_name, model_file=None, num_games=1,
+                      num_moves=None):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    if model_file is None:
+        conf = get_conf(conf_name)
+        network = ZetaGoNetwork(conf)
+    else:
+        model = torch.load(model_file, weights_only=False)
+        conf = model['conf']
+        network = ZetaGoNetwork(conf)
+        network.load_state_dict(model['network'])
+    network.to(device)
+    if num_moves is not None:
+        conf = conf._replace(MAX_GAME_LENGTH=num_moves)
+
+    evaluator = DefaultEvaluator(network, device)
+    resign_mgr = ResignManager(conf)
+
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+
+    log.info('profiling {} self-play games on {}...'.format(num_games, device))
+    moves = 0
+    start = time.time()
+    profiler = cProfile.Profile()
+    with profile(activities=activities) as torch_profiler:
+        profiler.enable()
+        for game in range(num_games):
+            moves += len(self_play(evaluator, conf, resign_mgr))
+        profiler.disable()
+    elapsed = time.time() - start
+
+    os.makedirs(output_dir, exist_ok=True)
+    profiler.dump_stats(os.path.join(output_dir, 'cprofile.prof'))
+    torch_profiler.export_chrome_trace(
+        os.path.join(output_dir, 'torch_trace.json'))
+
+    summary = io.StringIO()
+    summary.write('{} games, {} moves, {} simulations in {:.1f}s '
+                  '({:.1f} simulations/s, with profiling overhead)\n\n'
+                  .format(num_games, moves, moves * conf.NUM_SIMULATIONS,
+                          elapsed,
+                          moves * conf.NUM_SIMULATIONS / max(elapsed, 1e-6)))
+    for sort_key in ('tottime', 'cumulative'):
+        summary.write('==== python functions by {} ====\n'.format(sort_key))
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.strip_dirs().sort_stats(sort_key).print_stats(_TOP)
+    summary.write('==== torch operators by self cpu time ====\n')
+    summary.write(torch_profiler.key_averages().table(
+        sort_by='self_cpu_time_total', row_limit=_TOP))
+    summary.write('\n')
+
+    summary_path = os.path.join(output_dir, 'summary.txt')
+    with open(summary_path, 'w') as f:
+        f.write(summary.getvalue())
+    log.info('profiles written to {}'.format(output_dir))
+
+    return summary_path
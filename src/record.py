@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from go import BLACK, WHITE, Go
+
+
+# the ways a game ends
+END_UNKNOWN = 0  # e.g., a game of another source
+END_PASSES = 1  # two consecutive passes
+END_RESIGNATION = 2
+END_DECIDED = 3  # the winner is decided (see go.Go.decided_winner())
+END_MAX_LENGTH = 4  # the game reaches MAX_GAME_LENGTH
+
+
+# a compact record of a game: the actions taken and the distribution
+# of action selection (pi) at each move, together with the result
+# since a game is fully determined by its actions, the feature planes
+# of every position can be regenerated by replaying the game
+class GameRecord:
+
+    def __init__(self):
+        # actions[t] is the action taken at time t
+        self.actions = []
+
+        # pi is stored sparsely, only the actions with non-zero
+        # probability are kept
+        # the actions with non-zero probability at time t and their
+        # probabilities are pi_actions[pi_offsets[t]:pi_offsets[t + 1]]
+        # and pi_probs[pi_offsets[t]:pi_offsets[t + 1]]
+        self.pi_offsets = [0]
+        self.pi_actions = []
+        self.pi_probs = []
+
+        # the game winner, 1.0 for black and -1.0 for white, 0.0 if the
+        # game is not finished yet
+        self.result = 0.0
+
+        # how the game ends (END_*)
+        self.end = END_UNKNOWN
+
+    def __len__(self):
+        return len(self.actions)
+
+    def append(self, action, pi):
+        pi = np.asarray(pi, dtype=np.float32)
+        nonzero = np.flatnonzero(pi)
+        self.actions.append(action)
+        self.pi_actions += nonzero.tolist()
+        self.pi_probs += pi[nonzero].tolist()
+        self.pi_offsets.append(len(self.pi_actions))
+
+    # append an action whose pi is one-hot on the action, e.g., a move of
+    # a game of another source
+    def append_played(self, action):
+        self.actions.append(action)
+        self.pi_actions.append(action)
+        self.pi_probs.append(1.0)
+        self.pi_offsets.append(len(self.pi_actions))
+
+    # set the result and how the game ends (END_*) when the game ends,
+    # and convert the lists into compact arrays
+    def finish(self, result, end=END_UNKNOWN):
+        self.result = result
+        self.end = end
+        self.actions = np.array(self.actions, dtype=np.int16)
+        self.pi_offsets = np.array(self.pi_offsets, dtype=np.int32)
+        self.pi_actions = np.array(self.pi_actions, dtype=np.int16)
+        self.pi_probs = np.array(self.pi_probs, dtype=np.float16)
+
+    # serialize a finished record into bytes
+    def to_bytes(self):
+        header = np.array(
+            [len(self.actions), len(self.pi_actions), self.result,
+             self.end], dtype=np.int32)
+        return b''.join([
+            header.tobytes(),
+            self.actions.tobytes(),
+            np.diff(self.pi_offsets).astype(np.int16).tobytes(),
+            self.pi_actions.tobytes(),
+            self.pi_probs.tobytes(),
+        ])
+
+    # the inverse of to_bytes()
+    @classmethod
+    def from_bytes(cls, data):
+        length, pi_length, result, end = np.frombuffer(data, np.int32, 4)
+        offset = 16
+        record = cls()
+        record.result = float(result)
+        record.end = int(end)
+        record.actions = np.frombuffer(data, np.int16, length, offset)
+        offset += 2 * length
+        pi_lengths = np.frombuffer(data, np.int16, length, offset)
+        record.pi_offsets = np.concatenate(
+            ([0], np.cumsum(pi_lengths))).astype(np.int32)
+        offset += 2 * length
+        record.pi_actions = np.frombuffer(data, np.int16, pi_length, offset)
+        offset += 2 * pi_length
+        record.pi_probs = np.frombuffer(data, np.float16, pi_length, offset)
+        return record
+
+    # return the dense pi at time t
+    def pi(self, t, conf):
+        begin, end = self.pi_offsets[t], self.pi_offsets[t + 1]
+        pi = np.zeros(conf.NUM_ACTIONS, dtype=np.float32)
+        pi[self.pi_actions[begin:end]] = self.pi_probs[begin:end]
+        return pi
+
+    # return the game winner from the perspective of the player at
+    # time t, notice that black always moves first
+    def z(self, t):
+        return self.result if t % 2 == 0 else -self.result
+
+    # replay the game and yield the positions (i.e., the instances of
+    # Go) at time 0, 1, ..., stop
+    def replay(self, conf, stop=None):
+        if stop is None:
+            stop = len(self.actions)
+        go = Go(board_size=conf.BOARD_SIZE, komi=conf.KOMI)
+        for t in range(stop + 1):
+            yield go
+            if t == stop:
+                break
+            go = Go(copy=go)
+            action = int(self.actions[t])
+            if action == conf.PASS:
+                go.pass_()
+            else:
+                go.play(action // conf.BOARD_SIZE, action % conf.BOARD_SIZE)
+
+    # return the examples at the given times (in ascending order) by
+    # replaying the game once, each example is a list of
+    # [features, pi, z] as generated by self-play
+    def examples_at(self, times, conf):
+        examples = []
+        history = []
+        i = 0
+        for t, go in enumerate(self.replay(conf, stop=times[-1])):
+            history = [go] + history[:conf.HISTORY_LENGTH - 1]
+            while i < len(times) and times[i] == t:
+                examples.append([
+                    extract_features(history, conf),
+                    self.pi(t, conf),
+                    np.array([self.z(t)], dtype=np.float32),
+                ])
+                i += 1
+        return examples
+
+    # return all the examples of this game
+    def examples(self, conf):
+        if len(self.actions) == 0:
+            return []
+        return self.examples_at(range(len(self.actions)), conf)
+
+
+# extract the features from the history of positions, where history[0]
+# is the current position and history[i] is the position i moves ago
+# this is equivalent to predict.extract_features() applied to the
+# search tree node of the current position
+def extract_features(history, conf):
+    features = np.zeros(
+        (conf.INPUT_CHANNELS, conf.BOARD_SIZE, conf.BOARD_SIZE),
+        dtype=np.float32)
+    if history[0].turn == BLACK:
+        features[conf.INPUT_CHANNELS - 1] = 1.0
+    for i in range(min(conf.HISTORY_LENGTH, len(history))):
+        color = np.reshape(
+            history[i].board._color, (conf.BOARD_SIZE, conf.BOARD_SIZE))
+        features[2 * i] = color == BLACK
+        features[2 * i + 1] = color == WHITE
+    return features
@@ -2,7 +2,7 @@
 
 import numpy as np
 
-from data_structure import Queue
+from data_structure import PrefixSumTree, Queue
 
 
 class ResignManager:
@@ -13,6 +13,17 @@ class ResignManager:
         self._histories = Queue(conf.NUM_RESIGN_SAMPLES)
         self._threshold = -1.0
 
+        # the resignation values of all the histories, see _contributions()
+        self._values = PrefixSumTree()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # resignation managers saved by older versions have no _values
+        if '_values' not in state:
+            self._values = PrefixSumTree()
+            for history in self._histories:
+                self._add_history(history)
+
     def enabled(self):
         if not self._histories.is_full():
             return False
@@ -56,46 +67,43 @@ class ResignManager:
 
         # discard the earliest history and save the current history
         if self._histories.is_full():
-            self._histories.dequeue()
+            self._remove_history(self._histories.dequeue())
         self._histories.enqueue(history_)
+        self._add_history(history_)
 
         # update the threshold when we get sufficient samples
         if self._histories.is_full():
             self._update_threshold()
 
-    def _update_threshold(self):
-        # sort all the resignation values in descending order
-        resign_values = []
-        for history in self._histories:
-            resign_values += [x[0] for x in history]
-        resign_values = sorted(resign_values, reverse=True)
-
-        # search for the threshold
-        pointers = [0] * len(self._histories)
-        i = 0
-        while i < len(resign_values):
-            threshold = resign_values[i]
-
-            # calculate the number of regretful resignations for this
-            # candidate threshold
-            regrets = 0
-            for j in range(len(self._histories)):
-                history = self._histories[j]
-                while pointers[j] < len(history) and \
-                        history[pointers[j]][0] > threshold:
-                    pointers[j] += 1
-                if pointers[j] < len(history):
-                    regrets += history[pointers[j]][1]
-
-            if regrets <= self._regret_frac * len(self._histories):
-                self._threshold = threshold
-                return
-
-            # find the next candidate threshold 
-            j = i + 1
-            while j < len(resign_values) and \
-                    resign_values[j] == resign_values[i]:
-                j += 1
-            i = j
+    # for a candidate threshold T, the resignation of a history happens at
+    # the first eligible time whose value is <= T, and the number of
+    # regretful resignations of T is the sum of the regrets at these
+    # times over all the histories
+    # since the values of a history are strictly decreasing, the values
+    # <= T are a suffix of the history, so if every value v_i carries the
+    # weight r_i - r_{i+1} (and the last one carries r_last), the regret
+    # of the history is exactly the total weight of its values <= T
+    # therefore the number of regretful resignations of T is the prefix
+    # sum of T in the tree of all the values, and the threshold (the
+    # largest T whose regrets are acceptable) can be found in O(log n)
+    # without sorting all the values every time
+    @staticmethod
+    def _contributions(history):
+        for i in range(len(history)):
+            regret = history[i][1]
+            if i + 1 < len(history):
+                regret -= history[i + 1][1]
+            yield history[i][0], regret
+
+    def _add_history(self, history):
+        for value, weight in ResignManager._contributions(history):
+            self._values.add(value, weight)
+
+    def _remove_history(self, history):
+        for value, weight in ResignManager._contributions(history):
+            self._values.remove(value, weight)
 
-        self._threshold = -1.0
+    def _update_threshold(self):
+        threshold = self._values.last_key_within(
+            self._regret_frac * len(self._histories))
+        self._threshold = -1.0 if threshold is None else threshold
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from evaluate import DefaultEvaluator
+from mcts import TreeNode, advance, search_for
+from network import ZetaGoNetwork
+
+# Root parallelization of the search: every worker process keeps its
+# own search tree of the same position and searches it with its own
+# random seed (hence its own Dirichlet noise and random dihedral
+# transformations), and the visit counts and the total values of the
+# root are summed up before the action is chosen.
+# The trees are never shared, so no locking is needed, and the only
+# communication per move is the actions played so far (sent to the
+# workers) and the n and w of the roots (sent back).
+
+
+def _work(network_state, conf, device, seed, connection):
+    if device.type == 'cpu':
+        # the workers already run in parallel, avoid oversubscribing the
+        # cores with intra-op threads
+        torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    network = ZetaGoNetwork(conf)
+    network.load_state_dict(network_state)
+    network.to(device)
+    evaluator = DefaultEvaluator(network, device)
+
+    # the actions leading to the root of the search tree
+    actions = []
+    root = TreeNode(None, None, None, conf)
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        if message == 'clear':
+            actions = []
+            root = TreeNode(None, None, None, conf)
+            continue
+        actions_, num_simulations, seconds = message
+
+        # reuse the search tree if the game goes on from its root,
+        # otherwise (e.g., a move is taken back) start over
+        if actions_[:len(actions)] != actions:
+            actions = []
+            root = TreeNode(None, None, None, conf)
+        for action in actions_[len(actions):]:
+            root = advance(root, action, conf)
+        actions = list(actions_)
+
+        simulations = search_for(
+            root, evaluator, conf, num_simulations, seconds)
+        connection.send((root.n, root.w, simulations))
+
+
+# a search of the position after the given actions with num_processes
+# local worker processes, each one holding a copy of the network
+class RootParallelSearch:
+
+    def __init__(self, network, conf, device, num_processes):
+        self.conf = conf
+        self.num_processes = num_processes
+
+        network_state = {key: value.cpu()
+                         for key, value in network.state_dict().items()}
+        context = mp.get_context('spawn')
+        self._connections = []
+        self._processes = []
+        for seed in np.random.randint(2 ** 31, size=num_processes):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=_work,
+                args=(network_state, conf, device, int(seed),
+                      worker_connection),
+                daemon=True)
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        # the statistics of the last search
+        self.simulations = 0
+        self.seconds = 0.0
+
+    # split num_simulations among the workers, and return the merged n
+    # and w of the root
+    # if seconds is specified, every worker also stops searching after
+    # seconds, and num_simulations may be None (see mcts.search_for())
+    def search(self, actions, num_simulations, seconds=None):
+        start = time.time()
+        if num_simulations is None:
+            shares = [None] * self.num_processes
+        else:
+            shares = [
+                num_simulations // self.num_processes
+                + (1 if i < num_simulations % self.num_processes else 0)
+                for i in range(self.num_processes)]
+        for connection, share in zip(self._connections, shares):
+            connection.send((list(actions), share, seconds))
+        n = np.zeros(self.conf.NUM_ACTIONS, dtype=np.int_)
+        w = np.zeros(self.conf.NUM_ACTIONS, dtype=np.float32)
+        self.simulations = 0
+        for connection in self._connections:
+            n_, w_, simulations = connection.recv()
+            n += n_
+            w += w_
+            self.simulations += simulations
+        self.seconds = time.time() - start
+        return n, w
+
+    # discard the search trees of the workers
+    def clear(self):
+        for connection in self._connections:
+            connection.send('clear')
+
+    def simulations_per_second(self):
+        return self.simulations / max(self.seconds, 1e-6)
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(None)
+        for process in self._processes:
+            process.join()
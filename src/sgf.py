@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import functools
+import multiprocessing as mp
+import os
+import re
+
+import glog as log
+
+from go import BLACK, WHITE, Go
+from record import END_PASSES, END_RESIGNATION, END_UNKNOWN, GameRecord
+
+# Reading and writing games in the Smart Game Format (SGF, FF[4]), so
+# that the self-play, evaluation and human games can be viewed in any
+# SGF editor, and the games of other sources can be used for training.
+#
+# A point (x, y) of the board (x is the column from the left, y is the
+# row from the top) is written as two letters "ab" with a = x and b = y,
+# and pass is written as an empty value (or "tt" on boards up to 19x19).
+#
+# Only the main line of a game is read (the first variation at every
+# branch). A game is converted into a GameRecord by replaying it with
+# go.Go, where the distribution of action selection of every move is
+# one-hot on the move played. A game is skipped if it cannot be
+# represented by a GameRecord: another board size, setup stones (e.g.,
+# handicap), an illegal move under the rules of go.Go, or a draw.
+
+# number of games replayed by a worker process at a time
+_CHUNK_SIZE = 64
+
+# number of chunks submitted to the worker processes and not yet taken
+# by the reader, per worker process
+_CHUNKS_PER_PROCESS = 2
+
+# number of characters read from a file at a time
+_BLOCK_SIZE = 1 << 20
+
+# the tokens of SGF: parentheses, semicolons and properties with their
+# values, FF[3] property names may contain lowercase letters
+_TOKEN = re.compile(
+    r'\s*(?:([();])|([A-Za-z]+)\s*((?:\[(?:[^\]\\]|\\.)*\]\s*)+))', re.S)
+_VALUE = re.compile(r'\[((?:[^\]\\]|\\.)*)\]', re.S)
+_SPECIAL = re.compile(r'[\[()]')
+_VALUE_END = re.compile(r'(?:[^\]\\]|\\.)*\]', re.S)
+
+
+# a game read from SGF
+class SGFGame:
+
+    def __init__(self):
+        self.board_size = 19
+        self.komi = 0.0
+
+        # the game winner, 1.0 for black and -1.0 for white, 0.0 if it
+        # is a draw or unknown
+        self.result = 0.0
+
+        # whether the game is ended by resignation
+        self.resigned = False
+
+        self.black_name = ''
+        self.white_name = ''
+
+        # the actions of the setup stones (AB and AW)
+        self.setup = {BLACK: [], WHITE: []}
+
+        # (color, action) of the moves of the main line
+        self.moves = []
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace(']', '\\]')
+
+
+def _unescape(text):
+    return re.sub(r'\\(.)', r'\1', text, flags=re.S)
+
+
+def _point(action, conf):
+    if action == conf.PASS:
+        return ''
+    x, y = divmod(int(action), conf.BOARD_SIZE)
+    return chr(ord('a') + x) + chr(ord('a') + y)
+
+
+def _action(value, board_size):
+    num_actions = board_size * board_size + 1
+    if value == '' or (value == 'tt' and board_size <= 19):
+        return num_actions - 1
+    if len(value) != 2:
+        raise ValueError('invalid point {}'.format(value))
+    x, y = ord(value[0]) - ord('a'), ord(value[1]) - ord('a')
+    if not (0 <= x < board_size and 0 <= y < board_size):
+        raise ValueError('invalid point {}'.format(value))
+    return x * board_size + y
+
+
+# return the result of a game ("B+R", "W+3.5", ...) for the RE property,
+# where reason is "R" for resignation, the score margin, or empty if the
+# margin is unknown
+def _result_string(result, reason):
+    return '{}+{}'.format('B' if result > 0 else 'W', reason)
+
+
+def _parse_result(text):
+    text = text.strip().upper()
+    if text.startswith('B+'):
+        return 1.0
+    elif text.startswith('W+'):
+        return -1.0
+    else:
+        return 0.0
+
+
+# write a game of the given actions (black first, passes included) as
+# SGF, and return the text
+# if resigned is set, the game is regarded as ended by resignation with
+# the given result (1.0 for black and -1.0 for white), otherwise the
+# final position is scored, and the result is the winner by the score if
+# not given
+# a game stopped before its end (e.g., by the length limit or once the
+# winner is decided) is written with the score margin of its final
+# position, or without a margin if the score disagrees with its result
+def write_sgf(actions, conf, result=None, resigned=False, black_name='',
+              white_name='', komi=None):
+    if komi is None:
+        komi = conf.KOMI
+    if resigned:
+        reason = 'R'
+    else:
+        go = Go(board_size=conf.BOARD_SIZE, komi=komi)
+        for action in actions:
+            if action == conf.PASS:
+                go.pass_()
+            else:
+                go.play(*divmod(int(action), conf.BOARD_SIZE))
+        black_score, white_score = go.score()
+        winner = 1.0 if black_score > white_score else -1.0
+        if result is None:
+            result = winner
+        reason = '{:g}'.format(abs(black_score - white_score)) \
+            if result == winner else ''
+
+    properties = [
+        ('GM', '1'), ('FF', '4'), ('CA', 'UTF-8'), ('AP', 'ZetaGo'),
+        ('RU', 'Chinese'), ('SZ', str(conf.BOARD_SIZE)),
+        ('KM', '{:g}'.format(komi)),
+        ('PB', black_name), ('PW', white_name),
+        ('RE', _result_string(result, reason)),
+    ]
+    root = ''.join('{}[{}]'.format(key, _escape(value))
+                   for key, value in properties if value != '')
+    moves = ''.join(
+        ';{}[{}]'.format('B' if t % 2 == 0 else 'W', _point(action, conf))
+        for t, action in enumerate(actions))
+    return '(;{}{})\n'.format(root, moves)
+
+
+# write a self-play game (see GameRecord) as SGF
+def record_to_sgf(record, conf, black_name='ZetaGo', white_name='ZetaGo'):
+    return write_sgf([int(a) for a in record.actions], conf,
+                     result=record.result,
+                     resigned=record.end == END_RESIGNATION,
+                     black_name=black_name, white_name=white_name)
+
+
+# append the SGF of a game to a collection file, the directory of the
+# file is created if necessary
+def append_sgf(path, text):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+# write self-play games (see GameRecord) as a collection file, and
+# return the number of games written
+def write_records(records, conf, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = 0
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(record_to_sgf(record, conf))
+            count += 1
+    return count
+
+
+# read a collection from the file object f block by block, and yield the
+# texts of its games without parsing them, so that only the game being
+# read is kept in memory
+def split_games(f):
+    buffer = ''
+    position = 0
+    eof = False
+
+    # the depth of the parentheses and the beginning of the current game
+    depth, begin = 0, None
+    while True:
+        match = _SPECIAL.search(buffer, position)
+        value_end = None
+        if match is not None and match.group() == '[':
+            # a property value, whose parentheses are not special
+            value_end = _VALUE_END.match(buffer, match.end())
+        if match is None or (match.group() == '[' and value_end is None):
+            # read more text, the text before the current game is dropped
+            if eof:
+                return
+            if match is None:
+                position = len(buffer)
+            keep = begin if depth > 0 else position
+            buffer = buffer[keep:]
+            position -= keep
+            if depth > 0:
+                begin = 0
+            block = f.read(_BLOCK_SIZE)
+            eof = block == ''
+            buffer += block
+            continue
+
+        token = match.group()
+        position = match.end() if value_end is None else value_end.end()
+        if token == '(':
+            if depth == 0:
+                begin = match.start()
+            depth += 1
+        elif token == ')' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield buffer[begin:position]
+
+
+# parse the text of a collection, and return the games (see SGFGame)
+# a ValueError is raised if the text is malformed
+def parse_sgf(text):
+    games = []
+    depth = 0
+
+    # the nodes of the main line of the current game, each one is a dict
+    # of the properties
+    nodes = None
+
+    # once a variation is finished at depth d, the nodes deeper than
+    # d - 1 (i.e., its sibling variations) are skipped
+    skip = None
+
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise ValueError('malformed SGF at {}'.format(position))
+        position = match.end()
+        token, key, values = match.groups()
+        if token == '(':
+            depth += 1
+            if depth == 1:
+                nodes = []
+        elif token == ')':
+            depth -= 1
+            if depth < 0:
+                raise ValueError('unbalanced parentheses')
+            if depth == 0:
+                games.append(_game(nodes))
+                skip = None
+            else:
+                skip = depth if skip is None else min(skip, depth)
+        elif depth == 0 or (skip is not None and depth > skip):
+            continue
+        elif token == ';':
+            nodes.append({})
+        elif len(nodes) > 0:
+            # only the uppercase letters matter (e.g., AddBlack is AB)
+            key = re.sub('[a-z]', '', key)
+            nodes[-1][key] = [_unescape(v) for v in _VALUE.findall(values)]
+    if depth != 0:
+        raise ValueError('unbalanced parentheses')
+    return games
+
+
+def _game(nodes):
+    game = SGFGame()
+    if len(nodes) == 0:
+        return game
+    root = nodes[0]
+    if 'SZ' in root:
+        game.board_size = int(root['SZ'][0].split(':')[0])
+    if 'KM' in root:
+        game.komi = float(root['KM'][0] or 0)
+    game.result = _parse_result(root.get('RE', [''])[0])
+    game.resigned = re.match(
+        r'[BW]\+R', root.get('RE', [''])[0].strip().upper()) is not None
+    game.black_name = root.get('PB', [''])[0]
+    game.white_name = root.get('PW', [''])[0]
+    for node in nodes:
+        for color, setup, move in ((BLACK, 'AB', 'B'), (WHITE, 'AW', 'W')):
+            for value in node.get(setup, []):
+                game.setup[color].append(_action(value, game.board_size))
+            if move in node:
+                game.moves.append(
+                    (color, _action(node[move][0], game.board_size)))
+    return game
+
+
+# replay a game with go.Go, and return its GameRecord, or None if the
+# game cannot be represented by a GameRecord (see the top of the file)
+# if the moves of a player are not interleaved with the moves of the
+# opponent, the missing moves of the opponent are taken as passes
+def to_record(game, conf):
+    if game.board_size != conf.BOARD_SIZE \
+            or len(game.setup[BLACK]) + len(game.setup[WHITE]) > 0:
+        return None
+    go = Go(board_size=conf.BOARD_SIZE, komi=game.komi)
+    record = GameRecord()
+    for color, action in game.moves:
+        if color != go.turn:
+            go.pass_()
+            record.append_played(conf.PASS)
+        if action == conf.PASS:
+            go.pass_()
+        elif not go.play(*divmod(action, conf.BOARD_SIZE)):
+            return None
+        record.append_played(action)
+    if len(record) == 0:
+        return None
+
+    result = game.result
+    if result == 0.0:
+        black_score, white_score = go.score()
+        if black_score == white_score:
+            return None
+        result = 1.0 if black_score > white_score else -1.0
+    if game.resigned:
+        end = END_RESIGNATION
+    elif len(record) >= 2 \
+            and record.actions[-1] == record.actions[-2] == conf.PASS:
+        end = END_PASSES
+    else:
+        end = END_UNKNOWN
+    record.finish(result, end)
+    return record
+
+
+# parse and replay the texts of games, and return the serialized records
+# of the usable games and the number of games skipped
+def _replay_chunk(texts, conf):
+    records, skipped = [], 0
+    for text in texts:
+        try:
+            games = parse_sgf(text)
+        except (ValueError, IndexError):
+            skipped += 1
+            continue
+        for game in games:
+            try:
+                record = to_record(game, conf)
+            except (ValueError, IndexError):
+                record = None
+            if record is None:
+                skipped += 1
+            else:
+                records.append(record.to_bytes())
+    return records, skipped
+
+
+def _chunks(paths):
+    chunk = []
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for game in split_games(f):
+                chunk.append(game)
+                if len(chunk) == _CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+# apply function to the items with pool, and yield the results in order
+# unlike Pool.imap(), which takes the items as fast as it can, at most
+# max_pending items are submitted and not yet taken at the same time
+def _bounded_imap(pool, function, items, max_pending):
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+# read the games in the SGF files, and yield their GameRecords in order
+# the files are read block by block and split into games, which are
+# parsed and replayed in chunks by num_processes worker processes (or in
+# this process if num_processes is 1), and only a bounded number of
+# chunks is submitted ahead of the reader, so that only a bounded number
+# of games is in memory however large the collection is
+# the number of games skipped is logged at the end
+def read_sgf_records(paths, conf, num_processes=1):
+    skipped = 0
+    if num_processes == 1:
+        results = (_replay_chunk(chunk, conf) for chunk in _chunks(paths))
+        for records, skipped_ in results:
+            skipped += skipped_
+            for data in records:
+                yield GameRecord.from_bytes(data)
+    else:
+        context = mp.get_context('spawn')
+        with context.Pool(num_processes) as pool:
+            results = _bounded_imap(
+                pool, functools.partial(_replay_chunk, conf=conf),
+                _chunks(paths), _CHUNKS_PER_PROCESS * num_processes)
+            for records, skipped_ in results:
+                skipped += skipped_
+                for data in records:
+                    yield GameRecord.from_bytes(data)
+    if skipped > 0:
+        log.warning('{} games skipped'.format(skipped))
+
+
+# add the games in the SGF files to example_pool (see example.py), and
+# return the number of games added
+def import_sgf(example_pool, paths, conf, num_processes=1):
+    count = 0
+    for record in read_sgf_records(paths, conf, num_processes):
+        example_pool.add_game(record)
+        count += 1
+    return count
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from glob import glob
+import os
+
+import numpy as np
+
+from record import GameRecord
+
+# number of games stored in each shard
+GAMES_PER_SHARD = 10000
+
+
+# an append-only on-disk storage of games
+# every game is written exactly once and identified by its id, which is
+# the number of games stored before it
+# the games are stored in shards, the game of id i is the
+# (i % GAMES_PER_SHARD)th game in the shard of id i // GAMES_PER_SHARD
+# each shard consists of two files:
+#   - shard_<id>.bin: the serialized games (see GameRecord.to_bytes())
+#     written back to back
+#   - shard_<id>.idx: the offset and the size of each game in the .bin
+#     file, stored as pairs of int64
+# the game is appended to the .bin file before its entry is appended to
+# the .idx file, so a game is never visible until it is completely
+# written, and a game whose write was interrupted is discarded when the
+# storage is opened again (see _recover())
+class GameStorage:
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # count the games in the existing shards
+        self._num_games = 0
+        for path in glob(os.path.join(directory, 'shard_*.idx')):
+            self._num_games += self._recover(path)
+
+        # index of the shard being read, cached to avoid reloading it
+        # for every game
+        self._index_shard = -1
+        self._index = None
+
+    # if the process was killed when writing a game, drop the trailing
+    # incomplete entry of the index and the bytes of the .bin file after
+    # the last indexed game, so that the next game is appended right
+    # after it, and return the number of games in the shard
+    @staticmethod
+    def _recover(idx_path):
+        size = os.path.getsize(idx_path)
+        if size % 16 != 0:
+            size -= size % 16
+            os.truncate(idx_path, size)
+
+        end = 0
+        if size > 0:
+            with open(idx_path, 'rb') as f:
+                f.seek(size - 16)
+                offset, game_size = np.frombuffer(f.read(16), dtype=np.int64)
+            end = int(offset + game_size)
+        bin_path = idx_path[:-len('idx')] + 'bin'
+        if os.path.exists(bin_path) and os.path.getsize(bin_path) > end:
+            os.truncate(bin_path, end)
+        return size // 16
+
+    def __len__(self):
+        return self._num_games
+
+    def _path(self, shard, extension):
+        return os.path.join(
+            self.directory, 'shard_{:06d}.{}'.format(shard, extension))
+
+    # append a finished game, and return its id
+    def append(self, record):
+        game_id = self._num_games
+        shard = game_id // GAMES_PER_SHARD
+        data = record.to_bytes()
+        with open(self._path(shard, 'bin'), 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+        with open(self._path(shard, 'idx'), 'ab') as f:
+            f.write(np.array([offset, len(data)], dtype=np.int64).tobytes())
+        self._num_games += 1
+        return game_id
+
+    # read the game of the given id
+    def read(self, game_id):
+        shard = game_id // GAMES_PER_SHARD
+        if shard != self._index_shard:
+            self._index = np.fromfile(
+                self._path(shard, 'idx'), dtype=np.int64).reshape(-1, 2)
+            self._index_shard = shard
+        offset, size = self._index[game_id % GAMES_PER_SHARD]
+        with open(self._path(shard, 'bin'), 'rb') as f:
+            f.seek(offset)
+            return GameRecord.from_bytes(f.read(size))
+
+
+# compress a sequence of game ids into a list of [begin, end) runs of
+# consecutive ids
+def to_runs(game_ids):
+    runs = []
+    for game_id in game_ids:
+        if len(runs) > 0 and runs[-1][1] == game_id:
+            runs[-1][1] += 1
+        else:
+            runs.append([game_id, game_id + 1])
+    return runs
+
+
+# the inverse of to_runs()
+def from_runs(runs):
+    for begin, end in runs:
+        for game_id in range(begin, end):
+            yield game_id
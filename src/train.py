@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+
 import glog as log
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import torch.optim as optim
 
+from checkpoint import CheckpointWriter
 from config import get_conf
-from compare import estimate_win_rate
-from example import ExamplePool
+from compare import gate
+import distributed
+from example import create_example_pool
+from loader import BatchLoader
+from metrics import MetricsLogger, pool_metrics
 from network import ZetaGoNetwork
+from storage import GameStorage
 
 
 def learning_rate(step, conf):
@@ -16,8 +27,51 @@ def learning_rate(step, conf):
             return lr
 
 
-def train(model_dir, conf_name, checkpoint_file=None):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# perform one step of SGD on a batch of examples and return the loss
+def optimize(network, optimizer, features, pi, z, step, conf):
+    # set network to train mode
+    network.train()
+
+    # zero the parameter gradients
+    optimizer.zero_grad()
+
+    # forward
+    logp, v = network(features)
+    loss = torch.mean(
+        (z - v) ** 2 - torch.sum(pi * logp, dim=1, keepdim=True))
+
+    # backward
+    loss.backward()
+
+    # set learning rate and optimize
+    lr = learning_rate(step, conf)
+    for group in optimizer.param_groups:
+        group['lr'] = lr
+    optimizer.step()
+
+    return loss.item()
+
+
+# shuffle the example pool, every rank keeps its own shard of the
+# permutation in the distributed mode
+def _shuffle(example_pool, rank, world_size):
+    if world_size == 1:
+        example_pool.shuffle()
+    else:
+        seed = distributed.broadcast(np.random.randint(2 ** 31))
+        example_pool.shuffle(rank, world_size, seed)
+
+
+# train a model, the arguments rank, world_size and device are only
+# used in the distributed mode (see train_distributed())
+# if import_dir is specified, the example pool of a new model is seeded
+# with the games of the game storage in it (e.g., written by the import
+# command, see sgf.py) before the first self-play games
+def train(model_dir, conf_name, checkpoint_file=None,
+          rank=0, world_size=1, device=None, import_dir=None):
+    if device is None:
+        device = torch.device(
+            'cuda' if torch.cuda.is_available() else 'cpu')
 
     if checkpoint_file is None:
         log.info('start training a new model')
@@ -29,13 +83,17 @@ def train(model_dir, conf_name, checkpoint_file=None):
 
         iteration = 0
         step = 0
+        gated_steps = []
 
         # randomly initialize a network and let it to be the current
         # best network
         network = ZetaGoNetwork(conf)
+        network.to(device)
+        if world_size > 1:
+            # start from the same network on all the ranks
+            distributed.broadcast_module(network)
         best_network = ZetaGoNetwork(conf)
         best_network.load_state_dict(network.state_dict())
-        network.to(device)
         best_network.to(device)
 
         # setup the optimizer
@@ -49,20 +107,31 @@ def train(model_dir, conf_name, checkpoint_file=None):
 
         # create an example pool and fill it with examples
         log.info('initializing the example pool...')
-        example_pool = ExamplePool(conf)
-        example_pool.generate_examples(best_network, device)
-        example_pool.shuffle()
+        example_pool = create_example_pool(
+            _local_conf(conf, world_size), model_dir, rank)
+        if import_dir is not None:
+            log.info('{} games added from {}'.format(
+                example_pool.add_stored_games(
+                    GameStorage(import_dir), rank, world_size),
+                import_dir))
+        self_play_metrics = example_pool.generate_examples(
+            best_network, device, rank, world_size)
+        _shuffle(example_pool, rank, world_size)
     else:
         log.info('resume training from checkpoint {}'.format(checkpoint_file))
         log.info('device={}'.format(device))
 
         # load checkpoint and restore all the necessary states
-        checkpoint = torch.load(checkpoint_file)
+        # checkpoint_file is trusted, and conf and the resignation manager
+        # in it are not tensors, so it cannot be loaded with weights_only
+        checkpoint = torch.load(
+            checkpoint_file, map_location=device, weights_only=False)
 
         conf = checkpoint['conf']
 
         iteration = checkpoint['iteration']
         step = checkpoint['step']
+        gated_steps = checkpoint.get('gated_steps', [])
 
         network = ZetaGoNetwork(conf)
         network.load_state_dict(checkpoint['network'])
@@ -78,83 +147,182 @@ def train(model_dir, conf_name, checkpoint_file=None):
             weight_decay=2 * conf.L2_REG)
         optimizer.load_state_dict(checkpoint['optimizer'])
 
-        example_pool = checkpoint['example_pool']
-
-    running_loss = 0.0
-    while iteration < conf.NUM_ITERATIONS:
-        # train the model
-        log.info('start iteration {}'.format(iteration))
-        while example_pool.has_batch():
-            # load a batch of examples
-            features, pi, z = example_pool.load_batch(device)
-
-            # set network to train mode
-            network.train()
+        example_pool = create_example_pool(
+            _local_conf(conf, world_size), model_dir, rank)
+        example_pool.load_state_dict(checkpoint['example_pool'])
+        self_play_metrics = None
+        if world_size > 1:
+            _shuffle(example_pool, rank, world_size)
 
-            # zero the parameter gradients
-            optimizer.zero_grad()
+    # the network whose gradients are all-reduced among the ranks
+    if world_size > 1:
+        parallel_network = DistributedDataParallel(network)
+    else:
+        parallel_network = network
 
-            # forward
-            logp, v = network(features)
-            loss = torch.mean(
-                (z - v) ** 2 - torch.sum(pi * logp, dim=1, keepdim=True))
+    # the batches are prepared in background threads
+    loader = BatchLoader(example_pool, device, conf)
 
-            # backward
-            loss.backward()
+    # the checkpoints are written in the background
+    if rank == 0:
+        checkpoint_writer = CheckpointWriter(
+            model_dir, conf.KEEP_CHECKPOINTS, gated_steps)
+        metrics = MetricsLogger(model_dir, conf, 'train')
+        if self_play_metrics is not None:
+            metrics.write(iteration, step, dict(
+                self_play_metrics, **pool_metrics(example_pool)))
 
-            # set learning rate and optimize
-            lr = learning_rate(step, conf)
-            for group in optimizer.param_groups:
-                group['lr'] = lr
-            optimizer.step()
+    running_loss = 0.0
 
-            running_loss += loss.item()
+    # time spent on optimization since the last checkpoint, which
+    # excludes gating and self-play
+    train_time = 0.0
+    start = time.time()
+    while iteration < conf.NUM_ITERATIONS:
+        # train the model
+        log.info('start iteration {}'.format(iteration))
+        for features, pi, z in loader.epoch():
+            running_loss += optimize(
+                parallel_network, optimizer, features, pi, z, step, conf)
             step += 1
 
-            if step % conf.CHECKPOINT_FREQUENCY == 0:
+            if step % conf.CHECKPOINT_FREQUENCY == 0 and rank != 0:
+                # follow the decision of rank 0
+                if distributed.broadcast(None):
+                    best_network.load_state_dict(network.state_dict())
+                    example_pool.opening_cache.clear()
+                running_loss = 0.0
+                loader.wait_time = 0.0
+            elif step % conf.CHECKPOINT_FREQUENCY == 0:
+                train_time += time.time() - start
                 log.info('[iter={}] checkpoint reached, step={}'
                          .format(iteration, step))
 
                 # update best_network if the new network is stronger
                 # notice that it is necessary to make a copy
-                log.info('[iter={}] comparing current network ' +
+                log.info('[iter={}] comparing current network '
                          'with best network...'.format(iteration))
-                win_rate = estimate_win_rate(
-                    network, best_network, device, conf)
-                if win_rate > conf.WIN_RATE_MARGIN:
-                    log.info('[iter={}] best network updated, win_rate={}'
-                             .format(iteration, win_rate))
+                gating_start = time.time()
+                better, win_rate, num_games = gate(
+                    network, best_network, device, conf,
+                    sgf_file='{}/sgf/evaluation_{}.sgf'.format(
+                        model_dir, step))
+                gating_time = time.time() - gating_start
+                if world_size > 1:
+                    distributed.broadcast(better)
+                if better:
+                    log.info('[iter={}] best network updated, win_rate={}, '
+                             '{} games played, {} games saved'
+                             .format(iteration, win_rate, num_games,
+                                     conf.GAMES_PER_EVALUATION - num_games))
                     best_network.load_state_dict(network.state_dict())
+                    example_pool.opening_cache.clear()
                 else:
-                    log.info('[iter={}] best network not updated, win_rate={}'
-                             .format(iteration, win_rate))
+                    log.info('[iter={}] best network not updated, '
+                             'win_rate={}, {} games played, {} games saved'
+                             .format(iteration, win_rate, num_games,
+                                     conf.GAMES_PER_EVALUATION - num_games))
 
                 # save model and print statistics
                 running_loss /= conf.CHECKPOINT_FREQUENCY
-                torch.save({
+                checkpoint_writer.save({
                     'conf': conf,
                     'iteration': iteration,
                     'step': step,
-                    'example_pool': example_pool,
+                    'example_pool': example_pool.state_dict(),
                     'best_network': best_network.state_dict(),
                     'network': network.state_dict(),
                     'optimizer': optimizer.state_dict(),
-                }, '{}/checkpoint_{}.pt'.format(model_dir, step))
-                log.info('[iter={}] checkpoint saved, running_loss={}'
-                         .format(iteration, running_loss))
+                }, step, gated=better)
+                log.info('[iter={}] checkpoint saved, running_loss={}, '
+                         'data_wait={:.1f}s'
+                         .format(iteration, running_loss, loader.wait_time))
+                metrics.write(iteration, step, dict({
+                    'running_loss': running_loss,
+                    'steps_per_second':
+                        conf.CHECKPOINT_FREQUENCY / max(train_time, 1e-6),
+                    'data_wait': loader.wait_time,
+                    'gating_seconds': gating_time,
+                    'gating_games': num_games,
+                    'win_rate': win_rate,
+                    'gated': better,
+                }, **pool_metrics(example_pool)))
                 running_loss = 0.0
+                loader.wait_time = 0.0
+                train_time = 0.0
+                start = time.time()
 
+        train_time += time.time() - start
         log.info('[iter={}] generating new examples for the next iteration...'
                  .format(iteration))
-        example_pool.generate_examples(best_network, device)
-        example_pool.shuffle()
+        self_play_metrics = example_pool.generate_examples(
+            best_network, device, rank, world_size)
+        _shuffle(example_pool, rank, world_size)
+        if rank == 0:
+            metrics.write(iteration, step, dict(
+                self_play_metrics, **pool_metrics(example_pool)))
+        start = time.time()
 
         iteration += 1
 
+    if rank != 0:
+        return
+
     # training finished, save the final best network
+    checkpoint_writer.close()
     model_path = '{}/model.pt'.format(model_dir)
     torch.save({
         'conf': conf,
         'network': best_network.state_dict(),
     }, model_path)
     log.info('finished training, model saved to {}'.format(model_path))
+
+
+# every rank trains on BATCH_SIZE / world_size examples per step
+def _local_conf(conf, world_size):
+    if conf.BATCH_SIZE % world_size != 0:
+        raise ValueError('BATCH_SIZE ({}) is not divisible by the number '
+                         'of processes ({})'.format(conf.BATCH_SIZE,
+                                                    world_size))
+    return conf._replace(BATCH_SIZE=conf.BATCH_SIZE // world_size)
+
+
+def _train_rank(local_rank, model_dir, conf_name, checkpoint_file,
+                rank_offset, world_size, import_dir=None):
+    rank = rank_offset + local_rank
+    device = distributed.device_of(local_rank)
+    if device.type == 'cpu':
+        # share the cores of the node among the local ranks
+        local_world_size = int(os.environ.get(
+            'LOCAL_WORLD_SIZE', world_size))
+        torch.set_num_threads(
+            max(1, torch.get_num_threads() // local_world_size))
+    if rank != 0:
+        log.setLevel('WARNING')
+
+    distributed.init(rank, world_size)
+    try:
+        train(model_dir, conf_name, checkpoint_file,
+              rank=rank, world_size=world_size, device=device,
+              import_dir=import_dir)
+    finally:
+        distributed.destroy()
+
+
+# train a model with distributed data parallelism (see distributed.py)
+# if the process is started by a launcher like torchrun, which sets the
+# environment variables RANK, LOCAL_RANK and WORLD_SIZE, it runs as a
+# single rank, otherwise num_processes local ranks are started
+def train_distributed(model_dir, conf_name, checkpoint_file=None,
+                      num_processes=1, import_dir=None):
+    if 'RANK' in os.environ:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        _train_rank(local_rank, model_dir, conf_name, checkpoint_file,
+                    int(os.environ['RANK']) - local_rank,
+                    int(os.environ['WORLD_SIZE']), import_dir)
+    else:
+        distributed.init_local_master()
+        mp.spawn(_train_rank,
+                 args=(model_dir, conf_name, checkpoint_file,
+                       0, num_processes, import_dir),
+                 nprocs=num_processes)
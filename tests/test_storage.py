@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from record import GameRecord  # noqa: E402
+from storage import GameStorage  # noqa: E402
+
+
+def _record(num_moves):
+    record = GameRecord()
+    for action in range(num_moves):
+        record.append_played(action)
+    record.finish(1.0)
+    return record
+
+
+def _actions(record):
+    return [int(a) for a in record.actions]
+
+
+# simulate a process killed in the middle of writing a game: the game
+# is partially written to the .bin file, and its index entry is torn
+def test_recover_from_interrupted_write(tmp_path):
+    directory = str(tmp_path)
+    storage = GameStorage(directory)
+    for num_moves in (3, 5):
+        storage.append(_record(num_moves))
+
+    data = _record(7).to_bytes()
+    with open(os.path.join(directory, 'shard_000000.bin'), 'ab') as f:
+        f.write(data[:len(data) // 2])
+    with open(os.path.join(directory, 'shard_000000.idx'), 'ab') as f:
+        f.write(b'\0' * 9)
+
+    storage = GameStorage(directory)
+    assert len(storage) == 2
+    assert storage.append(_record(4)) == 2
+
+    storage = GameStorage(directory)
+    assert len(storage) == 3
+    assert [_actions(storage.read(i)) for i in range(3)] == [
+        list(range(3)), list(range(5)), list(range(4))]